@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Compares the per-line :class:`ansi2html.Ansi2HTMLConverter` conversion
+(the way :class:`kozmic.builds.tasks.Publisher` used to work) with the batch
+conversion by :class:`kozmic.builds.ansi.AnsiToHtmlConverter`.
+
+Usage::
+
+    PYTHONPATH=. python ./benchmarks/ansi_conversion.py [number-of-lines]
+"""
+import sys
+import time
+
+import ansi2html
+
+from kozmic.builds.ansi import AnsiToHtmlConverter
+
+
+SAMPLE_LINES = [
+    '\x1b[4mRunning "jshint:lib" (jshint) task\x1b[24m',
+    '\x1b[32m>> \x1b[39m3 files lint free.',
+    'test_views.py::TestProjects::test_history \x1b[32mPASSED\x1b[0m',
+    'Downloading/unpacking Flask==0.10.1 (from -r requirements.txt (line 1))',
+    '\x1b[1;31mE       assert <Job #1> == None\x1b[0m',
+]
+BATCH_SIZE = 500
+
+
+def measure(f):
+    started_at = time.time()
+    f()
+    return time.time() - started_at
+
+
+def main(n):
+    lines = [SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in xrange(n)]
+
+    def convert_per_line():
+        converter = ansi2html.Ansi2HTMLConverter()
+        for line in lines:
+            converter.convert(line, full=False) + '\n'
+
+    def convert_in_batches():
+        converter = AnsiToHtmlConverter()
+        for i in xrange(0, n, BATCH_SIZE):
+            converter.feed('\n'.join(lines[i:i + BATCH_SIZE]) + '\n')
+
+    per_line = measure(convert_per_line)
+    in_batches = measure(convert_in_batches)
+    print('{} lines'.format(n))
+    print('ansi2html, per line:           {:.3f}s'.format(per_line))
+    print('AnsiToHtmlConverter, batches:  {:.3f}s ({:.1f}x)'.format(
+        in_batches, per_line / in_batches))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Compares the per-task overhead of creating an application for every task
+(the way ``ContextTask`` used to work) with pushing a context of
+the application created once per worker process. Each variant runs in
+a child process, so that their peak memory usage can be compared too.
+
+Usage::
+
+    PYTHONPATH=. python ./benchmarks/task_overhead.py [number-of-tasks]
+"""
+import os
+import sys
+import time
+import resource
+
+from kozmic import create_app, db
+
+
+def run_tasks(n, reuse_app):
+    app = create_app()
+    started_at = time.time()
+    for _ in xrange(n):
+        task_app = app if reuse_app else create_app()
+        with task_app.app_context():
+            db.session  # Make sure the task can use the session
+    elapsed = time.time() - started_at
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, max_rss
+
+
+def measure(n, reuse_app):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.write(write_fd, '{} {}'.format(*run_tasks(n, reuse_app)))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 1024)
+    os.waitpid(pid, 0)
+    elapsed, max_rss = result.split()
+    return float(elapsed), int(max_rss)
+
+
+def main(n):
+    per_task_app = measure(n, reuse_app=False)
+    per_worker_app = measure(n, reuse_app=True)
+    print('{} tasks'.format(n))
+    for title, (elapsed, max_rss) in (
+            ('create_app() per task:  ', per_task_app),
+            ('app context per task:   ', per_worker_app)):
+        print('{}{:.3f}ms per task, max RSS {} KiB'.format(
+            title, elapsed * 1000 / n, max_rss))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -8,7 +8,6 @@ kozmic
 import os
 import logging
 
-import docker as _docker
 import flask
 import raven.contrib
 from celery import Celery, Task
@@ -38,9 +37,12 @@ celery = Celery()
 csrf = CsrfProtect()
 mail = Mail()
 moment = Moment()
-docker = LocalProxy(lambda: _docker.Client(
-    base_url=flask.current_app.config['DOCKER_URL'],
-    version=flask.current_app.config['DOCKER_API_VERSION']))
+docker = LocalProxy(lambda: _get_docker_client())
+
+
+def _get_docker_client():
+    from .docker_utils import get_docker_client
+    return get_docker_client()
 
 
 def create_app(config=None):
@@ -121,12 +123,15 @@ def configure_blueprints(app):
 def register_jinja2_globals_and_filters(app):
     import wtforms
     from kozmic.builds import get_ansi_to_html_converter
+    from kozmic.builds.ansi import ansi_to_html
+    from kozmic.builds.rendering import render_job_log, render_job_log_window
     app.jinja_env.globals['get_version'] = get_version
     app.jinja_env.globals['bootstrap_is_hidden_field'] = \
         lambda field: isinstance(field, wtforms.HiddenField)
     ansi_converter = get_ansi_to_html_converter()
-    app.jinja_env.filters['ansi2html'] = \
-        lambda ansi: ansi_converter.convert(ansi, full=False)
+    app.jinja_env.filters['ansi2html'] = ansi_to_html
+    app.jinja_env.globals['render_job_log'] = render_job_log
+    app.jinja_env.globals['render_job_log_window'] = render_job_log_window
     app.jinja_env.filters['precise_moment'] = \
         lambda dt: moment.create(dt).format('H:mm:ss, MMM DD')
     app.jinja_env.globals['render_ansi2html_style_tag'] = \
@@ -134,13 +139,30 @@ def register_jinja2_globals_and_filters(app):
 
 
 def init_celery_app(app, celery):
+    from .redis_utils import get_broker_transport_options
+    from .utils import get_worker_slots
     celery.config_from_object(app.config)
+    celery.conf.BROKER_TRANSPORT_OPTIONS = dict(
+        get_broker_transport_options(app.config),
+        **app.config.get('BROKER_TRANSPORT_OPTIONS', {}))
+    # Tasks are run in the context of the application the worker process
+    # has been started with (see :mod:`kozmic.entry_point`), so that
+    # per-application caches in ``app.extensions`` outlive tasks
+    celery.flask_app = app
+    if 'CELERYD_CONCURRENCY' not in app.config:
+        # Every worker process does one job at a time
+        celery.conf.CELERYD_CONCURRENCY = (
+            app.config['KOZMIC_WORKER_SLOTS'] or get_worker_slots(
+                app.config['KOZMIC_WORKER_CPUS_PER_JOB'],
+                app.config['KOZMIC_WORKER_MEMORY_PER_JOB']))
 
     class ContextTask(Task):
         abstract = True
 
         def __call__(self, *args, **kwargs):
-            with create_app().app_context():
+            # Every task gets a fresh application context. Popping it
+            # removes the scoped database session of the task
+            with self.app.flask_app.app_context():
                 return super(ContextTask, self).__call__(*args, **kwargs)
 
     celery.Task = ContextTask
@@ -11,9 +11,10 @@ kozmic.builds
     .. note::
         Does not require authentication.
 """
-import ansi2html
 from flask import Blueprint
 
+from .ansi import AnsiToHtmlConverter
+
 
 bp = Blueprint('builds', __name__)
 
@@ -28,4 +29,8 @@ def register_views():
 
 
 def get_ansi_to_html_converter():
-    return ansi2html.Ansi2HTMLConverter()
+    """Returns a new stateful ANSI-to-HTML converter.
+
+    :rtype: :class:`~kozmic.builds.ansi.AnsiToHtmlConverter`
+    """
+    return AnsiToHtmlConverter()
@@ -0,0 +1,230 @@
+# coding: utf-8
+"""
+kozmic.builds.ansi
+~~~~~~~~~~~~~~~~~~
+
+An incremental ANSI-to-HTML converter.
+
+Unlike :class:`ansi2html.Ansi2HTMLConverter`, which starts from scratch on
+every call, :class:`AnsiToHtmlConverter` remembers the current SGR state
+(colors, intensity, underline, etc.) between :meth:`~AnsiToHtmlConverter.feed`
+calls, so a job log can be converted batch by batch without losing colors
+that span multiple lines or batches.
+
+The produced markup uses the same CSS classes as ansi2html does, so the
+ansi2html stylesheet (see :meth:`AnsiToHtmlConverter.produce_headers`)
+applies to it.
+
+.. autoclass:: AnsiToHtmlConverter
+   :members:
+
+.. autofunction:: ansi_to_html
+"""
+import re
+
+from ansi2html.style import get_styles
+
+
+FULL_RESET = 0
+FOREGROUND_256 = 38
+FOREGROUND_DEFAULT = 39
+BACKGROUND_256 = 48
+BACKGROUND_DEFAULT = 49
+NEGATIVE_ON = 7
+NEGATIVE_OFF = 27
+
+#: Attribute codes grouped by the attribute they control. The first code
+#: of each group is the "off" (default) value
+ATTRIBUTES = (
+    ('intensity', (22, 1, 2)),
+    ('style', (23, 3)),
+    ('blink', (25, 5, 6)),
+    ('underline', (24, 4)),
+    ('crossedout', (29, 9)),
+    ('visibility', (28, 8)),
+)
+ATTRIBUTE_BY_CODE = dict((code, (name, codes[0]))
+                         for name, codes in ATTRIBUTES for code in codes)
+
+#: The maximum number of cached state transitions
+MAX_TRANSITIONS = 1000
+
+CSI_RE = re.compile(r'\x1b\[([\d;]*)([a-zA-Z])')
+INCOMPLETE_CSI_RE = re.compile(r'\x1b(\[[\d;]*)?\Z')
+
+
+class SGRState(object):
+    """The current Select Graphic Rendition state."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for name, codes in ATTRIBUTES:
+            setattr(self, name, codes[0])
+        self.foreground = (FOREGROUND_DEFAULT, None)
+        self.background = (BACKGROUND_DEFAULT, None)
+        self.negative = NEGATIVE_OFF
+
+    def apply(self, params):
+        """Applies a list of SGR parameters."""
+        i = 0
+        while i < len(params):
+            code = params[i]
+            if code == FULL_RESET:
+                self.reset()
+            elif code in ATTRIBUTE_BY_CODE:
+                name, _ = ATTRIBUTE_BY_CODE[code]
+                setattr(self, name, code)
+            elif 30 <= code <= 37 or code == FOREGROUND_DEFAULT:
+                self.foreground = (code, None)
+            elif 40 <= code <= 47 or code == BACKGROUND_DEFAULT:
+                self.background = (code, None)
+            elif code in (FOREGROUND_256, BACKGROUND_256):
+                # "38;5;n" and "48;5;n" -- 256 colors
+                if i + 2 < len(params):
+                    color = (code, params[i + 2])
+                    if code == FOREGROUND_256:
+                        self.foreground = color
+                    else:
+                        self.background = color
+                i += 2
+            elif code in (NEGATIVE_ON, NEGATIVE_OFF):
+                self.negative = code
+            i += 1
+
+    def get_key(self):
+        """Returns a hashable representation of the state."""
+        return tuple(getattr(self, name) for name, _ in ATTRIBUTES) + (
+            self.foreground, self.background, self.negative)
+
+    def set_key(self, key):
+        """Restores the state from :meth:`get_key` result."""
+        for (name, _), value in zip(ATTRIBUTES, key):
+            setattr(self, name, value)
+        self.foreground, self.background, self.negative = key[len(ATTRIBUTES):]
+
+    def get_css_classes(self):
+        css_classes = ['ansi{}'.format(getattr(self, name))
+                       for name, codes in ATTRIBUTES
+                       if getattr(self, name) != codes[0]]
+
+        negative = self.negative == NEGATIVE_ON
+        for (code, parameter), default, negative_css_class in (
+                (self.foreground, FOREGROUND_DEFAULT, 'inv_background'),
+                (self.background, BACKGROUND_DEFAULT, 'inv_foreground')):
+            if code != default:
+                css_classes.append('{}{}'.format(
+                    'inv' if negative else 'ansi',
+                    code if parameter is None else '{}-{}'.format(code, parameter)))
+            elif negative:
+                css_classes.append(negative_css_class)
+        return css_classes
+
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class AnsiToHtmlConverter(object):
+    """A stateful ANSI-to-HTML converter.
+
+    The output of every :meth:`feed` call is a well-formed HTML fragment.
+    Moreover, spans never cross line boundaries: they are closed at the end
+    of each line and reopened at the beginning of the next one, so the output
+    can be safely split into lines.
+
+    Escape sequences that are split between two :meth:`feed` calls are
+    handled correctly. Control sequences other than SGR (cursor movements,
+    line erasing, etc.) are dropped.
+    """
+    def __init__(self):
+        self._state = SGRState()
+        self._state_key = self._state.get_key()
+        self._pending = ''
+        # Maps (state key, SGR parameters) pairs to (new state key,
+        # opening span tag) pairs. Logs usually contain only a handful
+        # of distinct sequences, so most of them are processed by
+        # a single dictionary lookup
+        self._transitions = {}
+
+    def reset(self):
+        """Resets the converter to the initial state."""
+        self._state.reset()
+        self._state_key = self._state.get_key()
+        self._pending = ''
+
+    def _get_open_tag(self):
+        css_classes = self._state.get_css_classes()
+        return css_classes and '<span class="{}">'.format(' '.join(css_classes))
+
+    def _apply(self, params):
+        transition = self._transitions.get((self._state_key, params))
+        if transition is None:
+            try:
+                codes = [int(code or FULL_RESET) for code in params.split(';')]
+            except ValueError:
+                codes = [FULL_RESET]
+            self._state.set_key(self._state_key)
+            self._state.apply(codes)
+            transition = (self._state.get_key(), self._get_open_tag())
+            if len(self._transitions) >= MAX_TRANSITIONS:
+                self._transitions.clear()
+            self._transitions[(self._state_key, params)] = transition
+        self._state_key, open_tag = transition
+        return open_tag
+
+    def feed(self, ansi, final=False):
+        """Converts the next chunk of ANSI text to HTML.
+
+        :param ansi: the next chunk of ANSI text
+        :type ansi: str or unicode
+
+        :param final: whether this is the last chunk. If it is not, an escape
+                      sequence at the end of `ansi` that may be not complete
+                      yet is held until the next call.
+        """
+        ansi = self._pending + ansi
+        self._pending = ''
+        if not final:
+            match = INCOMPLETE_CSI_RE.search(ansi)
+            if match:
+                self._pending = ansi[match.start():]
+                ansi = ansi[:match.start()]
+        # Escaping never touches escape sequences, so it's safe
+        # to escape the whole chunk at once
+        ansi = escape(ansi)
+
+        parts = []
+        self._state.set_key(self._state_key)
+        open_tag = self._get_open_tag()
+        last_end = 0
+        for match in CSI_RE.finditer(ansi):
+            self._append_text(parts, ansi[last_end:match.start()], open_tag)
+            last_end = match.end()
+            params, command = match.groups()
+            if command == 'm':
+                open_tag = self._apply(params)
+        self._append_text(parts, ansi[last_end:], open_tag)
+
+        return ''.join(parts)
+
+    @staticmethod
+    def _append_text(parts, text, open_tag):
+        if not open_tag:
+            parts.append(text)
+            return
+        for i, line in enumerate(text.split('\n')):
+            if i:
+                parts.append('\n')
+            if line:
+                parts.extend((open_tag, line, '</span>'))
+
+    def produce_headers(self):
+        """Returns a ``<style>`` tag with CSS classes used in the output."""
+        return '<style type="text/css">\n{}\n</style>\n'.format(
+            '\n'.join(map(str, get_styles(True, 'ansi2html'))))
+
+
+def ansi_to_html(ansi):
+    """Converts the whole `ansi` text to HTML at once."""
+    return AnsiToHtmlConverter().feed(ansi, final=True)
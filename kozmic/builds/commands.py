@@ -3,8 +3,14 @@ import collections
 import datetime as dt
 
 import flask
+import redis
+from docker import APIError as DockerAPIError
 
-from kozmic import docker
+from kozmic import docker, docker_utils
+from kozmic.models import Project, Job
+from kozmic.redis_utils import get_redis_client, get_pool_stats
+from .tasks import get_scheduler, get_project_limits
+from . import messages
 
 
 logger = logging.getLogger(__name__)
@@ -38,5 +44,114 @@ def clean_dependencies_cache(verbose=True):
         images_to_remove = [image for _, image in
                             sorted(timestamped_images)[:-limit]]
         for image in images_to_remove:
-            docker.remove_image(image)
+            try:
+                docker_utils.remove_image(image)
+            except DockerAPIError as e:
+                # An image of an install stage can not be removed
+                # while images of the following stages exist
+                logger.info('Failed to remove %s: %s', image, e)
+                continue
             logger.info('Removed %s', image)
+
+
+def get_log_buffers_stats(redis_client):
+    """Returns a list of dictionaries that describe Redis log buffers
+    of the jobs that have been started and have not finished.
+    Each dictionary contains the following keys: ``job`` (:class:`Job`),
+    ``lines`` (number of lines in the buffer), ``bytes`` (their total size),
+    ``trimmed_lines`` and ``ttl`` (in seconds, ``None`` if the buffer
+    does not exist).
+    """
+    jobs = Job.query.filter(Job.started_at != None,
+                            Job.finished_at == None).order_by(Job.id).all()
+    pipeline = redis_client.pipeline(transaction=False)
+    for job in jobs:
+        meta_key = messages.get_meta_key(job.task_uuid)
+        pipeline.llen(job.task_uuid)
+        pipeline.hmget(meta_key, 'bytes', 'offset')
+        pipeline.ttl(job.task_uuid)
+    results = pipeline.execute()
+
+    stats = []
+    for i, job in enumerate(jobs):
+        lines, (size, offset), ttl = results[i * 3:i * 3 + 3]
+        stats.append({
+            'job': job,
+            'lines': lines,
+            'bytes': int(size or 0),
+            'trimmed_lines': int(offset or 0),
+            'ttl': ttl if lines else None,
+        })
+    return stats
+
+
+def show_log_buffers():
+    """Reports Redis memory used by log buffers of running jobs."""
+    redis_client = get_redis_client()
+    stats = get_log_buffers_stats(redis_client)
+    for buffer_stats in stats:
+        job = buffer_stats['job']
+        logger.info('Job #%s (%s): %s lines, %s bytes, %s lines trimmed, '
+                    'TTL: %s', job.id, job.task_uuid, buffer_stats['lines'],
+                    buffer_stats['bytes'], buffer_stats['trimmed_lines'],
+                    buffer_stats['ttl'])
+    logger.info('Total: %s buffers, %s lines, %s bytes', len(stats),
+                sum(buffer_stats['lines'] for buffer_stats in stats),
+                sum(buffer_stats['bytes'] for buffer_stats in stats))
+    logger.info('Redis memory used: %s',
+                redis_client.info()['used_memory_human'])
+
+
+def show_redis_pools():
+    """Reports Redis connections used by the processes that have
+    reported their connection pool stats during the last hour.
+    """
+    redis_client = get_redis_client()
+    pool_stats = get_pool_stats(redis_client)
+    for name, stats in sorted(pool_stats.iteritems()):
+        logger.info('%s: %s open, %s in use, %s at peak, limit: %s, '
+                    'failed health checks: %s', name, stats['created'],
+                    stats['in_use'], stats['peak_in_use'], stats['max'],
+                    stats['failed_health_checks'])
+    logger.info('Total: %s processes, %s open connections, %s at peak',
+                len(pool_stats),
+                sum(stats['created'] for stats in pool_stats.itervalues()),
+                sum(stats['peak_in_use'] for stats in pool_stats.itervalues()))
+    info = redis_client.info()
+    try:
+        maxclients = redis_client.config_get('maxclients')['maxclients']
+    except redis.ResponseError:
+        # CONFIG may be disabled
+        maxclients = 'unknown'
+    logger.info('Redis connected clients: %s, maxclients: %s',
+                info['connected_clients'], maxclients)
+
+
+def show_scheduler_queues():
+    """Reports queued and running jobs of every project and
+    for how long their jobs wait for a worker slot.
+    """
+    stats = get_scheduler().get_stats()
+    limits = get_project_limits(list(stats))
+    projects = dict((project.id, project) for project in
+                    Project.query.filter(Project.id.in_(list(stats))))
+
+    def format_time(seconds):
+        return 'n/a' if seconds is None else '{:.1f}s'.format(seconds)
+
+    for project_id, project_stats in sorted(stats.iteritems()):
+        project = projects.get(project_id)
+        cap, weight = limits.get(project_id, (None, 1))
+        logger.info('%s (#%s): %s queued, %s running (limit: %s, weight: %s), '
+                    'oldest queued: %s, %s started, average wait: %s, '
+                    'last wait: %s',
+                    project.gh_full_name if project else 'deleted project',
+                    project_id, project_stats['queued'],
+                    project_stats['running'], cap or 'none', weight,
+                    format_time(project_stats['oldest_wait_time']),
+                    project_stats['started'],
+                    format_time(project_stats['average_wait_time']),
+                    format_time(project_stats['last_wait_time']))
+    logger.info('Total: %s queued, %s running',
+                sum(s['queued'] for s in stats.itervalues()),
+                sum(s['running'] for s in stats.itervalues()))
@@ -0,0 +1,184 @@
+# coding: utf-8
+"""
+kozmic.builds.follower
+~~~~~~~~~~~~~~~~~~~~~~
+
+An in-process replacement for ``tail -f``.
+
+.. autoclass:: LogFollower
+"""
+import os
+import errno
+import select
+import time
+import ctypes
+import ctypes.util
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# See inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_ATTRIB = 0x00000004
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+
+class Inotify(object):
+    """A minimal ctypes wrapper around Linux inotify that watches
+    a single file for modifications.
+
+    Use :meth:`create` to get an instance; it returns ``None`` if inotify
+    is not available (non-Linux hosts, exhausted watch limits, etc.).
+    """
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def create(cls, path):
+        if _libc is None:
+            return None
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.info('inotify_init1 has failed with errno %i.',
+                        ctypes.get_errno())
+            return None
+        wd = _libc.inotify_add_watch(
+            fd, path.encode('utf-8') if isinstance(path, unicode) else path,
+            IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB)
+        if wd < 0:
+            logger.info('inotify_add_watch has failed with errno %i.',
+                        ctypes.get_errno())
+            os.close(fd)
+            return None
+        return cls(fd)
+
+    def wait(self, timeout):
+        """Blocks until the watched file is modified or `timeout` seconds
+        pass. Returns True if there were any events.
+        """
+        try:
+            reads, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        if not reads:
+            return False
+        # Drain the queued events: we don't care about their content,
+        # only about the fact that the file has changed
+        while True:
+            try:
+                if not os.read(self.fd, 4096):
+                    break
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogFollower(object):
+    """Follows a growing log file by byte offset.
+
+    Each :meth:`read_lines` call returns all the complete lines that have been
+    appended since the previous call. :meth:`wait` blocks until the file
+    changes; it uses inotify if it is available and falls back to polling
+    otherwise.
+
+    :param path: path to the log file to follow
+    :type path: str
+
+    :param poll_interval: number of seconds between file checks
+                          when inotify is not available
+    :type poll_interval: float
+
+    :param max_read_size: the maximum number of bytes to read
+                          by a single :meth:`read_lines` call
+    :type max_read_size: int
+    """
+    def __init__(self, path, poll_interval=0.5, max_read_size=1024 * 1024):
+        self._path = path
+        self._poll_interval = poll_interval
+        self._max_read_size = max_read_size
+        self._fd = os.open(path, os.O_RDONLY)
+        self._inotify = Inotify.create(path)
+        self._buf = ''
+        #: Number of bytes read so far
+        self.offset = 0
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def _read(self):
+        size = os.fstat(self._fd).st_size
+        if size < self.offset:
+            # The file has been truncated, start from the beginning
+            logger.info('%s has been truncated.', self._path)
+            self.offset = 0
+            self._buf = ''
+        if size == self.offset:
+            return ''
+        os.lseek(self._fd, self.offset, os.SEEK_SET)
+        data = os.read(self._fd, min(size - self.offset, self._max_read_size))
+        self.offset += len(data)
+        return data
+
+    def has_unread_data(self):
+        """Returns True if the file contains bytes that have not been read."""
+        return os.fstat(self._fd).st_size != self.offset
+
+    def read_lines(self, final=False):
+        """Returns a list of complete lines (without trailing newlines)
+        appended to the file since the last call.
+
+        :param final: if True, read the file up to its end regardless of
+                      `max_read_size` and also return the last incomplete line
+        """
+        self._buf += self._read()
+        while final and self.has_unread_data():
+            self._buf += self._read()
+        lines = self._buf.split('\n')
+        self._buf = lines.pop()
+        if final and self._buf:
+            lines.append(self._buf)
+            self._buf = ''
+        return lines
+
+    def wait(self, timeout):
+        """Blocks until the file changes or `timeout` seconds pass."""
+        if self._inotify:
+            self._inotify.wait(timeout)
+            return
+        deadline = time.time() + timeout
+        while not self.has_unread_data():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, self._poll_interval))
+
+    def close(self):
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+        os.close(self._fd)
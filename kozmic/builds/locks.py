@@ -0,0 +1,130 @@
+# coding: utf-8
+"""
+kozmic.builds.locks
+~~~~~~~~~~~~~~~~~~~
+
+Single-flight builds of cached images.
+
+When several jobs of the same commit start at once, they all miss the
+install script cache. Only one of them builds the cached image: it
+holds a Redis lock keyed by the image name while the others wait for
+the lock to be released and then use the built image.
+
+The lock expires after :setting:`KOZMIC_CACHE_BUILD_LOCK_TTL` seconds
+unless its holder renews it, which it does in a background thread. So
+if the holder's worker dies, a waiting job takes over within that time.
+
+.. autoclass:: CacheBuildLock
+   :members:
+
+.. autofunction:: single_flight
+"""
+import time
+import threading
+import contextlib
+
+import redis
+
+
+#: How often waiting jobs check the lock, in seconds
+POLL_INTERVAL = 2
+
+
+class CacheBuildLock(object):
+    """A Redis lock that records its holder.
+
+    :param redis_client: Redis client
+    :type redis_client: :class:`redis.StrictRedis`
+
+    :param name: the lock name (for example, a cached image name)
+    :type name: str
+
+    :param holder: the holder id (for example, a job id)
+    :type holder: str
+
+    :param ttl: for how long the lock is held unless renewed, in seconds
+    :type ttl: int
+    """
+    def __init__(self, redis_client, name, holder, ttl=60):
+        self.redis_client = redis_client
+        self.key = 'kozmic:cache-build-lock:' + name
+        self.holder = str(holder)
+        self.ttl = ttl
+        self._stop_renewing = None
+
+    def acquire(self):
+        """Tries to acquire the lock. Returns ``None`` if the lock has been
+        acquired or the id of the current holder otherwise. The returned id
+        is an empty string if the lock has been released meanwhile.
+        """
+        if self.redis_client.set(self.key, self.holder, ex=self.ttl, nx=True):
+            self._stop_renewing = threading.Event()
+            renewer = threading.Thread(target=self._renew,
+                                       args=(self._stop_renewing,))
+            renewer.daemon = True
+            renewer.start()
+            return None
+        return self.redis_client.get(self.key) or ''
+
+    def _if_held(self, command):
+        # Runs `command` on the lock key if it is still held by us
+        def func(pipeline):
+            if pipeline.get(self.key) == self.holder:
+                pipeline.multi()
+                command(pipeline)
+        try:
+            self.redis_client.transaction(func, self.key)
+        except redis.WatchError:
+            # The lock has expired and been acquired by another holder
+            pass
+
+    def _renew(self, stop_renewing):
+        while not stop_renewing.wait(self.ttl / 3.0):
+            try:
+                self._if_held(lambda pipeline: pipeline.expire(self.key, self.ttl))
+            except redis.RedisError:
+                # Try again later, the lock is not lost yet
+                pass
+
+    def release(self):
+        """Releases the lock if it is held."""
+        if self._stop_renewing is not None:
+            self._stop_renewing.set()
+            self._stop_renewing = None
+        self._if_held(lambda pipeline: pipeline.delete(self.key))
+
+
+@contextlib.contextmanager
+def single_flight(lock, is_done, on_wait=None, poll_interval=POLL_INTERVAL):
+    """Makes sure that only one holder of `lock` does the work at a time.
+
+    Yields ``True`` if the work has been done, as reported by `is_done`
+    function, either before or while waiting for `lock`. Otherwise
+    acquires `lock`, yields ``False`` and releases `lock` when
+    the block finishes.
+
+    :param lock: :class:`CacheBuildLock`
+    :param is_done: a function that returns whether the work has been done
+    :param on_wait: a function to be called with the holder id whenever
+                    the caller starts waiting for another holder
+    """
+    waiting_for = None
+    while True:
+        if is_done():
+            yield True
+            return
+        holder = lock.acquire()
+        if holder is None:
+            break
+        if holder and holder != waiting_for:
+            waiting_for = holder
+            if on_wait is not None:
+                on_wait(holder)
+        time.sleep(poll_interval)
+
+    try:
+        # The previous holder may have finished between
+        # the check and the acquisition
+        yield is_done()
+    finally:
+        lock.release()
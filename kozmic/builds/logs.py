@@ -0,0 +1,87 @@
+# coding: utf-8
+"""
+kozmic.builds.logs
+~~~~~~~~~~~~~~~~~~
+
+Chunked job log storage.
+
+Job logs are stored in :class:`~kozmic.models.JobLogChunk` rows, each of
+which holds a zlib-compressed piece of the log of a fixed size together with
+its byte and line offsets. Chunks are written as soon as they fill up, so
+a log is never written by a single huge ``UPDATE`` and is not limited
+by the size of a MySQL column.
+
+.. autoclass:: JobLogWriter
+   :members:
+"""
+import zlib
+import threading
+
+from kozmic.models import JobLogChunk
+
+
+class JobLogWriter(object):
+    """Splits a job log into chunks and writes them to the database.
+
+    It is thread-safe and writes chunks using `engine` directly, bypassing
+    the ORM session, so it can be used from any thread.
+
+    :param engine: SQLAlchemy engine
+    :type engine: :class:`sqlalchemy.engine.Engine`
+
+    :param job_id: :class:`~kozmic.models.Job` identifier
+    :type job_id: int
+
+    :param chunk_size: uncompressed chunk size in bytes
+    :type chunk_size: int
+
+    :param compression_level: zlib compression level
+    :type compression_level: int
+    """
+    def __init__(self, engine, job_id, chunk_size=64 * 1024,
+                 compression_level=6):
+        self._engine = engine
+        self._job_id = job_id
+        self._chunk_size = chunk_size
+        self._compression_level = compression_level
+        self._lock = threading.Lock()
+        self._buffer = ''
+        self._number = 0
+        self._offset = 0
+        self._line_offset = 0
+
+    def write(self, data):
+        """Appends `data` to the log. Writes every chunk that
+        has been filled up.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self._lock:
+            self._buffer += data
+            while len(self._buffer) >= self._chunk_size:
+                self._write_chunk(self._buffer[:self._chunk_size])
+                self._buffer = self._buffer[self._chunk_size:]
+
+    def close(self):
+        """Writes the last, incomplete chunk. Calling it more than once
+        has no effect (unless something has been written in between).
+        """
+        with self._lock:
+            if self._buffer:
+                self._write_chunk(self._buffer)
+                self._buffer = ''
+
+    def _write_chunk(self, data):
+        line_count = data.count('\n')
+        self._engine.execute(
+            JobLogChunk.__table__.insert(),
+            job_id=self._job_id,
+            number=self._number,
+            offset=self._offset,
+            size=len(data),
+            line_offset=self._line_offset,
+            line_count=line_count,
+            data=zlib.compress(data, self._compression_level))
+        self._number += 1
+        self._offset += len(data)
+        self._line_offset += line_count
@@ -0,0 +1,62 @@
+# coding: utf-8
+"""
+kozmic.builds.messages
+~~~~~~~~~~~~~~~~~~~~~~
+
+Format of the messages that :class:`kozmic.builds.tasks.Publisher` sends
+to job log pub/sub channels and :mod:`tailer` receives.
+
+A message carries a batch of log lines prefixed by the sequence number of
+the first of them. Sequence numbers are zero-based line numbers of the job
+log: a line with sequence number N is stored at index N of the job log Redis
+list. They let the readers replay the list and switch to the channel without
+losing or duplicating lines.
+
+The last message of a channel is :data:`END_OF_STREAM`; it is published
+once the job is finished.
+
+The Redis list is capped: once it gets too long, the oldest lines are trimmed.
+The number of trimmed lines is kept in the ``offset`` field of the hash
+stored at :func:`get_meta_key`, so a line with sequence number N is
+actually stored at index N - offset. The ``bytes`` field of the same hash
+contains the total size of the lines in the list.
+
+.. autodata:: END_OF_STREAM
+
+.. autofunction:: encode
+
+.. autofunction:: decode
+
+.. autofunction:: skip_lines
+
+.. autofunction:: get_meta_key
+"""
+
+#: The message that marks the end of a job log
+END_OF_STREAM = 'end'
+
+
+def encode(seq, data):
+    """Returns a message carrying `data` (one or more lines, each ending
+    with a newline) that starts with the line number `seq`.
+    """
+    return '{}\n{}'.format(seq, data)
+
+
+def decode(message):
+    """Returns a ``(seq, data)`` pair encoded by :func:`encode`."""
+    seq, _, data = message.partition('\n')
+    return int(seq), data
+
+
+def skip_lines(data, n):
+    """Returns `data` without its first `n` lines."""
+    if n <= 0:
+        return data
+    parts = data.split('\n', n)
+    return parts[n] if len(parts) > n else ''
+
+
+def get_meta_key(channel):
+    """Returns the key of the hash that describes the `channel` list."""
+    return channel + ':meta'
@@ -0,0 +1,134 @@
+# coding: utf-8
+"""
+kozmic.builds.mirrors
+~~~~~~~~~~~~~~~~~~~~~
+
+Host-side git mirrors of project repositories.
+
+If :setting:`KOZMIC_GIT_MIRRORS_DIR` is set, a worker keeps a bare mirror
+of every project repository it builds in that directory. The mirror is
+updated by ``git fetch`` before each job and mounted read-only into job
+containers, where the source is cloned from it using ``git clone --shared``
+instead of being downloaded from GitHub. So only the first job of a project
+on a worker host transfers the whole repository over the network.
+
+Mirrors are updated under an exclusive file lock, so any number of workers
+can share the same directory.
+
+Private repositories are fetched over SSH with strict host key checking
+against the same host keys as job containers use
+(see :func:`kozmic.builds.ssh.get_known_hosts`), so a mirror, which all
+later checkouts and cache ids of a project rely on, can not be served by
+an impostor.
+
+.. autofunction:: update_git_mirror
+
+.. autoexception:: GitMirrorError
+"""
+import os
+import shutil
+import tempfile
+import contextlib
+import subprocess
+
+from Crypto.PublicKey import RSA
+
+from kozmic.utils import file_lock
+
+
+GIT_SSH_SH = '''
+#!/bin/sh
+exec ssh -i {key_path} -o IdentitiesOnly=yes -o BatchMode=yes \\
+    -o StrictHostKeyChecking=yes -o UserKnownHostsFile={known_hosts_path} "$@"
+'''.strip()
+
+
+class GitMirrorError(Exception):
+    """Raised if a mirror can not be created or updated."""
+
+
+@contextlib.contextmanager
+def _git_env(deploy_key, known_hosts):
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    if not deploy_key:
+        yield env
+        return
+
+    rsa_private_key, passphrase = deploy_key
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # Decrypt the key, so that ssh does not ask for passphrase
+        key_path = os.path.join(temp_dir, 'id_rsa')
+        key_fd = os.open(key_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        with os.fdopen(key_fd, 'w') as key_file:
+            key_file.write(
+                RSA.importKey(rsa_private_key, passphrase).exportKey('PEM'))
+
+        known_hosts_path = os.path.join(temp_dir, 'known_hosts')
+        with open(known_hosts_path, 'w') as known_hosts_file:
+            known_hosts_file.write(known_hosts)
+
+        git_ssh_path = os.path.join(temp_dir, 'git-ssh.sh')
+        with open(git_ssh_path, 'w') as git_ssh:
+            git_ssh.write(GIT_SSH_SH.format(
+                key_path=key_path, known_hosts_path=known_hosts_path))
+        os.chmod(git_ssh_path, 0o700)
+
+        env['GIT_SSH'] = git_ssh_path
+        yield env
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def _git(args, env):
+    process = subprocess.Popen(
+        ['git'] + args, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        raise GitMirrorError('`git {}` has failed with return code {}: {}'.format(
+            args[0], process.returncode, output.strip()))
+
+
+def update_git_mirror(mirrors_dir, name, clone_url, deploy_key=None,
+                      known_hosts=''):
+    """Creates or updates a bare mirror of `clone_url` repository
+    in `mirrors_dir`. Returns the mirror path.
+
+    :param mirrors_dir: a directory to keep mirrors in
+    :type mirrors_dir: str
+
+    :param name: the mirror name, unique within `mirrors_dir`
+    :type name: str
+
+    :param clone_url: the repository clone URL
+    :type clone_url: str
+
+    :param deploy_key: a pair of strings (private key, passphrase)
+                       to be used for fetching from a SSH URL
+    :type deploy_key: 2-tuple of strings
+
+    :param known_hosts: SSH host keys in ``known_hosts`` file format
+                        to check the host of a SSH URL against
+    :type known_hosts: str
+
+    :raises: :exc:`GitMirrorError`
+    """
+    path = os.path.join(mirrors_dir, name + '.git')
+    with file_lock(path + '.lock'), _git_env(deploy_key, known_hosts) as env:
+        if os.path.exists(os.path.join(path, 'HEAD')):
+            # The clone URL changes if the repository is renamed
+            # or made private
+            _git(['--git-dir', path, 'remote', 'set-url', 'origin', clone_url],
+                 env)
+            _git(['--git-dir', path, 'fetch', '--quiet', '--prune', 'origin'],
+                 env)
+        else:
+            # Clone to a temporary path first, so that an interrupted
+            # clone does not leave a broken mirror behind
+            temp_path = path + '.tmp'
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path)
+            _git(['clone', '--quiet', '--mirror', clone_url, temp_path], env)
+            os.rename(temp_path, path)
+    return path
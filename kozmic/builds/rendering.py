@@ -0,0 +1,178 @@
+# coding: utf-8
+"""
+kozmic.builds.rendering
+~~~~~~~~~~~~~~~~~~~~~~~
+
+On-demand rendering of job logs to HTML.
+
+Raw job logs are the single source of truth: neither Redis nor the database
+store HTML. Logs are rendered when someone looks at them and the result is
+kept in a per-process LRU cache keyed by job id and log length, so viewing
+a finished job costs a cache hit. While the job is running its log grows,
+the length changes and the previous rendering gets replaced.
+
+Long logs are shown by windows of lines (see :func:`render_job_log_window`).
+Each window is rendered on its own, so colors that span across a window
+boundary are not carried over to the next window.
+
+.. autofunction:: render_job_log
+
+.. autofunction:: render_job_log_window
+"""
+import threading
+import collections
+
+import flask
+
+from .ansi import ansi_to_html
+
+
+class LRUCache(object):
+    """A thread-safe LRU cache limited by the total length of its values.
+
+    :param max_size: the maximum total length of cached values
+    :type max_size: int
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value  # Move the key to the end
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._delete(key)
+            if len(value) > self.max_size:
+                return
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                _, evicted_value = self._items.popitem(last=False)
+                self.size -= len(evicted_value)
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        if key in self._items:
+            self.size -= len(self._items.pop(key))
+
+
+class JobLogRenderer(object):
+    """Renders job logs to HTML and caches the results.
+
+    :param max_size: the maximum total length of cached HTML
+    :type max_size: int
+    """
+    def __init__(self, max_size):
+        self._cache = LRUCache(max_size)
+        self._lock = threading.Lock()
+        # Maps ids of running jobs to the log lengths they have been
+        # rendered with, to drop outdated renderings once the log grows
+        self._running_job_log_lengths = {}
+
+    def render(self, job):
+        """Returns HTML rendering of the `job` log.
+
+        :type job: :class:`kozmic.models.Job`
+        """
+        log_length = job.get_log_length()
+
+        with self._lock:
+            if job.is_finished():
+                previous_log_length = self._running_job_log_lengths.pop(job.id, None)
+            else:
+                previous_log_length = self._running_job_log_lengths.get(job.id)
+                self._running_job_log_lengths[job.id] = log_length
+        if previous_log_length not in (None, log_length):
+            self._cache.delete((job.id, previous_log_length))
+
+        key = (job.id, log_length)
+        html = self._cache.get(key)
+        if html is None:
+            html = ansi_to_html(job.get_log().decode('utf-8', 'replace'))
+            self._cache.set(key, html)
+        return html
+
+    def render_lines(self, job, start, end):
+        """Returns HTML rendering of the `job` log lines from `start`
+        to `end` (zero-based, `end` is not included).
+
+        :type job: :class:`kozmic.models.Job`
+        """
+        key = (job.id, job.get_log_length(), start, end)
+        html = self._cache.get(key)
+        if html is None:
+            html = ansi_to_html(
+                job.get_log_lines(start, end).decode('utf-8', 'replace'))
+            self._cache.set(key, html)
+        return html
+
+
+def get_job_log_renderer():
+    """Returns :class:`JobLogRenderer` of the current application."""
+    app = flask.current_app
+    renderer = app.extensions.get('kozmic_job_log_renderer')
+    if renderer is None:
+        renderer = JobLogRenderer(app.config['KOZMIC_RENDERED_LOGS_CACHE_SIZE'])
+        app.extensions['kozmic_job_log_renderer'] = renderer
+    return renderer
+
+
+def render_job_log(job):
+    """Returns HTML rendering of the `job` log.
+    See :class:`JobLogRenderer`.
+
+    :type job: :class:`kozmic.models.Job`
+    """
+    return get_job_log_renderer().render(job)
+
+
+def render_job_log_window(job, start=None, end=None):
+    """Returns a window of the `job` log as a dictionary with the following
+    keys: ``start`` and ``end`` (the window bounds, zero-based, ``end`` is
+    not included), ``line_count`` (the number of lines in the whole log)
+    and ``html`` (HTML rendering of the window lines, without a trailing
+    newline).
+
+    The window is limited to :setting:`KOZMIC_LOG_WINDOW_SIZE` lines. If
+    `start` is not specified, the window contains the last lines of the log.
+
+    :type job: :class:`kozmic.models.Job`
+    :type start: int or None
+    :type end: int or None
+    """
+    window_size = flask.current_app.config['KOZMIC_LOG_WINDOW_SIZE']
+    line_count = job.get_log_line_count()
+    if start is None:
+        start = max(line_count - window_size, 0)
+    start = min(max(start, 0), line_count)
+    if end is None:
+        end = start + window_size
+    end = min(max(end, start), start + window_size, line_count)
+
+    html = get_job_log_renderer().render_lines(job, start, end)
+    if html.endswith('\n'):
+        html = html[:-1]
+    return {
+        'start': start,
+        'end': end,
+        'line_count': line_count,
+        'html': html,
+    }
@@ -0,0 +1,249 @@
+# coding: utf-8
+"""
+kozmic.builds.scheduler
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Fair scheduling of jobs across projects.
+
+Jobs are not sent to Celery directly. They are put to per-project queues
+in Redis and every enqueued job sends a
+:func:`~kozmic.builds.tasks.run_next_job` task, which, once a worker slot
+is free, takes the next job from the scheduler and does it. So the Celery
+queue only holds "a slot is needed" tokens and the choice of the job is
+made at the last moment:
+
+* a project does not run more than its concurrency cap
+  (:attr:`kozmic.models.Project.max_concurrent_jobs` or
+  :setting:`KOZMIC_SCHEDULER_MAX_JOBS_PER_PROJECT`) jobs at once;
+* among the other projects with queued jobs, the slot goes to the one
+  that has received the least service relative to its weight
+  (:attr:`kozmic.models.Project.scheduling_weight`): weighted fair queuing
+  with start-time tags, where every job costs one unit. A project that has
+  been idle does not accumulate credit.
+
+Running jobs hold leases that are renewed while they run, so a job of
+a worker that has died stops counting against its project cap once
+its lease expires.
+
+The number of slots of a worker is its Celery concurrency, which defaults
+to what the host can afford (see :setting:`KOZMIC_WORKER_SLOTS`).
+
+.. autoclass:: Scheduler
+   :members:
+"""
+import json
+import time
+import uuid
+import threading
+import contextlib
+
+import redis
+
+
+class Scheduler(object):
+    """Redis-backed per-project job queues.
+
+    :param redis_client: Redis client
+    :type redis_client: :class:`redis.StrictRedis`
+
+    :param prefix: a prefix of the Redis keys
+    :type prefix: str
+
+    :param lease_ttl: for how long a running job lease lasts
+                      unless renewed, in seconds
+    :type lease_ttl: int
+    """
+    def __init__(self, redis_client, prefix='kozmic:scheduler:', lease_ttl=60):
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.lease_ttl = lease_ttl
+        #: A set of ids of the projects that have queued jobs
+        self._projects_key = prefix + 'projects'
+        #: A sorted set of running job leases ("<project id>:<job id>")
+        #: scored by their expiration time
+        self._running_key = prefix + 'running'
+        #: Virtual time: the start tag of the last started job
+        self._vtime_key = prefix + 'vtime'
+        #: A hash that maps project ids to finish tags of their last jobs
+        self._finish_tags_key = prefix + 'finish-tags'
+        #: A set of ids of the projects that have started jobs
+        self._started_projects_key = prefix + 'started-projects'
+
+    def _get_queue_key(self, project_id):
+        return '{}queue:{}'.format(self.prefix, project_id)
+
+    def _get_stats_key(self, project_id):
+        return '{}stats:{}'.format(self.prefix, project_id)
+
+    def enqueue(self, project_id, **data):
+        """Puts a job described by `data` to the queue of `project_id`
+        project. Returns the job id.
+        """
+        job_id = uuid.uuid4().hex
+        entry = json.dumps(dict(data, id=job_id, enqueued_at=time.time()))
+        pipeline = self.redis_client.pipeline()
+        pipeline.rpush(self._get_queue_key(project_id), entry)
+        pipeline.sadd(self._projects_key, project_id)
+        pipeline.execute()
+        return job_id
+
+    def _discard_project_if_idle(self, project_id):
+        queue_key = self._get_queue_key(project_id)
+
+        def func(pipeline):
+            # The transaction fails if a job is enqueued meanwhile
+            if not pipeline.llen(queue_key):
+                pipeline.multi()
+                pipeline.srem(self._projects_key, project_id)
+        self.redis_client.transaction(func, queue_key)
+
+    def has_queued_jobs(self):
+        return bool(self.redis_client.scard(self._projects_key))
+
+    def _get_running_jobs_counts(self):
+        self.redis_client.zremrangebyscore(self._running_key, '-inf', time.time())
+        counts = {}
+        for lease in self.redis_client.zrange(self._running_key, 0, -1):
+            project_id = int(lease.split(':', 1)[0])
+            counts[project_id] = counts.get(project_id, 0) + 1
+        return counts
+
+    def pop(self, get_project_limits):
+        """Takes the next job to run. Returns a pair (job data, whether
+        there are queued jobs that can not be run due to the project caps).
+        Job data is ``None`` if there is nothing to run. The job is counted
+        as running until :meth:`finish` is called or its lease expires,
+        see :meth:`hold_lease`.
+
+        :param get_project_limits: a function that takes a list of project
+                                   ids and returns a dictionary that maps
+                                   them to pairs (concurrency cap or ``None``,
+                                   weight)
+        """
+        with self.redis_client.lock(self.prefix + 'lock', timeout=10):
+            project_ids = [int(project_id) for project_id in
+                           self.redis_client.smembers(self._projects_key)]
+            if not project_ids:
+                return None, False
+
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for project_id in project_ids:
+                pipeline.lindex(self._get_queue_key(project_id), 0)
+            heads = pipeline.execute()
+            vtime = float(self.redis_client.get(self._vtime_key) or 0)
+            finish_tags = self.redis_client.hgetall(self._finish_tags_key)
+            running = self._get_running_jobs_counts()
+            limits = get_project_limits(project_ids)
+
+            is_blocked = False
+            best = None
+            for project_id, head in zip(project_ids, heads):
+                if head is None:
+                    self._discard_project_if_idle(project_id)
+                    continue
+                cap, weight = limits.get(project_id, (None, 1))
+                if cap and running.get(project_id, 0) >= cap:
+                    is_blocked = True
+                    continue
+                start_tag = max(vtime, float(finish_tags.get(str(project_id), 0)))
+                entry = json.loads(head)
+                key = (start_tag, entry['enqueued_at'])
+                if best is None or key < best[0]:
+                    best = (key, project_id, weight, entry)
+            if best is None:
+                return None, is_blocked
+
+            (start_tag, _), project_id, weight, entry = best
+            started_at = time.time()
+            wait_time = started_at - entry['enqueued_at']
+            pipeline = self.redis_client.pipeline()
+            pipeline.lpop(self._get_queue_key(project_id))
+            pipeline.set(self._vtime_key, repr(start_tag))
+            pipeline.hset(self._finish_tags_key, project_id,
+                          repr(start_tag + 1.0 / max(weight, 1)))
+            pipeline.zadd(self._running_key, started_at + self.lease_ttl,
+                          '{}:{}'.format(project_id, entry['id']))
+            stats_key = self._get_stats_key(project_id)
+            pipeline.sadd(self._started_projects_key, project_id)
+            pipeline.hincrby(stats_key, 'started', 1)
+            pipeline.hincrbyfloat(stats_key, 'total_wait_time', wait_time)
+            pipeline.hset(stats_key, 'last_wait_time', repr(wait_time))
+            pipeline.execute()
+            entry['project_id'] = project_id
+            entry['wait_time'] = wait_time
+            return entry, is_blocked
+
+    def finish(self, job):
+        """Stops counting `job` (returned by :meth:`pop`) as running."""
+        self.redis_client.zrem(self._running_key,
+                               '{}:{}'.format(job['project_id'], job['id']))
+
+    @contextlib.contextmanager
+    def hold_lease(self, job):
+        """Renews the lease of `job` (returned by :meth:`pop`) in a background
+        thread while the block runs and calls :meth:`finish` after it.
+        """
+        lease = '{}:{}'.format(job['project_id'], job['id'])
+        stop_renewing = threading.Event()
+
+        def renew():
+            while not stop_renewing.wait(self.lease_ttl / 3.0):
+                try:
+                    self.redis_client.zadd(self._running_key,
+                                           time.time() + self.lease_ttl, lease)
+                except redis.RedisError:
+                    # Try again later, the lease has not expired yet
+                    pass
+
+        renewer = threading.Thread(target=renew)
+        renewer.daemon = True
+        renewer.start()
+        try:
+            yield
+        finally:
+            stop_renewing.set()
+            renewer.join()
+            self.finish(job)
+
+    def get_stats(self):
+        """Returns a dictionary that maps ids of the projects that have
+        queued or running jobs or have ever started one to dictionaries with
+        the following keys: ``queued`` (the queue depth), ``running``,
+        ``oldest_wait_time`` (for how long the first queued job has been
+        waiting, in seconds, ``None`` if nothing is queued), ``started``
+        (the number of started jobs), ``average_wait_time`` and
+        ``last_wait_time`` (of the started jobs, in seconds).
+        """
+        running = self._get_running_jobs_counts()
+        project_ids = set(running)
+        project_ids.update(int(project_id) for project_id in
+                           self.redis_client.smembers(self._projects_key))
+        project_ids.update(int(project_id) for project_id in
+                           self.redis_client.smembers(self._started_projects_key))
+        project_ids = sorted(project_ids)
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for project_id in project_ids:
+            pipeline.llen(self._get_queue_key(project_id))
+            pipeline.lindex(self._get_queue_key(project_id), 0)
+            pipeline.hgetall(self._get_stats_key(project_id))
+        results = pipeline.execute()
+
+        stats = {}
+        now = time.time()
+        for i, project_id in enumerate(project_ids):
+            queued, head, project_stats = results[i * 3:i * 3 + 3]
+            started = int(project_stats.get('started', 0))
+            stats[project_id] = {
+                'queued': queued,
+                'running': running.get(project_id, 0),
+                'oldest_wait_time': (now - json.loads(head)['enqueued_at']
+                                     if head else None),
+                'started': started,
+                'average_wait_time': (
+                    float(project_stats['total_wait_time']) / started
+                    if started else None),
+                'last_wait_time': (float(project_stats['last_wait_time'])
+                                   if started else None),
+            }
+        return stats
@@ -0,0 +1,118 @@
+# coding: utf-8
+"""
+kozmic.builds.ssh
+~~~~~~~~~~~~~~~~~
+
+SSH host keys for job containers.
+
+Job containers need GitHub host keys to clone private repositories over
+SSH. Instead of running ``ssh-keyscan`` in every container, the keys are
+either pinned in :setting:`KOZMIC_SSH_KNOWN_HOSTS` or scanned once per
+worker process and cached for :setting:`KOZMIC_SSH_KNOWN_HOSTS_TTL`
+seconds by all the tasks the process runs. They are written to the job
+working directory, from which the container adds them to its known hosts.
+
+.. autoclass:: KnownHostsCache
+   :members:
+
+.. autofunction:: get_known_hosts
+"""
+import os
+import time
+import threading
+import subprocess
+
+import flask
+from celery.utils.log import get_task_logger
+
+
+logger = get_task_logger(__name__)
+
+#: How soon to retry a failed scan, in seconds
+FAILED_SCAN_RETRY_INTERVAL = 60
+
+
+class KnownHostsCache(object):
+    """Scans SSH host keys of `hosts` and caches them for `ttl` seconds.
+
+    If a scan fails, the previously scanned keys are used until the next
+    scan succeeds.
+
+    :param hosts: host names
+    :type hosts: list of strings
+
+    :param ttl: how long to cache keys for, in seconds
+    :type ttl: int
+
+    :param timeout: ``ssh-keyscan`` timeout, in seconds
+    :type timeout: int
+    """
+    def __init__(self, hosts=('github.com',), ttl=24 * 3600, timeout=10):
+        self.hosts = list(hosts)
+        self.ttl = ttl
+        self.timeout = timeout
+        self._known_hosts = ''
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        #: The process the cache has been created in
+        self.pid = os.getpid()
+
+    def _scan(self):
+        process = subprocess.Popen(
+            ['ssh-keyscan', '-H', '-T', str(self.timeout)] + self.hosts,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        known_hosts, _ = process.communicate()
+        return known_hosts
+
+    def get(self):
+        """Returns the keys in ``known_hosts`` file format or an empty
+        string if they have never been scanned successfully.
+        """
+        with self._lock:
+            if time.time() >= self._expires_at:
+                try:
+                    known_hosts = self._scan()
+                except OSError as e:
+                    known_hosts = ''
+                    logger.warning('Failed to run ssh-keyscan: %s', e)
+                if known_hosts:
+                    self._known_hosts = known_hosts
+                    self._expires_at = time.time() + self.ttl
+                else:
+                    # Do not make every job wait for the timeout
+                    self._expires_at = time.time() + min(
+                        self.ttl, FAILED_SCAN_RETRY_INTERVAL)
+                    logger.warning('Failed to scan SSH keys of %s.',
+                                   ', '.join(self.hosts))
+            return self._known_hosts
+
+
+#: :class:`KnownHostsCache` of the current process
+_known_hosts_cache = None
+_known_hosts_cache_lock = threading.Lock()
+
+
+def get_known_hosts():
+    """Returns GitHub SSH host keys in ``known_hosts`` file format.
+    See :class:`KnownHostsCache`.
+
+    Scanned keys are cached per process rather than per application,
+    so that they outlive tasks. A cache is never shared between
+    processes, so that forked worker processes do not inherit its lock.
+    """
+    global _known_hosts_cache
+    app = flask.current_app
+    known_hosts = app.config['KOZMIC_SSH_KNOWN_HOSTS']
+    if known_hosts:
+        return known_hosts.strip() + '\n'
+
+    pid = os.getpid()
+    cache = _known_hosts_cache
+    if cache is None or cache.pid != pid:
+        with _known_hosts_cache_lock:
+            cache = _known_hosts_cache
+            if cache is None or cache.pid != pid:
+                cache = KnownHostsCache(
+                    ttl=app.config['KOZMIC_SSH_KNOWN_HOSTS_TTL'])
+                _known_hosts_cache = cache
+    return cache.get()
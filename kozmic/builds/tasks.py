@@ -3,21 +3,23 @@
 kozmic.builds.tasks
 ~~~~~~~~~~~~~~~~~~~
 
+.. autofunction:: enqueue_job
+.. autofunction:: run_next_job()
 .. autofunction:: do_job(hook_call_id)
 .. autofunction:: restart_job(id)
 """
 import os
 import sys
+import time
 import tempfile
 import shutil
 import contextlib
 import threading
 import pipes
-import subprocess
-import fcntl
-import select
 import Queue
 import socket
+import itertools
+import collections
 
 import redis
 from flask import current_app
@@ -25,9 +27,18 @@ from celery.utils.log import get_task_logger
 from docker import APIError as DockerAPIError
 
 from kozmic import db, celery, docker
-from kozmic.models import Job, HookCall
-from kozmic.docker_utils import does_docker_image_exist
-from . import get_ansi_to_html_converter
+from kozmic.models import Project, Job, HookCall
+from kozmic.redis_utils import get_redis_client, report_pool_stats
+from kozmic.docker_utils import (does_docker_image_exist, pull_image,
+                                 commit_image, get_image_index,
+                                 PULL_IF_OLDER_THAN)
+from .follower import LogFollower
+from .logs import JobLogWriter
+from .mirrors import update_git_mirror, GitMirrorError
+from .ssh import get_known_hosts
+from .locks import CacheBuildLock, single_flight
+from .scheduler import Scheduler
+from . import messages
 
 
 logger = get_task_logger(__name__)
@@ -41,45 +52,214 @@ def create_temp_dir():
 
 
 class Publisher(object):
-    """
+    """Sends job log lines to a Redis pub/sub channel and pushes them
+    to the Redis list of the same name.
+
+    Lines are sent as is, without translating ANSI sequences: raw log
+    is the single source of truth and it is rendered to HTML by its readers
+    (see :mod:`tailer` and :mod:`kozmic.builds.rendering`). Pub/sub messages
+    are prefixed by the sequence number of their first line
+    (see :mod:`kozmic.builds.messages`).
+
+    If `log_writer` is specified, lines are also written to the persistent
+    job log.
+
+    Lines are buffered and written using a single pipelined ``PUBLISH`` and
+    ``RPUSH`` pair. The buffer is flushed once it contains `max_lines` lines
+    or `max_bytes` bytes, or `max_latency` seconds after the first line
+    has been buffered, whichever happens first. The latter is done by
+    a daemon thread that lives until :meth:`finish` is called.
+
+    The Redis list keeps at most `list_max_lines` lines and `list_max_bytes`
+    bytes: older lines are trimmed by ``LTRIM`` (but they are still written
+    to the persistent job log). The list and its metadata expire if they
+    have not been written for `list_ttl` seconds, so the lists of crashed
+    jobs do not live forever.
+
     :param redis_client: Redis client
     :type log_path: redis.Redis
 
     :param channel: pub/sub channel name
     :type channel: str
+
+    :param max_lines: the maximum number of buffered lines
+    :type max_lines: int
+
+    :param max_bytes: the maximum size of buffered lines in bytes
+    :type max_bytes: int
+
+    :param max_latency: the maximum number of seconds a line can stay in the
+                        buffer. If it is zero, every :meth:`publish` call
+                        flushes the buffer immediately.
+    :type max_latency: float
+
+    :param log_writer: job log writer
+    :type log_writer: :class:`~kozmic.builds.logs.JobLogWriter`
+
+    :param list_max_lines: the maximum number of lines in the Redis list
+    :type list_max_lines: int
+
+    :param list_max_bytes: the maximum size of the Redis list in bytes
+    :type list_max_bytes: int
+
+    :param list_ttl: the Redis list TTL in seconds
+    :type list_ttl: int
     """
-    def __init__(self, redis_client, channel):
+    def __init__(self, redis_client, channel, max_lines=1000,
+                 max_bytes=64 * 1024, max_latency=0.05, log_writer=None,
+                 list_max_lines=100000, list_max_bytes=16 * 1024 * 1024,
+                 list_ttl=3600):
         self._redis_client = redis_client
         self._channel = channel
-        self._ansi_converter = get_ansi_to_html_converter()
+        self._meta_key = messages.get_meta_key(channel)
+        self._log_writer = log_writer
+        self._list_max_lines = list_max_lines
+        self._list_max_bytes = list_max_bytes
+        self._list_ttl = list_ttl
+        # Sizes of the lines that are in the Redis list
+        self._list_line_sizes = collections.deque()
+        self._list_size = 0
+        self._max_lines = max_lines
+        self._max_bytes = max_bytes
+        self._max_latency = max_latency
+        self._lock = threading.Lock()
+        # Notifies the flush thread that lines have been buffered
+        # or the publisher has finished
+        self._buffer_changed = threading.Condition(self._lock)
+        self._buffer = []
+        self._buffer_size = 0
+        # When the first of the buffered lines has been buffered
+        self._buffered_at = None
+        self._flush_thread = None
+        self._is_finished = False
+        self._seq = 0
 
     def publish(self, lines):
+        """Publishes a list of lines (without trailing newlines)
+        or a single string that may consist of several lines.
+        """
         if isinstance(lines, basestring):
-            lines = [lines]
-        for line in lines:
-            try:
-                line = self._ansi_converter.convert(line, full=False) + '\n'
-            except:
-                pass
-            self._redis_client.publish(self._channel, line)
-            self._redis_client.rpush(self._channel, line)
+            lines = lines.split('\n')
+        with self._lock:
+            for line in lines:
+                self._buffer.append(line)
+                self._buffer_size += len(line) + 1
+
+            if (not self._max_latency or
+                    len(self._buffer) >= self._max_lines or
+                    self._buffer_size >= self._max_bytes):
+                self._flush()
+            elif self._buffer and self._buffered_at is None:
+                self._buffered_at = time.time()
+                if not self._flush_thread:
+                    self._flush_thread = threading.Thread(
+                        target=self._run_flush_thread)
+                    self._flush_thread.daemon = True
+                    self._flush_thread.start()
+                self._buffer_changed.notify()
+
+    def _run_flush_thread(self):
+        with self._lock:
+            while not self._is_finished:
+                if self._buffered_at is None:
+                    self._buffer_changed.wait()
+                    continue
+                timeout = self._buffered_at + self._max_latency - time.time()
+                if timeout > 0:
+                    self._buffer_changed.wait(timeout)
+                    continue
+                try:
+                    self._flush()
+                except redis.RedisError:
+                    logger.exception('Failed to publish %s log lines.',
+                                     self._channel)
+                    # Try again in `max_latency` seconds
+                    self._buffered_at = time.time()
+
+    def flush(self):
+        """Writes buffered lines to Redis."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        lines = [line + '\n' for line in self._buffer]
+        data = ''.join(lines)
+        lines_to_trim, list_size = self._count_lines_to_trim(lines)
+        # Readers must never see the list trimmed and its offset not updated
+        pipeline = self._redis_client.pipeline(transaction=bool(lines_to_trim))
+        pipeline.publish(self._channel, messages.encode(self._seq, data))
+        pipeline.rpush(self._channel, *lines)
+        if lines_to_trim:
+            pipeline.ltrim(self._channel, lines_to_trim, -1)
+            pipeline.hincrby(self._meta_key, 'offset', lines_to_trim)
+        pipeline.hset(self._meta_key, 'bytes', list_size)
+        pipeline.expire(self._channel, self._list_ttl)
+        pipeline.expire(self._meta_key, self._list_ttl)
+        pipeline.execute()
+        # The list has been written, so is its size
+        self._list_line_sizes.extend(len(line) for line in lines)
+        for _ in xrange(lines_to_trim):
+            self._list_line_sizes.popleft()
+        self._list_size = list_size
+        self._seq += len(lines)
+        if self._log_writer:
+            self._log_writer.write(data)
+        self._buffer = []
+        self._buffer_size = 0
+        self._buffered_at = None
+
+    def _count_lines_to_trim(self, new_lines):
+        """Returns the number of lines to be trimmed from the Redis list
+        once `new_lines` are pushed to it and the list size after that.
+        """
+        line_sizes = itertools.chain(self._list_line_sizes,
+                                     (len(line) for line in new_lines))
+        line_count = len(self._list_line_sizes) + len(new_lines)
+        list_size = self._list_size + sum(len(line) for line in new_lines)
+        lines_to_trim = 0
+        # Always keep the last line, otherwise Redis removes the list
+        while (line_count > 1 and
+               (line_count > self._list_max_lines or
+                list_size > self._list_max_bytes)):
+            list_size -= next(line_sizes)
+            line_count -= 1
+            lines_to_trim += 1
+        return lines_to_trim, list_size
 
     def finish(self):
-        # Remove `channel` key to let `tailer` module
-        # stop listening pubsub channel
-        self._redis_client.delete(self._channel)
+        """Writes the rest of the log and notifies readers that
+        the log has ended.
+        """
+        with self._lock:
+            self._is_finished = True
+            self._buffer_changed.notify()
+            self._flush()
+        if self._flush_thread:
+            self._flush_thread.join()
+        if self._log_writer:
+            self._log_writer.close()
+        pipeline = self._redis_client.pipeline(transaction=False)
+        pipeline.publish(self._channel, messages.END_OF_STREAM)
+        # Also remove `channel` key: `tailer` checks for it in case
+        # the end of stream message has been lost
+        pipeline.delete(self._channel, self._meta_key)
+        pipeline.execute()
 
 
 class Tailer(threading.Thread):
     """A daemon thread that waits for additional lines to be appended to a
-    specified log file.
-    Once there is a new line, it does the following:
+    specified log file (see :class:`~kozmic.builds.follower.LogFollower`).
+    Once there are new lines, it does the following:
 
-    1. Translates ANSI sequences to HTML tags;
-    2. Sends the line to a Redis pub/sub channel;
-    3. Pushes it to Redis list of the same name.
+    1. Sends the lines to a Redis pub/sub channel;
+    2. Pushes them to Redis list of the same name.
 
-    If the log file does not change for ``kill_timeout`` seconds,
+    When the thread is stopped, it publishes the rest of the log file
+    (including the last line if it doesn't end with a newline).
+
+    If nothing is appended to the log file for ``kill_timeout`` seconds,
     specified Docker container will be killed and corresponding message
     will be appended to the log file.
 
@@ -127,41 +307,37 @@ class Tailer(threading.Thread):
     def run(self):
         logger.info('Tailer has started. Log path: %s', self._log_path)
 
-        tailf = subprocess.Popen(['/usr/bin/tail', '-f', self._log_path],
-                                 stdout=subprocess.PIPE)
+        follower = LogFollower(self._log_path, poll_interval=self._read_timeout)
         try:
-            fl = fcntl.fcntl(tailf.stdout, fcntl.F_GETFL)
-            fcntl.fcntl(tailf.stdout, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
-            buf = ''
-            iterations_without_read = 0
-            while True:
-                if self.is_stopped():
-                    break
-                reads, _, _ = select.select([tailf.stdout], [], [], self._read_timeout)
-                if not reads:
-                    iterations_without_read += 1
-                    if iterations_without_read * self._read_timeout < self._kill_timeout:
+            last_read_at = time.time()
+            last_offset = follower.offset
+            while not self.is_stopped():
+                lines = follower.read_lines()
+                if follower.offset != last_offset:
+                    # Any output counts, including incomplete lines
+                    # (for example, progress bars redrawn by "\r")
+                    last_offset = follower.offset
+                    last_read_at = time.time()
+                if lines:
+                    self._publisher.publish(lines)
+                    if follower.has_unread_data():
                         continue
-                    else:
-                        self._kill_container()
-                        return
-                else:
-                    iterations_without_read = 0
-
-                buf += tailf.stdout.read()
-                lines = buf.split('\n')
-
-                if lines[-1] == '':
-                    buf = ''
-                else:
-                    buf = lines[-1]
-                lines = lines[:-1]
-
+                elif time.time() - last_read_at >= self._kill_timeout:
+                    self._kill_container()
+                    return
+                follower.wait(self._read_timeout)
+
+            # Publish whatever has been appended to the log
+            # between the last read and the stop
+            while follower.has_unread_data():
+                lines = follower.read_lines()
+                if lines:
+                    self._publisher.publish(lines)
+            lines = follower.read_lines(final=True)
+            if lines:
                 self._publisher.publish(lines)
         finally:
-            tailf.terminate()
-            tailf.wait()
+            follower.close()
 
 
 SCRIPT_STARTER_SH = '''
@@ -183,8 +359,14 @@ function cleanup {{  # escape
 }}  # escape
 trap cleanup EXIT
 
-# Add GitHub to known hosts
-ssh-keyscan -H github.com >> /etc/ssh/ssh_known_hosts
+# Add GitHub to known hosts. The keys are provided by the worker
+# (see `kozmic.builds.ssh`) and scanned here only if it has none
+if [ -s /kozmic/known_hosts ]; then
+  cat /kozmic/known_hosts >> /etc/ssh/ssh_known_hosts
+else
+  ssh-keyscan -H github.com >> /etc/ssh/ssh_known_hosts
+fi
+rm -f /kozmic/known_hosts
 
 if [ -f /kozmic/id_rsa ] && [ -f /kozmic/askpass.sh ]; then
   # Start ssh-agent service...
@@ -196,14 +378,83 @@ if [ -f /kozmic/id_rsa ] && [ -f /kozmic/askpass.sh ]; then
   rm /kozmic/askpass.sh /kozmic/id_rsa
 fi
 
-git clone {clone_url} /kozmic/src
-cd /kozmic/src && git checkout -q {commit_sha}
+{checkout}
 
 chown -R kozmic /kozmic
 # Redirect stdout to the file being translated to the redis pubsub channel
 TERM=xterm su kozmic -c "/kozmic/script.sh" &>> /kozmic/script.log
 '''.strip()
 
+
+def get_checkout_sh(clone_url, commit_sha, mirror=False, ref=None,
+                    shallow=False, single_branch=False, sparse_paths=None):
+    """Returns shell commands that check out `commit_sha` commit of
+    `clone_url` repository to `/kozmic/src`.
+
+    If `/kozmic/src` already contains a repository (the source checked out
+    by the install script, see :func:`do_job`), it is cleaned and reused
+    and nothing is cloned.
+
+    :param mirror: whether to clone from the read-only repository mirror
+                   mounted in `/kozmic-mirror` (see :mod:`kozmic.builds.mirrors`).
+                   The mirror already has all the objects, so `shallow` and
+                   `single_branch` are ignored
+    :param ref: the branch `commit_sha` belongs to
+    :param shallow: whether to fetch only `commit_sha`, without its history
+    :param single_branch: whether to clone only `ref` branch
+    :param sparse_paths: a list of paths to be checked out. If empty,
+                         the whole tree is checked out
+    """
+    clone_url = pipes.quote(clone_url)
+    commit_sha = pipes.quote(commit_sha)
+    ref = ref and pipes.quote(ref)
+
+    if mirror:
+        lines = ['git clone -q -n --shared /kozmic-mirror /kozmic/src',
+                 'cd /kozmic/src',
+                 'git remote set-url origin {}'.format(clone_url)]
+    elif shallow:
+        lines = ['git init -q /kozmic/src',
+                 'cd /kozmic/src',
+                 'git remote add origin {}'.format(clone_url)]
+    elif single_branch and ref:
+        # Fall back to a full clone if the branch does not exist in
+        # the repository (e.g., a pull request from a fork)
+        lines = ['git clone -q -n --single-branch --branch {ref} {url} '
+                 '/kozmic/src || git clone -q -n {url} /kozmic/src'.format(
+                     ref=ref, url=clone_url),
+                 'cd /kozmic/src']
+    else:
+        lines = ['git clone -q -n {} /kozmic/src'.format(clone_url),
+                 'cd /kozmic/src']
+
+    if sparse_paths:
+        lines.append('git config core.sparseCheckout true')
+        lines.extend('echo {} >> .git/info/sparse-checkout'.format(
+            pipes.quote(path)) for path in sparse_paths)
+
+    if shallow and not mirror:
+        # Not every server allows fetching a commit by its SHA. If it is
+        # refused, fetch the branch tip, and failing that the whole history
+        fetch_ref = ' || git fetch -q --depth 1 origin {}'.format(ref) if ref else ''
+        lines.append('git fetch -q --depth 1 origin {sha}{fetch_ref}'.format(
+            sha=commit_sha, fetch_ref=fetch_ref))
+
+    lines = (
+        ['if [ -d /kozmic/src/.git ]; then',
+         # The repository is owned by kozmic user since the previous run
+         '  git config --global --add safe.directory /kozmic/src || true',
+         '  cd /kozmic/src && git clean -q -ffdx',
+         'else'] +
+        ['  ' + line for line in lines] +
+        ['fi',
+         # The commit may be not reachable from the fetched refs
+         'git cat-file -e {}^{{commit}} || git fetch -q origin '
+         '"+refs/heads/*:refs/remotes/origin/*"'.format(commit_sha),
+         'git checkout -q -f {}'.format(commit_sha)])
+    return '\n'.join(lines)
+
+
 ASKPASS_SH = '''
 #!/bin/bash
 if [[ "$1" == *"Bad passphrase, try again"* ]]; then
@@ -259,9 +510,31 @@ class Builder(threading.Thread):
 
     :param commit_sha: SHA of the commit to be checked out
     :type commit_sha: str
+
+    :param mirror_path: path of the repository mirror to be mounted
+                        read-only in container's `/kozmic-mirror` path
+                        (see :mod:`kozmic.builds.mirrors`)
+    :type mirror_path: str
+
+    :param checkout_options: keyword arguments for :func:`get_checkout_sh`
+                             (see :meth:`kozmic.models.Hook.get_checkout_options`)
+    :type checkout_options: dict
+
+    :param source_dir: path of the directory to be mounted in container's
+                       `/kozmic/src` path. If it contains a repository
+                       checked out by the previous run, the repository
+                       is reused instead of being cloned
+    :type source_dir: str
+
+    :param known_hosts: SSH host keys in ``known_hosts`` file format to be
+                        added to the container's known hosts
+                        (see :mod:`kozmic.builds.ssh`)
+    :type known_hosts: str
     """
     def __init__(self, docker, message_queue, docker_image, script,
-                 working_dir, clone_url, commit_sha, deploy_key=None):
+                 working_dir, clone_url, commit_sha, deploy_key=None,
+                 mirror_path=None, checkout_options=None, source_dir=None,
+                 known_hosts=None):
         threading.Thread.__init__(self)
 
         self._docker = docker
@@ -271,6 +544,10 @@ class Builder(threading.Thread):
         self._working_dir = working_dir
         self._clone_url = clone_url
         self._commit_sha = commit_sha
+        self._mirror_path = mirror_path
+        self._checkout_options = checkout_options or {}
+        self._source_dir = source_dir
+        self._known_hosts = known_hosts
 
         self._rsa_private_key = None
         self._passphrase = None
@@ -294,11 +571,16 @@ class Builder(threading.Thread):
 
         script_starter_sh_path = working_dir_path('script-starter.sh')
         script_starter_sh_content = SCRIPT_STARTER_SH.format(
-            clone_url=pipes.quote(self._clone_url),
-            commit_sha=pipes.quote(self._commit_sha))
+            checkout=get_checkout_sh(
+                self._clone_url, self._commit_sha,
+                mirror=bool(self._mirror_path), **self._checkout_options))
         with open(script_starter_sh_path, 'w') as script_starter_sh:
             script_starter_sh.write(script_starter_sh_content)
 
+        if self._known_hosts:
+            with open(working_dir_path('known_hosts'), 'w') as known_hosts:
+                known_hosts.write(self._known_hosts)
+
         script_path = working_dir_path('script.sh')
         with open(script_path, 'w') as script:
             script.write(self._build_script)
@@ -322,16 +604,25 @@ class Builder(threading.Thread):
                 id_rsa.write(self._rsa_private_key)
             os.chmod(id_rsa_path, 0o400)
 
+        volumes = {'/kozmic': {}}
+        binds = {self._working_dir: '/kozmic'}
+        if self._mirror_path:
+            volumes['/kozmic-mirror'] = {}
+            binds[self._mirror_path] = '/kozmic-mirror:ro'
+        if self._source_dir:
+            volumes['/kozmic/src'] = {}
+            binds[self._source_dir] = '/kozmic/src'
+
         logger.info('Starting Docker process...')
         self.container = self._docker.create_container(
             self._docker_image,
             command='bash /kozmic/script-starter.sh',
-            volumes={'/kozmic': {}})
+            volumes=volumes)
 
         self._message_queue.put(self.container, block=True, timeout=60)
         self._message_queue.join()
 
-        self._docker.start(self.container, binds={self._working_dir: '/kozmic'})
+        self._docker.start(self.container, binds=binds)
         logger.info('Docker process %s has started.', self.container)
 
         return_code = self._docker.wait(self.container)
@@ -350,15 +641,20 @@ class Builder(threading.Thread):
 
 @contextlib.contextmanager
 def _run(publisher, stall_timeout, clone_url, commit_sha,
-         docker_image, script, deploy_key=None, remove_container=True):
+         docker_image, script, deploy_key=None, mirror_path=None,
+         checkout_options=None, source_dir=None, known_hosts=None,
+         remove_container=True):
     yielded = False
-    stdout = ''
     try:
         with create_temp_dir() as working_dir:
             message_queue = Queue.Queue()
             builder = Builder(
                 docker=docker._get_current_object(),  # `docker` is a local proxy
                 deploy_key=deploy_key,
+                mirror_path=mirror_path,
+                checkout_options=checkout_options,
+                source_dir=source_dir,
+                known_hosts=known_hosts,
                 clone_url=clone_url,
                 commit_sha=commit_sha,
                 docker_image=docker_image,
@@ -367,7 +663,6 @@ def _run(publisher, stall_timeout, clone_url, commit_sha,
                 message_queue=message_queue)
 
             log_path = os.path.join(working_dir, 'script.log')
-            stop_reason = ''
             try:
                 # Start Builder and wait until it will create the container
                 builder.start()
@@ -386,16 +681,14 @@ def _run(publisher, stall_timeout, clone_url, commit_sha,
                     builder.join()
                 finally:
                     tailer.stop()
+                    tailer.join()
                     if tailer.has_killed_container:
-                        stop_reason = '\nSorry, your script has stalled and been killed.\n'
+                        publisher.publish(
+                            'Sorry, your script has stalled and been killed.')
             finally:
                 if builder.container and remove_container:
                     docker.remove_container(builder.container)
 
-                if os.path.exists(log_path):
-                    with open(log_path, 'r') as log:
-                        stdout = log.read()
-
                 assert ((builder.return_code is not None) ^
                         (builder.exc_info is not None))
                 if builder.exc_info:
@@ -404,9 +697,7 @@ def _run(publisher, stall_timeout, clone_url, commit_sha,
                     raise builder.exc_info[1], None, builder.exc_info[2]
                 else:
                     try:
-                        yield (builder.return_code,
-                               stdout + stop_reason,
-                               builder.container)
+                        yield builder.return_code, builder.container
                     except:
                         raise
                     finally:
@@ -414,13 +705,85 @@ def _run(publisher, stall_timeout, clone_url, commit_sha,
                                         # stop after throw()" error if nested
                                         # code raised exception
     except:
-        stdout += ('\nSorry, something went wrong. We are notified of '
-                   'the issue and will fix it soon.')
+        publisher.publish('Sorry, something went wrong. We are notified of '
+                          'the issue and will fix it soon.')
         if not yielded:
-            yield 1, stdout, None
+            yield 1, None
         raise
 
 
+def get_scheduler():
+    """Returns the :class:`~kozmic.builds.scheduler.Scheduler`
+    of the current application.
+    """
+    scheduler = current_app.extensions.get('kozmic_scheduler')
+    if scheduler is None:
+        scheduler = Scheduler(
+            get_redis_client(),
+            lease_ttl=current_app.config['KOZMIC_SCHEDULER_LEASE_TTL'])
+        current_app.extensions['kozmic_scheduler'] = scheduler
+    return scheduler
+
+
+def get_project_limits(project_ids):
+    """Returns a dictionary that maps `project_ids` to pairs
+    (concurrency cap or ``None``, scheduling weight).
+    """
+    default_cap = current_app.config['KOZMIC_SCHEDULER_MAX_JOBS_PER_PROJECT']
+    rows = db.session.query(
+        Project.id, Project.max_concurrent_jobs, Project.scheduling_weight,
+    ).filter(Project.id.in_(project_ids))
+    return dict((id, (cap or default_cap, weight))
+                for id, cap, weight in rows)
+
+
+def enqueue_job(hook_call_id):
+    """Puts a job specified by a hook call to the queue of its project
+    and sends :func:`run_next_job` task to do it once a worker slot is free.
+
+    :param hook_call_id: int, :class:`HookCall` identifier
+    """
+    hook_call = HookCall.query.get(hook_call_id)
+    assert hook_call, 'HookCall#{} does not exist.'.format(hook_call_id)
+    get_scheduler().enqueue(hook_call.build.project_id,
+                            hook_call_id=hook_call_id)
+    run_next_job.delay()
+
+
+@celery.task
+def run_next_job():
+    """A Celery task that takes the next job from the scheduler
+    (see :mod:`kozmic.builds.scheduler`) and does it by :func:`do_job`.
+
+    If all the queued jobs belong to projects that have reached their
+    concurrency caps, tries again in
+    :setting:`KOZMIC_SCHEDULER_RETRY_INTERVAL` seconds. Normally the caps
+    are freed earlier: every finished job sends this task again while
+    there are queued jobs.
+    """
+    scheduler = get_scheduler()
+    entry, is_blocked = scheduler.pop(get_project_limits)
+    # Do not keep the transaction of the limits query open
+    # while the job is running
+    db.session.commit()
+    if entry is None:
+        if is_blocked:
+            run_next_job.apply_async(
+                countdown=current_app.config['KOZMIC_SCHEDULER_RETRY_INTERVAL'])
+        return
+
+    logger.info('Starting a job of hook call #%d of project #%d, '
+                'it has been waiting for %.1f seconds.',
+                entry['hook_call_id'], entry['project_id'], entry['wait_time'])
+    try:
+        with scheduler.hold_lease(entry):
+            # Run do_job task synchronously:
+            do_job.apply(kwargs={'hook_call_id': entry['hook_call_id']})
+    finally:
+        if scheduler.has_queued_jobs():
+            run_next_job.delay()
+
+
 class RestartError(Exception):
     pass
 
@@ -436,9 +799,10 @@ def restart_job(id):
     if not job.is_finished():
         raise RestartError('Tried to restart %r which is not finished.', job)
 
+    hook_call_id = job.hook_call_id
     db.session.delete(job)
-    # Run do_job task synchronously:
-    do_job.apply(args=(job.hook_call_id,))
+    db.session.commit()
+    enqueue_job(hook_call_id)
 
 
 @celery.task
@@ -466,38 +830,69 @@ def do_job(hook_call_id):
     project = hook.project
     config = current_app.config
 
-    redis_client = redis.StrictRedis(host=config['KOZMIC_REDIS_HOST'],
-                                     port=config['KOZMIC_REDIS_PORT'],
-                                     db=config['KOZMIC_REDIS_DATABASE'])
-    publisher = Publisher(redis_client=redis_client, channel=job.task_uuid)
-
-    stdout = ''
+    redis_client = get_redis_client()
+    log_writer = JobLogWriter(
+        engine=db.get_engine(current_app),
+        job_id=job.id,
+        chunk_size=config['KOZMIC_LOG_CHUNK_SIZE'])
+    publisher = Publisher(
+        redis_client=redis_client,
+        channel=job.task_uuid,
+        max_lines=config['KOZMIC_LOG_FLUSH_MAX_LINES'],
+        max_bytes=config['KOZMIC_LOG_FLUSH_MAX_BYTES'],
+        max_latency=config['KOZMIC_LOG_FLUSH_MAX_LATENCY'],
+        log_writer=log_writer,
+        list_max_lines=config['KOZMIC_LOG_BUFFER_MAX_LINES'],
+        list_max_bytes=config['KOZMIC_LOG_BUFFER_MAX_BYTES'],
+        list_ttl=config['KOZMIC_LOG_BUFFER_TTL'])
+
+    def finish_job(return_code):
+        # Write the rest of the log before the job is marked as finished.
+        # The end of the log stream is published in the `finally` clause
+        # below, after the job status has been committed
+        publisher.flush()
+        log_writer.close()
+        job.finished(return_code)
+        db.session.commit()
+
+    source_dir = None
     try:
         kwargs = dict(
             publisher=publisher,
             stall_timeout=config['KOZMIC_STALL_TIMEOUT'],
             clone_url=(project.gh_https_clone_url if project.is_public else
                        project.gh_ssh_clone_url),
-            commit_sha=hook_call.build.gh_commit_sha)
-
-        message = 'Pulling "{}" Docker image...'.format(hook.docker_image)
+            commit_sha=hook_call.build.gh_commit_sha,
+            checkout_options=hook.get_checkout_options(
+                hook_call.build.gh_commit_ref),
+            known_hosts=get_known_hosts())
+
+        pull_policy = config['KOZMIC_DOCKER_PULL_POLICY']
+        pull_max_age = config['KOZMIC_DOCKER_PULL_MAX_AGE']
+        if pull_policy == PULL_IF_OLDER_THAN:
+            pull_policy_description = '{} {} seconds'.format(
+                pull_policy, pull_max_age)
+        else:
+            pull_policy_description = pull_policy
+        message = 'Pulling "{}" Docker image (pull policy: {})...'.format(
+            hook.docker_image, pull_policy_description)
         logger.info(message)
         publisher.publish(message)
-        stdout = message + '\n'
 
         try:
-            docker.pull(hook.docker_image)
-            # Make sure that image has been successfully pulled by calling
-            # `inspect_image` on it:
-            docker.inspect_image(hook.docker_image)
+            pulled = pull_image(hook.docker_image, policy=pull_policy,
+                                max_age=pull_max_age)
         except DockerAPIError as e:
             logger.info('Failed to pull %s: %s.', hook.docker_image, e)
-            job.finished(1)
-            job.stdout = str(e)
-            db.session.commit()
+            publisher.publish(str(e))
+            finish_job(1)
             return
         else:
-            logger.info('%s image has been pulled.', hook.docker_image)
+            if pulled:
+                logger.info('%s image has been pulled.', hook.docker_image)
+            else:
+                logger.info('Using the local %s image.', hook.docker_image)
+                publisher.publish('Using the local image.')
 
         if not project.is_public:
             project.deploy_key.ensure()
@@ -507,45 +902,113 @@ def do_job(hook_call_id):
                 project.deploy_key.rsa_private_key,
                 project.passphrase)
 
-        if job.hook_call.hook.install_script:
-            cached_image = 'kozmic-cache/{}'.format(job.get_cache_id())
-            cached_image_tag = str(project.id)
-            if does_docker_image_exist(cached_image, cached_image_tag):
-                install_stdout = ('Skipping install script as tracked files '
+        mirrors_dir = config['KOZMIC_GIT_MIRRORS_DIR']
+        if mirrors_dir:
+            publisher.publish('Updating the repository mirror...')
+            try:
+                kwargs['mirror_path'] = update_git_mirror(
+                    mirrors_dir, str(project.id), kwargs['clone_url'],
+                    deploy_key=kwargs.get('deploy_key'),
+                    known_hosts=kwargs['known_hosts'])
+            except GitMirrorError as e:
+                # Not a big deal, the repository will be cloned from GitHub
+                logger.warning('Failed to update the mirror of %r: %s',
+                               project, e)
+
+        install_stages = hook.get_install_stages()
+        if install_stages:
+            cache_key = job.get_cache_key(
+                mirror_path=kwargs.get('mirror_path'))
+            stage_images = cache_key.get_stage_docker_images()
+            assert len(stage_images) == len(install_stages)
+
+            # Find the last stage that has its image cached: each stage
+            # image is built on top of the previous one, so the stages
+            # up to it can be skipped
+            first_stage = 0
+            for i in reversed(range(len(stage_images))):
+                if does_docker_image_exist(*stage_images[i].rsplit(':', 1)):
+                    first_stage = i + 1
+                    break
+
+            if first_stage == len(install_stages):
+                publisher.publish('Skipping install script as tracked files '
                                   'did not change...')
-                publisher.publish(install_stdout)
-                stdout += install_stdout + '\n'
-            else:
-                with _run(docker_image=hook.docker_image,
-                          script=hook.install_script,
-                          remove_container=False,
-                          **kwargs) as (return_code, install_stdout, container):
-                    stdout += install_stdout
-                    if return_code == 0:
-                        # Install script has finished successfully. So we
-                        # promote the resulting container to an image that
-                        # we will use for running the build script in
-                        # this and consequent jobs
-                        docker.commit(container['Id'], repository=cached_image,
-                                      tag=cached_image_tag)
-                        docker.remove_container(container)
-                    else:
-                        job.finished(return_code)
-                        job.stdout = stdout
-                        db.session.commit()
-                        return
-                assert docker.images(cached_image)
-            docker_image = cached_image + ':' + cached_image_tag
+            elif first_stage:
+                publisher.publish(
+                    'Skipping install stages 1-{} of {} as their tracked '
+                    'files did not change...'.format(
+                        first_stage, len(install_stages)))
+
+            if first_stage < len(install_stages):
+                # Keep the source checked out by the install script run,
+                # so that the following runs do not clone it again
+                source_dir = kwargs['source_dir'] = tempfile.mkdtemp()
+            base_image = (stage_images[first_stage - 1] if first_stage
+                          else hook.docker_image)
+            for i in range(first_stage, len(install_stages)):
+                script, _ = install_stages[i]
+                cached_image, cached_image_tag = stage_images[i].rsplit(':', 1)
+
+                def is_stage_image_built():
+                    # Do not trust the image index, the image may have been
+                    # committed by another worker process
+                    get_image_index().discard(stage_images[i])
+                    return does_docker_image_exist(cached_image, cached_image_tag)
+
+                def publish_waiting(holder):
+                    publisher.publish(
+                        'Waiting for dependency cache built by job #{}...'.format(
+                            holder))
+
+                # Concurrent jobs that miss the same cache wait for
+                # the one that builds it instead of building it too
+                lock = CacheBuildLock(
+                    redis_client, stage_images[i], job.id,
+                    ttl=config['KOZMIC_CACHE_BUILD_LOCK_TTL'])
+                with single_flight(lock, is_stage_image_built,
+                                   on_wait=publish_waiting) as is_built:
+                    if is_built:
+                        publisher.publish(
+                            'Using dependency cache built by another job.')
+                        base_image = stage_images[i]
+                        continue
+
+                    if len(install_stages) > 1:
+                        publisher.publish('Running install stage {} of {}...'.format(
+                            i + 1, len(install_stages)))
+                    with _run(docker_image=base_image,
+                              script=script,
+                              remove_container=False,
+                              **kwargs) as (return_code, container):
+                        if return_code == 0:
+                            # Install stage has finished successfully. So we
+                            # promote the resulting container to an image
+                            # that we will use for running the next stages
+                            # and the build script in this and consequent jobs
+                            commit_image(container['Id'], repository=cached_image,
+                                         tag=cached_image_tag)
+                            docker.remove_container(container)
+                        else:
+                            finish_job(return_code)
+                            return
+                    assert does_docker_image_exist(cached_image, cached_image_tag)
+                base_image = stage_images[i]
+            docker_image = stage_images[-1]
         else:
             docker_image = job.hook_call.hook.docker_image
 
         with _run(docker_image=docker_image,
                   script=hook.build_script,
                   remove_container=True,
-                  **kwargs) as (return_code, build_stdout, container):
-            job.finished(return_code)
-            job.stdout = stdout + build_stdout
-            db.session.commit()
+                  **kwargs) as (return_code, container):
+            finish_job(return_code)
             return
     finally:
         publisher.finish()
+        if source_dir:
+            shutil.rmtree(source_dir)
+        try:
+            report_pool_stats(redis_client, 'worker')
+        except redis.RedisError as e:
+            logger.warning('Failed to report Redis pool stats: %s', e)
@@ -0,0 +1,156 @@
+# coding: utf-8
+"""
+kozmic.builds.trees
+~~~~~~~~~~~~~~~~~~~
+
+Git object SHAs of tracked files.
+
+A dependency cache id (see :meth:`kozmic.models.Job.get_cache_id`) depends
+on the contents of :term:`tracked files`. Instead of asking for the contents
+of every file, it uses SHAs of git objects: the blob SHA of a file or
+the tree SHA of a directory, which changes whenever anything in the
+directory changes.
+
+SHAs are read from the repository mirror (see :mod:`kozmic.builds.mirrors`)
+by a single ``git cat-file --batch-check`` call or, if there is no mirror,
+from the GitHub Git Trees API. In the latter case only the trees along
+the tracked paths are requested (usually just the root tree).
+
+Results are memoized per commit and set of paths in a per-process cache,
+so restarted jobs and jobs of other hooks of the same commit reuse them.
+
+.. autofunction:: get_tracked_file_shas
+"""
+import os
+import threading
+import posixpath
+import subprocess
+import collections
+
+
+#: The maximum number of memoized results
+MAX_MEMOIZED_RESULTS = 1000
+
+_memoized_results = collections.OrderedDict()
+_memoized_results_lock = threading.Lock()
+
+
+class TreeError(Exception):
+    """Raised if SHAs of tracked files could not be read."""
+
+
+def normalize_path(path):
+    """Returns `path` relative to the repository root, as git and
+    GitHub want to see it. The root itself is an empty string.
+    """
+    path = os.path.relpath(path, start='.')
+    return '' if path == '.' else path
+
+
+def get_tracked_file_shas_from_mirror(mirror_path, commit_sha, paths):
+    """Returns a dictionary that maps `paths` to SHAs of git objects
+    at `commit_sha` commit of `mirror_path` repository. Paths that do not
+    exist are mapped to ``None``.
+    """
+    def git(args, input=None):
+        process = subprocess.Popen(
+            ['git', '--git-dir', mirror_path] + args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        output, error = process.communicate(input)
+        if process.returncode != 0:
+            raise TreeError(error.strip() or 'git {} has failed.'.format(args[0]))
+        return output
+
+    git(['cat-file', '-e', commit_sha + '^{commit}'])
+    # "<commit>:<path>" names an object at the path (the root tree if
+    # the path is empty); batch-check resolves them all at once and
+    # answers "<sha> <type> <size>" or "<name> missing" for each
+    output = git(['cat-file', '--batch-check'], input=''.join(
+        '{}:{}\n'.format(commit_sha, path) for path in paths))
+    shas = {}
+    for path, line in zip(paths, output.splitlines()):
+        shas[path] = None if line.endswith(' missing') else line.split()[0]
+    return shas
+
+
+def get_tracked_file_shas_from_github(gh_repo, commit_sha, paths):
+    """Does the same as :func:`get_tracked_file_shas_from_mirror`
+    using GitHub Git Trees API.
+
+    :type gh_repo: :class:`github3.repos.Repository`
+    """
+    # Maps directory paths to their tree SHAs and entries
+    # ({name: (type, SHA)}); files and missing paths are mapped to None
+    trees = {}
+
+    def get_tree(path):
+        if path in trees:
+            return trees[path]
+        if path:
+            parent_path, name = posixpath.split(path)
+            parent_tree = get_tree(parent_path)
+            entry = parent_tree and parent_tree[1].get(name)
+            if not entry or entry[0] != 'tree':
+                trees[path] = None
+                return None
+            tree_sha = entry[1]
+        else:
+            # The API resolves the commit to its tree
+            tree_sha = commit_sha
+
+        gh_tree = gh_repo.tree(tree_sha)
+        if gh_tree is None:
+            raise TreeError('Failed to get {} tree of {} commit.'.format(
+                path or 'the root', commit_sha))
+        trees[path] = (gh_tree.sha, dict(
+            (gh_hash.path, (gh_hash.type, gh_hash.sha))
+            for gh_hash in gh_tree.tree))
+        return trees[path]
+
+    shas = {}
+    for path in paths:
+        if not path:
+            shas[path] = get_tree(path)[0]
+            continue
+        parent_path, name = posixpath.split(path)
+        parent_tree = get_tree(parent_path)
+        entry = parent_tree and parent_tree[1].get(name)
+        shas[path] = entry and entry[1]
+    return shas
+
+
+def get_tracked_file_shas(commit_sha, paths, gh_repo, mirror_path=None):
+    """Returns a dictionary that maps tracked `paths` (normalized by
+    :func:`normalize_path`) to SHAs of git objects at `commit_sha` commit.
+    Paths that do not exist are mapped to ``None``.
+
+    Uses the mirror at `mirror_path`, if specified, and falls back
+    to the GitHub API if the mirror does not have the commit.
+
+    :type gh_repo: :class:`github3.repos.Repository`
+    :raises: :exc:`TreeError`
+    """
+    paths = tuple(sorted(set(normalize_path(path) for path in paths)))
+    key = (commit_sha, paths)
+    with _memoized_results_lock:
+        shas = _memoized_results.pop(key, None)
+        if shas is not None:
+            _memoized_results[key] = shas  # Move the key to the end
+            return dict(shas)
+
+    shas = None
+    if mirror_path:
+        try:
+            shas = get_tracked_file_shas_from_mirror(
+                mirror_path, commit_sha, paths)
+        except TreeError:
+            pass
+    if shas is None:
+        shas = get_tracked_file_shas_from_github(gh_repo, commit_sha, paths)
+
+    with _memoized_results_lock:
+        _memoized_results[key] = shas
+        while len(_memoized_results) > MAX_MEMOIZED_RESULTS:
+            _memoized_results.popitem(last=False)
+    return dict(shas)
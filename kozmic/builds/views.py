@@ -88,7 +88,7 @@ def hook(id):
         db.session.rollback()
         return 'OK'
 
-    tasks.do_job.delay(hook_call_id=hook_call.id)
+    tasks.enqueue_job(hook_call_id=hook_call.id)
     return 'OK'
 
 
@@ -16,16 +16,43 @@ class DefaultConfig(object):
     KOZMIC_REDIS_HOST = 'localhost'
     KOZMIC_REDIS_PORT = 6379
     KOZMIC_REDIS_DATABASE = 0
+    KOZMIC_REDIS_MAX_CONNECTIONS = None
+    KOZMIC_REDIS_SOCKET_TIMEOUT = None
+    KOZMIC_REDIS_HEALTH_CHECK_INTERVAL = 30
     KOZMIC_STALL_TIMEOUT = 900
+    KOZMIC_LOG_FLUSH_MAX_LINES = 1000
+    KOZMIC_LOG_FLUSH_MAX_BYTES = 64 * 1024
+    KOZMIC_LOG_FLUSH_MAX_LATENCY = 0.05
+    KOZMIC_LOG_BUFFER_MAX_LINES = 100000
+    KOZMIC_LOG_BUFFER_MAX_BYTES = 16 * 1024 * 1024
+    KOZMIC_LOG_BUFFER_TTL = 3600
+    KOZMIC_LOG_CHUNK_SIZE = 64 * 1024
+    KOZMIC_LOG_WINDOW_SIZE = 1000
+    KOZMIC_RENDERED_LOGS_CACHE_SIZE = 64 * 1024 * 1024
     KOZMIC_ENABLE_EMAIL_NOTIFICATIONS = False  # They are not very useful
                                                # at the moment
     KOZMIC_CACHED_IMAGES_LIMIT = 3
+    KOZMIC_DOCKER_PULL_POLICY = 'if-older-than'
+    KOZMIC_DOCKER_PULL_MAX_AGE = 5 * 60
+    KOZMIC_DOCKER_IMAGE_INDEX_TTL = 30
+    KOZMIC_CACHE_BUILD_LOCK_TTL = 60
+    KOZMIC_SCHEDULER_MAX_JOBS_PER_PROJECT = None
+    KOZMIC_SCHEDULER_RETRY_INTERVAL = 30
+    KOZMIC_SCHEDULER_LEASE_TTL = 60
+    KOZMIC_WORKER_SLOTS = None
+    KOZMIC_WORKER_CPUS_PER_JOB = 1
+    KOZMIC_WORKER_MEMORY_PER_JOB = 1024
+    KOZMIC_GIT_MIRRORS_DIR = None
+    KOZMIC_SSH_KNOWN_HOSTS = None
+    KOZMIC_SSH_KNOWN_HOSTS_TTL = 24 * 3600
     KOZMIC_USE_HTTPS_FOR_BADGES = False
 
     SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://kozmic:@127.0.0.1/kozmic'
 
     DOCKER_URL = 'unix://var/run/docker.sock'
     DOCKER_API_VERSION = '1.10'
+    DOCKER_TIMEOUT = 60
+    DOCKER_POOL_SIZE = 10
 
     BROKER_URL = 'redis://{host}:{port}/{db}'.format(
         host=KOZMIC_REDIS_HOST,
@@ -36,6 +63,7 @@ class DefaultConfig(object):
     CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
     CELERY_IGNORE_RESULT = True
     CELERY_DEFAULT_QUEUE = 'kozmic'
+    CELERYD_PREFETCH_MULTIPLIER = 1
 
     TAILER_URL_TEMPLATE = None
 
@@ -62,4 +90,5 @@ class TestingConfig(DefaultConfig):
     MAIL_SUPPRESS_SEND = True
     MAIL_DEFAULT_SENDER = 'Kozmic CI <no-reply@kozmic.test>'
     CELERY_ALWAYS_EAGER = True
+    KOZMIC_DOCKER_PULL_POLICY = 'always'
     TAILER_URL_TEMPLATE = 'ws://127.0.0.1:8801/{job_id}/'
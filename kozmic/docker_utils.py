@@ -1,4 +1,229 @@
+"""
+kozmic.docker_utils
+~~~~~~~~~~~~~~~~~~~
+
+:data:`kozmic.docker` is a :class:`PooledDockerClient` shared by all threads
+of a process (see :func:`get_docker_client`). It keeps up to
+:setting:`DOCKER_POOL_SIZE` connections to the Docker daemon open, so API
+calls do not pay for setting up a connection.
+
+Image ids are looked up by ``inspect_image`` of a single image, so the cost
+of a lookup does not depend on the number of images on the host, and the
+results are cached in :class:`ImageIndex` for
+:setting:`KOZMIC_DOCKER_IMAGE_INDEX_TTL` seconds. Images that are pulled,
+committed or removed using this module are dropped from the index at once.
+
+.. autoclass:: PooledDockerClient
+
+.. autofunction:: get_docker_client
+
+.. autofunction:: get_docker_image_id
+
+.. autofunction:: pull_image
+
+.. autoclass:: ImageIndex
+   :members:
+"""
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+
+import httplib
+import socket
+
+import flask
+import requests.adapters
+import docker as _docker
+from docker import APIError as DockerAPIError
+from docker.client import DEFAULT_DOCKER_API_VERSION
+from requests.packages.urllib3 import connectionpool
+
 from . import docker
+from .utils import file_lock
+
+
+#: Pull the image before every job
+PULL_ALWAYS = 'always'
+#: Pull the image if it has not been pulled for a while
+PULL_IF_OLDER_THAN = 'if-older-than'
+#: Pull the image only if it is not present
+PULL_NEVER_IF_PRESENT = 'never-if-present'
+
+PULL_POLICIES = (PULL_ALWAYS, PULL_IF_OLDER_THAN, PULL_NEVER_IF_PRESENT)
+
+#: A directory to keep image pull locks and timestamps in
+PULLS_DIR = os.path.join(tempfile.gettempdir(), 'kozmic-docker-pulls')
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection, object):
+    def __init__(self, socket_path, timeout):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class _UnixHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    def __init__(self, socket_path, timeout, maxsize):
+        connectionpool.HTTPConnectionPool.__init__(
+            self, 'localhost', timeout=timeout, maxsize=maxsize)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        self.num_connections += 1
+        return _UnixHTTPConnection(self.socket_path,
+                                   timeout=self.timeout.connect_timeout)
+
+
+class _UnixAdapter(requests.adapters.HTTPAdapter):
+    # Unlike the adapter of docker-py, which creates a new connection pool
+    # for every request, uses the same pool for all requests
+    def __init__(self, base_url, timeout, pool_size):
+        super(_UnixAdapter, self).__init__()
+        # The socket path is a part of the base URL
+        # (``http+unix://var/run/docker.sock``) and of request URLs
+        self.base_url = base_url
+        socket_path = '/' + base_url[len('http+unix:'):].lstrip('/')
+        self.pool = _UnixHTTPConnectionPool(
+            socket_path, timeout=timeout, maxsize=pool_size)
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def request_url(self, request, proxies):
+        return request.url[len(self.base_url):]
+
+    def close(self):
+        super(_UnixAdapter, self).close()
+        self.pool.close()
+
+
+class PooledDockerClient(_docker.Client):
+    """A thread-safe Docker client that reuses connections.
+
+    :param pool_size: how many idle connections to keep open
+    :type pool_size: int
+    """
+    def __init__(self, base_url=None, version=DEFAULT_DOCKER_API_VERSION,
+                 timeout=60, pool_size=10):
+        super(PooledDockerClient, self).__init__(
+            base_url=base_url, version=version, timeout=timeout)
+        #: The process the client has been created in
+        self.pid = os.getpid()
+        if self.base_url.startswith('http+unix:'):
+            self.mount('http+unix://',
+                       _UnixAdapter(self.base_url, timeout, pool_size))
+        else:
+            self.mount('http://', requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size))
+
+
+_docker_client_lock = threading.Lock()
+
+
+def get_docker_client():
+    """Returns :class:`PooledDockerClient` of the current application.
+    A client is never shared between processes, so that forked worker
+    processes do not use the connections of their parent.
+    """
+    app = flask.current_app
+    pid = os.getpid()
+    client = app.extensions.get('kozmic_docker_client')
+    if client is None or client.pid != pid:
+        with _docker_client_lock:
+            client = app.extensions.get('kozmic_docker_client')
+            if client is None or client.pid != pid:
+                client = PooledDockerClient(
+                    base_url=app.config['DOCKER_URL'],
+                    version=app.config['DOCKER_API_VERSION'],
+                    timeout=app.config['DOCKER_TIMEOUT'],
+                    pool_size=app.config['DOCKER_POOL_SIZE'])
+                app.extensions['kozmic_docker_client'] = client
+    return client
+
+
+class ImageIndex(object):
+    """A thread-safe in-process cache of image ids by image names
+    (``repository:tag``). Names of images that do not exist are cached too.
+
+    :param ttl: how long to cache an id for, in seconds
+    :type ttl: int
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        #: The process the index has been created in
+        self.pid = os.getpid()
+
+    def get(self, name):
+        """Returns a pair (whether `name` is cached, image id or ``None``)."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return False, None
+            image_id, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[name]
+                return False, None
+            return True, image_id
+
+    def set(self, name, image_id):
+        with self._lock:
+            self._entries[name] = (image_id, time.time() + self.ttl)
+
+    def discard(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def discard_image_id(self, image_id):
+        """Drops all names of `image_id` image."""
+        with self._lock:
+            for name, (cached_image_id, _) in self._entries.items():
+                if cached_image_id == image_id:
+                    del self._entries[name]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+#: :class:`ImageIndex` of the current process
+_image_index = None
+_image_index_lock = threading.Lock()
+
+
+def get_image_index():
+    """Returns :class:`ImageIndex` of the current process. It is shared
+    by all the tasks the process runs, but never with forked processes.
+    """
+    global _image_index
+    pid = os.getpid()
+    index = _image_index
+    if index is None or index.pid != pid:
+        with _image_index_lock:
+            index = _image_index
+            if index is None or index.pid != pid:
+                index = ImageIndex(
+                    flask.current_app.config['KOZMIC_DOCKER_IMAGE_INDEX_TTL'])
+                _image_index = index
+    return index
+
+
+def get_image_name(image, tag='latest'):
+    """Returns ``repository:tag`` name of `image`. If `image` already
+    contains a tag, `tag` is ignored.
+    """
+    if ':' in image.rsplit('/', 1)[-1]:
+        return image
+    return ':'.join((image, tag))
 
 
 def does_docker_image_exist(image, tag='latest'):
@@ -6,8 +231,97 @@ def does_docker_image_exist(image, tag='latest'):
 
 
 def get_docker_image_id(image, tag='latest'):
-    for image_data in docker.images(image):
-        for repo_tag in image_data['RepoTags']:
-            if repo_tag == ':'.join((image, tag)):
-                return image_data['Id']
-    return None
+    """Returns id of `image` image or ``None`` if it does not exist."""
+    name = get_image_name(image, tag=tag)
+    index = get_image_index()
+    is_cached, image_id = index.get(name)
+    if not is_cached:
+        try:
+            image_data = docker.inspect_image(name)
+        except DockerAPIError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            image_id = None
+        else:
+            # Old Docker API versions use lowercase keys
+            image_id = image_data.get('Id') or image_data.get('id')
+        index.set(name, image_id)
+    return image_id
+
+
+def commit_image(container, repository, tag='latest'):
+    """Commits `container` to `repository`:`tag` image."""
+    result = docker.commit(container, repository=repository, tag=tag)
+    get_image_index().discard(get_image_name(repository, tag=tag))
+    return result
+
+
+def remove_image(image_id):
+    """Removes `image_id` image."""
+    docker.remove_image(image_id)
+    get_image_index().discard_image_id(image_id)
+
+
+def _read_timestamp(path):
+    try:
+        with open(path) as timestamp_file:
+            return float(timestamp_file.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _is_image_present(image):
+    try:
+        docker.inspect_image(image)
+    except DockerAPIError:
+        return False
+    return True
+
+
+def pull_image(image, policy=PULL_ALWAYS, max_age=0, pulls_dir=PULLS_DIR):
+    """Pulls `image` from the registry according to `policy`:
+
+    * :data:`PULL_ALWAYS` -- pull the image;
+    * :data:`PULL_IF_OLDER_THAN` -- pull the image if it is not present
+      or has not been pulled during the last `max_age` seconds;
+    * :data:`PULL_NEVER_IF_PRESENT` -- pull the image if it is not present.
+
+    Pulls of the same image are serialized using a file lock in `pulls_dir`,
+    so that concurrent jobs of a host trigger a single pull: a job that has
+    been waiting for another job's pull to finish uses its result regardless
+    of the policy.
+
+    Returns ``True`` if the image has been pulled, ``False`` if the local
+    image has been used.
+
+    :raises: :exc:`docker.APIError` if the image could not be pulled
+    """
+    assert policy in PULL_POLICIES
+    requested_at = time.time()
+
+    try:
+        os.makedirs(pulls_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    stamp_path = os.path.join(pulls_dir, hashlib.sha1(image).hexdigest())
+
+    with file_lock(stamp_path + '.lock'):
+        if _is_image_present(image):
+            pulled_at = _read_timestamp(stamp_path)
+            if policy == PULL_NEVER_IF_PRESENT:
+                return False
+            if pulled_at is not None and (
+                    pulled_at >= requested_at or
+                    (policy == PULL_IF_OLDER_THAN and
+                     time.time() - pulled_at < max_age)):
+                return False
+
+        docker.pull(image)
+        get_image_index().discard(get_image_name(image))
+        # Make sure that image has been successfully pulled by calling
+        # `inspect_image` on it
+        docker.inspect_image(image)
+        with open(stamp_path, 'w') as timestamp_file:
+            timestamp_file.write(repr(time.time()))
+        return True
@@ -2,7 +2,8 @@
 kozmic.entry_point
 ~~~~~~~~~~~~~~~~~~
 A module to be used as an ``-A`` argument for ``celery worker`` command.
-Contains a :class:`celery.Celery` instance.
+Contains a :class:`celery.Celery` instance. The application created here
+is shared by all tasks run by a worker process.
 """
 from . import celery, create_app
 
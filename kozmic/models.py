@@ -7,11 +7,12 @@ import itertools
 import datetime
 import collections
 import hashlib
-import os.path
 import logging
+import zlib
 
 import github3
 import sqlalchemy.dialects.mysql
+import sqlalchemy.exc
 import flask
 from Crypto.PublicKey import RSA
 from flask.ext.login import UserMixin
@@ -22,6 +23,7 @@ from sqlalchemy.ext.declarative import declared_attr
 
 from . import db, mail, perms, docker_utils
 from .utils import JSONEncodedDict
+from .builds.trees import get_tracked_file_shas, normalize_path
 
 
 logger = logging.getLogger(__name__)
@@ -382,6 +384,13 @@ class Project(db.Model):
     gh_https_clone_url = db.Column(db.String(200), nullable=False)
     #: Is the project's repository public?
     is_public = db.Column(db.Boolean, nullable=False)
+    #: The maximum number of the project's jobs that run at once,
+    #: :setting:`KOZMIC_SCHEDULER_MAX_JOBS_PER_PROJECT` if not set
+    max_concurrent_jobs = db.Column(db.Integer)
+    #: The project's share of worker slots relative to other projects
+    #: when they all have queued jobs (see :mod:`kozmic.builds.scheduler`)
+    scheduling_weight = db.Column(db.Integer, nullable=False, default=1,
+                                  server_default='1')
 
     #: Deploy key
     deploy_key = db.relationship(
@@ -511,10 +520,46 @@ class Hook(db.Model):
     #: (for example, "ubuntu" or "aromanovich/ubuntu-kozmic").
     #: Specified docker image is pulled from index.docker.io before build
     docker_image = db.Column(db.String(200), nullable=False)
+    #: Whether to fetch only the commit being built, without its history
+    shallow_clone = db.Column(db.Boolean, nullable=False, default=False)
+    #: Whether to clone only the branch being built
+    single_branch = db.Column(db.Boolean, nullable=False, default=False)
+    #: Paths to be checked out, one per line (sparse checkout).
+    #: If empty, the whole tree is checked out
+    sparse_checkout_paths = db.Column(db.Text)
     #: Project
     project = db.relationship(
         Project, backref=db.backref('hooks', lazy='dynamic', cascade='all'))
 
+    def get_checkout_options(self, ref):
+        """Returns a dictionary of keyword arguments for
+        :func:`kozmic.builds.tasks.get_checkout_sh` that describes
+        how to check out a commit of `ref` branch.
+        """
+        sparse_paths = [path.strip() for path in
+                        (self.sparse_checkout_paths or '').splitlines()]
+        return {
+            'ref': ref,
+            'shallow': self.shallow_clone,
+            'single_branch': self.single_branch,
+            'sparse_paths': [path for path in sparse_paths if path],
+        }
+
+    def get_install_stages(self):
+        """Returns a list of install stages as pairs (script, list of
+        tracked paths). :attr:`install_script` with the hook's
+        :term:`tracked files` is the first stage and
+        :class:`InstallStage` instances follow it.
+        """
+        stages = []
+        if self.install_script:
+            stages.append((self.install_script,
+                           [tracked_file.path for tracked_file in self.tracked_files]))
+        for install_stage in self.install_stages.order_by(InstallStage.number):
+            stages.append((install_stage.script,
+                           install_stage.get_tracked_paths()))
+        return stages
+
     def ensure(self):
         """If the corresponding GitHub hook does not exist, creates it.
         If it exists, but has wrong configuration, re-configures it.
@@ -588,6 +633,87 @@ class TrackedFile(db.Model):
         Hook, backref=db.backref('tracked_files', lazy='dynamic', cascade='all'))
 
 
+class InstallStage(db.Model):
+    """An additional install script of a hook. Stages are run one after
+    another, each in the image committed after the previous one, and each
+    result is cached separately. So a change of a stage's tracked files
+    reruns only this stage and the following ones.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('hook_id', 'number',
+                            name='unique_install_stage_within_hook'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    hook_id = db.Column(db.Integer, db.ForeignKey('hook.id', ondelete='CASCADE'),
+                        nullable=False)
+
+    #: Stage number (within a hook)
+    number = db.Column(db.Integer, nullable=False)
+    #: Install script
+    script = db.Column(db.Text, nullable=False)
+    #: Paths of :term:`tracked files` of the stage, one per line
+    tracked_files = db.Column(db.Text)
+    #: Hook
+    hook = db.relationship(
+        Hook, backref=db.backref('install_stages', lazy='dynamic', cascade='all'))
+
+    def get_tracked_paths(self):
+        paths = [path.strip() for path in (self.tracked_files or '').splitlines()]
+        return [path for path in paths if path]
+
+
+class CacheKey(db.Model):
+    """Memoizes a dependency cache id (see :meth:`Job.get_cache_id`)
+    computed for a commit, so that restarted jobs and other jobs of the
+    commit do not compute it again.
+
+    A cache id also depends on tracked files, which are not a part of
+    the key, so the hook's cache keys are deleted whenever it is edited.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('hook_id', 'install_script_hash', 'docker_image_id',
+                            'gh_commit_sha', name='unique_cache_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    hook_id = db.Column(db.Integer, db.ForeignKey('hook.id', ondelete='CASCADE'),
+                        nullable=False)
+
+    #: SHA-256 of the install script
+    install_script_hash = db.Column(db.String(64), nullable=False)
+    #: Id of the base Docker image
+    docker_image_id = db.Column(db.String(64), nullable=False)
+    #: Commit SHA
+    gh_commit_sha = db.Column(db.String(40), nullable=False)
+    #: Cache id
+    cache_id = db.Column(db.String(64), nullable=False)
+    #: Name of the cached Docker image of the last install stage
+    #: (``repository:tag``)
+    docker_image = db.Column(db.String(200), nullable=False)
+    #: Names of the cached Docker images of all install stages,
+    #: one per line
+    stage_docker_images = db.Column(db.Text)
+    #: Created at
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+    #: Hook
+    hook = db.relationship(
+        Hook, backref=db.backref('cache_keys', lazy='dynamic', cascade='all'))
+
+    @staticmethod
+    def get_install_script_hash(install_scripts):
+        """Returns SHA-256 of a list of install stage scripts."""
+        return hashlib.sha256(
+            '\0'.join(install_scripts).encode('utf-8')).hexdigest()
+
+    def get_stage_docker_images(self):
+        """Returns a list of names of the install stage images."""
+        if not self.stage_docker_images:
+            return [self.docker_image]
+        return self.stage_docker_images.splitlines()
+
+
 class Build(db.Model):
     """Reflects a project commit that triggered a project hook."""
     __table_args__ = (
@@ -716,6 +842,32 @@ class HookCall(db.Model):
         Build, backref=db.backref('hook_calls', lazy='dynamic', cascade='all'))
 
 
+def count_lines(data):
+    """Returns the number of lines in `data`, including
+    the last one that may not end with a newline.
+    """
+    return data.count('\n') + int(bool(data) and not data.endswith('\n'))
+
+
+def slice_lines(data, start, end=None):
+    """Returns lines of `data` from `start` to `end` (zero-based, `end`
+    is not included) as a single string with the newlines preserved.
+    """
+    begin = 0
+    for _ in xrange(start):
+        begin = data.find('\n', begin) + 1
+        if not begin:
+            return ''
+    if end is None:
+        return data[begin:]
+    stop = begin
+    for _ in xrange(end - start):
+        stop = data.find('\n', stop) + 1
+        if not stop:
+            return data[begin:]
+    return data[begin:stop]
+
+
 class Job(db.Model):
     """A job that caused by a hook call."""
     id = db.Column(db.Integer, primary_key=True)
@@ -730,7 +882,8 @@ class Job(db.Model):
     finished_at = db.Column(db.DateTime)
     #: Return code
     return_code = db.Column(db.Integer)
-    #: Job log
+    #: Job log of the jobs run before the chunked log storage has been
+    #: introduced. Use :meth:`get_log` to read the log of any job
     stdout = db.deferred(db.Column(sqlalchemy.dialects.mysql.MEDIUMBLOB))
     #: uuid of a Celery task that is running a job
     task_uuid = db.Column(db.String(36))
@@ -739,15 +892,72 @@ class Job(db.Model):
         Build, backref=db.backref('jobs', lazy='dynamic', cascade='all'))
     #: :class:`HookCall`
     hook_call = db.relationship('HookCall')
+    #: Log chunks (see :class:`JobLogChunk`)
+    log_chunks = db.relationship(
+        'JobLogChunk', lazy='dynamic', cascade='all, delete-orphan',
+        passive_deletes=True, order_by='JobLogChunk.number')
 
     def __repr__(self):
         return u'<Job #{0.id}>'.format(self).encode('utf-8')
 
-    def get_cache_id(self):
-        """Returns a string that can be used for tagging a Docker image
-        built from the install script.
-        A cache id changes whenever the base Docker image, the install
-        script or any of the :term:`tracked files` is changed.
+    def get_cache_key(self, mirror_path=None):
+        """Returns :class:`CacheKey` of the job. Computes the cache ids
+        (see :meth:`get_stage_cache_ids`) only if the key does not
+        exist yet. Commits the session if the key is created.
+
+        .. note::
+
+            Requires that Docker is running and Docker base image
+            (:attr:`self.hook_call.hook.docker_image`) is pulled.
+        """
+        hook = self.hook_call.hook
+        docker_image_id = docker_utils.get_docker_image_id(
+            *hook.docker_image.rsplit(':'))
+        assert docker_image_id
+        key = {
+            'hook_id': hook.id,
+            'install_script_hash': CacheKey.get_install_script_hash(
+                [script for script, _ in hook.get_install_stages()]),
+            'docker_image_id': docker_image_id,
+            'gh_commit_sha': self.build.gh_commit_sha,
+        }
+
+        cache_key = CacheKey.query.filter_by(**key).first()
+        if cache_key is None:
+            cache_ids = self.get_stage_cache_ids(mirror_path=mirror_path)
+            stage_docker_images = [
+                'kozmic-cache/{}:{}'.format(cache_id, self.build.project.id)
+                for cache_id in cache_ids]
+            cache_key = CacheKey(
+                cache_id=cache_ids[-1],
+                docker_image=stage_docker_images[-1],
+                stage_docker_images='\n'.join(stage_docker_images),
+                **key)
+            db.session.add(cache_key)
+            try:
+                # Commit the key right away, so that concurrent jobs of
+                # the commit see it instead of waiting for the unique
+                # index lock until the job is finished
+                db.session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                # A concurrent job has created the same key. Rolling back
+                # starts a new transaction that sees it
+                db.session.rollback()
+                cache_key = CacheKey.query.filter_by(**key).one()
+        return cache_key
+
+    def get_stage_cache_ids(self, mirror_path=None):
+        """Returns a list of strings that can be used for tagging Docker
+        images built from the install stages (see
+        :meth:`Hook.get_install_stages`).
+
+        A stage cache id changes whenever the previous stage cache id
+        (the base Docker image id for the first stage), the stage script
+        or any of the stage :term:`tracked files` is changed.
+
+        Tracked files are identified by SHAs of their git objects
+        (see :mod:`kozmic.builds.trees`), which are read from the repository
+        mirror at `mirror_path`, if specified, or requested from GitHub.
 
         .. note::
 
@@ -755,39 +965,162 @@ class Job(db.Model):
             (:attr:`self.hook_call.hook.docker_image`) is pulled.
         """
         hook = self.hook_call.hook
-        gh = self.build.project.gh
-        commit_sha = self.build.gh_commit_sha
+        stages = hook.get_install_stages()
 
         docker_image_id = docker_utils.get_docker_image_id(
             *hook.docker_image.rsplit(':'))
         assert docker_image_id
-        hash_parts = [docker_image_id, hook.install_script]
-
-        for tracked_file in hook.tracked_files.order_by(TrackedFile.path):
-            path = tracked_file.path
-            # GitHub API wants to see paths relative to the repo directory
-            # ("./basic.txt" does not work, whereas "basic.txt" does)
-            path = os.path.relpath(path, start='.')
-            if path == '.':
-                # Special case: os.path.relpath('.', start='.') returns ".",
-                # but GitHub API wants to see "/" or "".
-                path = ''
-
-            contents = gh.contents(path, ref=commit_sha)
-            if isinstance(contents, dict):
-                # `contents` represents a directory. Add all its entries
-                # to the hash
-                for file_path, file_contents in contents.iteritems():
-                    hash_parts.append(file_path + file_contents.sha)
-            elif contents:
-                # `contents` represents a regular file
-                hash_parts.append(path + contents.sha)
-            else:
-                # `path` does not exist. But it's still necessary to include
-                # it in the hash to be able to detect file removals
-                hash_parts.append(path)
 
-        return hashlib.sha256(''.join(hash_parts)).hexdigest()
+        # Ask for SHAs of all the stages at once
+        tracked_file_shas = get_tracked_file_shas(
+            self.build.gh_commit_sha,
+            [path for _, paths in stages for path in paths],
+            gh_repo=self.build.project.gh,
+            mirror_path=mirror_path)
+
+        cache_ids = []
+        previous_id = docker_image_id
+        for script, paths in stages:
+            hash_parts = [previous_id, script]
+            for path in sorted(set(normalize_path(path) for path in paths)):
+                # Paths that do not exist are still included in the hash
+                # to be able to detect file removals
+                hash_parts.append(path + (tracked_file_shas[path] or ''))
+            previous_id = hashlib.sha256(''.join(hash_parts)).hexdigest()
+            cache_ids.append(previous_id)
+        return cache_ids
+
+    def get_cache_id(self, mirror_path=None):
+        """Returns a string that can be used for tagging a Docker image
+        built from the last install stage (see :meth:`get_stage_cache_ids`).
+        A cache id changes whenever the base Docker image, the install
+        script or any of the :term:`tracked files` is changed.
+        """
+        return self.get_stage_cache_ids(mirror_path=mirror_path)[-1]
+
+    def _has_log_chunks(self):
+        return db.session.query(self.log_chunks.exists()).scalar()
+
+    def get_log_length(self):
+        """Returns the length of the job log in bytes without loading it."""
+        length, count = db.session.query(
+            db.func.sum(JobLogChunk.size), db.func.count()).filter(
+            JobLogChunk.job_id == self.id).one()
+        if count:
+            return int(length)
+        if 'stdout' not in sqlalchemy.inspect(self).unloaded:
+            return len(self.stdout or '')
+        return db.session.query(db.func.length(Job.stdout)).filter(
+            Job.id == self.id).scalar() or 0
+
+    def get_log_line_count(self):
+        """Returns the number of lines in the job log without loading it.
+        The last line is counted even if it doesn't end with a newline.
+        """
+        last_chunk = self.log_chunks.order_by(None).order_by(
+            JobLogChunk.number.desc()).first()
+        if last_chunk is None:
+            return count_lines(self.stdout or '')
+        return last_chunk.line_offset + count_lines(last_chunk.get_data())
+
+    def get_log(self, start=0, end=None):
+        """Returns the job log or its part from `start` to `end` byte.
+        Only chunks that contain the requested bytes are loaded.
+
+        :type start: int
+        :type end: int or None
+        """
+        chunks = self.log_chunks
+        if end is not None:
+            chunks = chunks.filter(JobLogChunk.offset < end)
+        chunks = chunks.filter(JobLogChunk.offset + JobLogChunk.size > start).all()
+        if not chunks:
+            if self._has_log_chunks():
+                return ''
+            return (self.stdout or '')[start:end]
+
+        first_chunk_offset = chunks[0].offset
+        data = ''.join(chunk.get_data() for chunk in chunks)
+        return data[start - first_chunk_offset:
+                    None if end is None else end - first_chunk_offset]
+
+    def iter_log(self, end=None, chunks_per_query=16):
+        """Yields the job log or its part up to `end` byte piece by piece,
+        loading `chunks_per_query` chunks at a time.
+
+        :type end: int or None
+        :type chunks_per_query: int
+        """
+        query = self.log_chunks
+        if end is not None:
+            query = query.filter(JobLogChunk.offset < end)
+        number = 0
+        while True:
+            chunks = query.filter(
+                JobLogChunk.number >= number).limit(chunks_per_query).all()
+            if not chunks:
+                break
+            for chunk in chunks:
+                data = chunk.get_data()
+                if end is not None:
+                    data = data[:end - chunk.offset]
+                yield data
+            number = chunks[-1].number + 1
+        if not number and self.stdout:
+            yield self.stdout[:end]
+
+    def get_log_lines(self, start=0, end=None):
+        """Returns lines of the job log from `start` to `end`
+        (zero-based, `end` is not included) as a single string.
+        Only chunks that contain the requested lines are loaded.
+
+        :type start: int
+        :type end: int or None
+        """
+        # Line n begins right after the n-th newline of the log. So we need
+        # chunks that contain the `start`-th newline (or begin after it)
+        # and precede the `end`-th newline (the one that ends line `end - 1`)
+        chunks = self.log_chunks.filter(
+            JobLogChunk.line_offset + JobLogChunk.line_count >= start)
+        if end is not None:
+            chunks = chunks.filter(JobLogChunk.line_offset < end)
+        chunks = chunks.all()
+        if chunks:
+            first_line = chunks[0].line_offset
+            data = ''.join(chunk.get_data() for chunk in chunks)
+        elif not self._has_log_chunks():
+            first_line = 0
+            data = self.stdout or ''
+        else:
+            return ''
+        return slice_lines(data, start - first_line,
+                           None if end is None else end - first_line)
+
+    def iter_log_lines(self, start=0, chunks_per_query=16):
+        """Yields lines of the job log starting from `start` (zero-based)
+        piece by piece, loading `chunks_per_query` chunks at a time.
+
+        :type start: int
+        :type chunks_per_query: int
+        """
+        # The first chunk contains the `start`-th newline (see get_log_lines)
+        first_chunk = self.log_chunks.filter(
+            JobLogChunk.line_offset + JobLogChunk.line_count >= start).first()
+        if first_chunk is None:
+            if self.stdout and not self._has_log_chunks():
+                yield slice_lines(self.stdout, start)
+            return
+        yield slice_lines(first_chunk.get_data(),
+                          start - first_chunk.line_offset)
+        number = first_chunk.number + 1
+        while True:
+            chunks = self.log_chunks.filter(
+                JobLogChunk.number >= number).limit(chunks_per_query).all()
+            if not chunks:
+                break
+            for chunk in chunks:
+                yield chunk.get_data()
+            number = chunks[-1].number + 1
 
     def started(self):
         """Sets :attr:`started_at` and updates :attr:`build` status.
@@ -854,3 +1187,35 @@ class Job(db.Model):
                 return 'success'
             else:
                 return 'failure'
+
+
+class JobLogChunk(db.Model):
+    """A zlib-compressed chunk of a job log.
+
+    A log is split into chunks of a fixed size (all of them except the last
+    one are :attr:`size` bytes long), which are written while the job is
+    running (see :class:`kozmic.builds.logs.JobLogWriter`). Chunks store
+    their byte and line offsets, so :meth:`Job.get_log` and
+    :meth:`Job.get_log_lines` load only the chunks they need.
+    """
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id', ondelete='CASCADE'),
+                       primary_key=True)
+    #: Zero-based number of the chunk within the log
+    number = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    #: Offset of the chunk's first byte in the log
+    offset = db.Column(db.BigInteger, nullable=False)
+    #: Uncompressed size in bytes
+    size = db.Column(db.Integer, nullable=False)
+    #: Number of newlines in the log before the chunk
+    line_offset = db.Column(db.Integer, nullable=False)
+    #: Number of newlines in the chunk
+    line_count = db.Column(db.Integer, nullable=False)
+    #: zlib-compressed data
+    data = db.Column(sqlalchemy.dialects.mysql.MEDIUMBLOB, nullable=False)
+
+    def __repr__(self):
+        return u'<JobLogChunk #{0.job_id}:{0.number}>'.format(self).encode('utf-8')
+
+    def get_data(self):
+        """Returns uncompressed data."""
+        return zlib.decompress(self.data)
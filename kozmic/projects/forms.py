@@ -4,7 +4,7 @@ import os.path
 import wtforms
 from flask.ext import wtf
 
-from kozmic.models import TrackedFile
+from kozmic.models import TrackedFile, InstallStage
 
 
 required = wtforms.validators.Required()
@@ -39,18 +39,55 @@ class UnixEndingsTextAreaField(wtforms.TextAreaField):
         return super(UnixEndingsTextAreaField, self).process_formdata(valuelist)
 
 
+class InstallStageForm(wtforms.Form):
+    script = UnixEndingsTextAreaField('Script', [optional])
+    tracked_files = UnixEndingsTextAreaField('Tracked files', [optional])
+
+
+class InstallStagesField(wtforms.FieldList):
+    """A list of install stages. A blank stage is added to the end of
+    the list to be filled in; stages with empty scripts are dropped.
+    """
+    def __init__(self, label=None, validators=None, **kwargs):
+        super(InstallStagesField, self).__init__(
+            wtforms.FormField(InstallStageForm), label, validators, **kwargs)
+
+    def process(self, formdata, data=None):
+        if hasattr(data, 'order_by'):
+            data = data.order_by(InstallStage.number).all()
+        super(InstallStagesField, self).process(formdata, data)
+        if not formdata:
+            self.append_entry()
+
+    def populate_obj(self, obj, name):
+        install_stages = getattr(obj, name)
+        install_stages.delete()
+        entries = [entry for entry in self.entries
+                   if (entry.script.data or '').strip()]
+        for number, entry in enumerate(entries, start=1):
+            install_stages.append(InstallStage(
+                number=number,
+                script=entry.script.data,
+                tracked_files=entry.tracked_files.data))
+
+
 class HookForm(wtf.Form):
     title = wtforms.TextField('Title *', [required])
     install_script = UnixEndingsTextAreaField(
         'Install script', [optional])
     tracked_files = TrackedFilesField(
         'Tracked files', [optional])
+    install_stages = InstallStagesField('Install stages')
     build_script = UnixEndingsTextAreaField(
         'Build script *', [required],
         default='#!/bin/bash\n\necho "It works!"')
     docker_image = wtforms.TextField(
         'Docker image *', [required],
         default='kozmic/ubuntu-base:12.04')
+    shallow_clone = wtforms.BooleanField('Shallow clone')
+    single_branch = wtforms.BooleanField('Single branch')
+    sparse_checkout_paths = UnixEndingsTextAreaField(
+        'Sparse checkout paths', [optional])
     submit = wtforms.SubmitField('Save')
 
 
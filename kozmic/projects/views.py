@@ -1,7 +1,7 @@
 import logging
 
 from flask import (Response, current_app, render_template, redirect,
-                   flash, request, url_for)
+                   flash, request, url_for, stream_with_context, jsonify)
 from flask.ext.login import current_user
 
 from . import bp
@@ -10,6 +10,7 @@ from kozmic import db, perms
 from kozmic.models import (MISSING_ID, Project, User, Membership, Hook,
                            Build, Job)
 from kozmic.builds.tasks import restart_job
+from kozmic.builds.rendering import render_job_log_window
 
 
 logger = logging.getLogger(__name__)
@@ -118,10 +119,62 @@ def job(project_id, build_id, id):
 
 @bp.route('/<int:project_id>/jobs/<int:id>/log/')
 def job_log(project_id, id):
+    """Returns the raw job log.
+
+    ``?tail=N`` returns the last N lines, ``?from_line=N`` returns lines
+    starting from the N-th one (one-based). A single byte range can be
+    requested by the ``Range`` header. Otherwise the whole log is streamed.
+    None of them loads more of the log than needed.
+    """
+    project = get_project(project_id, for_management=False)
+    job = project.builds.join(Job).filter(
+        Job.id == id).with_entities(Job).first_or_404()
+
+    tail = request.args.get('tail', type=int)
+    if tail is not None:
+        start = max(job.get_log_line_count() - max(tail, 0), 0)
+        return Response(stream_with_context(job.iter_log_lines(start)),
+                        mimetype='text/plain')
+
+    from_line = request.args.get('from_line', type=int)
+    if from_line is not None:
+        return Response(
+            stream_with_context(job.iter_log_lines(max(from_line - 1, 0))),
+            mimetype='text/plain')
+
+    length = job.get_log_length()
+    if request.range and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            return Response(status=416, headers={
+                'Content-Range': 'bytes */{}'.format(length)})
+        response = Response(job.get_log(*byte_range), status=206,
+                            mimetype='text/plain')
+        response.headers['Content-Range'] = \
+            request.range.make_content_range(length).to_header()
+    else:
+        # A running job may write more of the log while it is being sent,
+        # so stop where Content-Length says the log ends
+        response = Response(stream_with_context(job.iter_log(length)),
+                            mimetype='text/plain')
+        response.content_length = length
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+@bp.route('/<int:project_id>/jobs/<int:id>/log/lines/')
+def job_log_lines(project_id, id):
+    """Returns a window of the rendered job log as JSON.
+    See :func:`kozmic.builds.rendering.render_job_log_window` for
+    the ``start`` and ``end`` parameters and the response format.
+    """
     project = get_project(project_id, for_management=False)
     job = project.builds.join(Job).filter(
         Job.id == id).with_entities(Job).first_or_404()
-    return Response(job.stdout, mimetype='text/plain')
+    return jsonify(**render_job_log_window(
+        job,
+        start=request.args.get('start', type=int),
+        end=request.args.get('end', type=int)))
 
 
 @bp.route('/<int:project_id>/job/<int:id>/restart/')
@@ -210,6 +263,9 @@ def edit_hook(project_id, hook_id):
     form = HookForm(request.form, obj=hook)
     if form.validate_on_submit():
         form.populate_obj(hook)
+        # Tracked files might have changed, so memoized cache ids
+        # can not be trusted anymore
+        hook.cache_keys.delete()
         db.session.add(hook)
         db.session.commit()
         return redirect(url_for('.settings', id=project_id))
@@ -0,0 +1,170 @@
+"""
+kozmic.redis_utils
+~~~~~~~~~~~~~~~~~~
+
+All Redis clients of a process share a :class:`ConnectionPool` created by
+:func:`create_connection_pool` from ``KOZMIC_REDIS_*`` settings: Celery
+workers and web application processes get it by :func:`get_redis_client`,
+:mod:`tailer` creates its own one. The same settings limit the connection
+pools of the Celery broker (see :func:`get_broker_transport_options`).
+
+Every pool reports its utilization to Redis (see :func:`report_pool_stats`),
+so that ``./manage.py show_redis_pools`` can show how many connections
+all the processes use and how it compares to Redis ``maxclients``.
+
+.. autoclass:: ConnectionPool
+   :members: get_stats
+
+.. autofunction:: create_connection_pool
+
+.. autofunction:: get_redis_client
+"""
+import os
+import json
+import time
+import socket
+
+import flask
+import redis
+
+
+#: A Redis hash that maps process names to their pool stats
+POOL_STATS_KEY = 'kozmic:redis-pools'
+
+
+class ConnectionPool(redis.ConnectionPool):
+    """A :class:`redis.ConnectionPool` that checks idle connections
+    before reusing them and collects utilization stats.
+    """
+    #: Connections that have been idle for this many seconds are
+    #: checked by ``PING`` before use, 0 disables the check
+    health_check_interval = 0
+
+    def __init__(self, *args, **kwargs):
+        # Also called after a fork, so that the stats are per-process
+        super(ConnectionPool, self).__init__(*args, **kwargs)
+        self._peak_in_use_connections = 0
+        self._failed_health_checks = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        connection = super(ConnectionPool, self).get_connection(
+            command_name, *keys, **options)
+        self._peak_in_use_connections = max(
+            self._peak_in_use_connections, len(self._in_use_connections))
+
+        released_at = getattr(connection, 'released_at', None)
+        if (self.health_check_interval and connection._sock is not None and
+                released_at is not None and
+                time.time() - released_at >= self.health_check_interval):
+            try:
+                connection.send_command('PING')
+                if connection.read_response() != 'PONG':
+                    raise redis.ConnectionError('Unexpected PING response.')
+            except redis.RedisError:
+                # Most likely Redis or a firewall has closed the connection.
+                # The command will open a new one
+                self._failed_health_checks += 1
+                connection.disconnect()
+        return connection
+
+    def release(self, connection):
+        connection.released_at = time.time()
+        super(ConnectionPool, self).release(connection)
+
+    def get_stats(self):
+        """Returns a dictionary with the following keys: ``created``
+        (the number of open connections), ``in_use``, ``idle``,
+        ``peak_in_use`` (since the process has started), ``max``
+        (``None`` if not limited) and ``failed_health_checks``.
+        """
+        return {
+            'created': self._created_connections,
+            'in_use': len(self._in_use_connections),
+            'idle': len(self._available_connections),
+            'peak_in_use': self._peak_in_use_connections,
+            'max': (self.max_connections
+                    if self.max_connections < 2 ** 31 else None),
+            'failed_health_checks': self._failed_health_checks,
+        }
+
+
+def get_pool_options(config):
+    """Returns keyword arguments for :func:`create_connection_pool`
+    from ``KOZMIC_REDIS_*`` settings of `config` mapping.
+    """
+    return {
+        'host': config['KOZMIC_REDIS_HOST'],
+        'port': int(config['KOZMIC_REDIS_PORT']),
+        'db': int(config['KOZMIC_REDIS_DATABASE']),
+        'max_connections': config['KOZMIC_REDIS_MAX_CONNECTIONS'],
+        'socket_timeout': config['KOZMIC_REDIS_SOCKET_TIMEOUT'],
+        'health_check_interval': config['KOZMIC_REDIS_HEALTH_CHECK_INTERVAL'],
+    }
+
+
+def create_connection_pool(host='localhost', port=6379, db=0,
+                           max_connections=None, socket_timeout=None,
+                           health_check_interval=0):
+    """Returns a new :class:`ConnectionPool`.
+
+    :param max_connections: the maximum number of connections, if
+                            exceeded, commands raise :exc:`redis.ConnectionError`
+    :param socket_timeout: socket timeout, in seconds
+    :param health_check_interval: see :attr:`ConnectionPool.health_check_interval`
+    """
+    pool = ConnectionPool(host=host, port=port, db=db,
+                          max_connections=max_connections,
+                          socket_timeout=socket_timeout)
+    pool.health_check_interval = health_check_interval
+    return pool
+
+
+def get_broker_transport_options(config):
+    """Returns Celery ``BROKER_TRANSPORT_OPTIONS`` that apply
+    ``KOZMIC_REDIS_*`` limits of `config` mapping to the broker connections.
+    """
+    options = {}
+    if config['KOZMIC_REDIS_MAX_CONNECTIONS']:
+        options['max_connections'] = config['KOZMIC_REDIS_MAX_CONNECTIONS']
+    if config['KOZMIC_REDIS_SOCKET_TIMEOUT']:
+        options['socket_timeout'] = config['KOZMIC_REDIS_SOCKET_TIMEOUT']
+    return options
+
+
+def get_redis_client():
+    """Returns a :class:`redis.StrictRedis` that uses the connection pool
+    of the current application.
+    """
+    app = flask.current_app
+    pool = app.extensions.get('kozmic_redis_pool')
+    if pool is None:
+        pool = create_connection_pool(**get_pool_options(app.config))
+        app.extensions['kozmic_redis_pool'] = pool
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def report_pool_stats(redis_client, name):
+    """Saves stats of `redis_client`'s connection pool to
+    :data:`POOL_STATS_KEY` hash under ``<name>:<hostname>:<pid>`` field.
+    """
+    stats = dict(redis_client.connection_pool.get_stats(),
+                 reported_at=time.time())
+    field = '{}:{}:{}'.format(name, socket.gethostname(), os.getpid())
+    redis_client.hset(POOL_STATS_KEY, field, json.dumps(stats))
+
+
+def get_pool_stats(redis_client, max_age=3600):
+    """Returns a dictionary that maps process names to pool stats
+    reported during the last `max_age` seconds. Older reports are removed.
+    """
+    pool_stats = {}
+    stale_fields = []
+    for field, value in redis_client.hgetall(POOL_STATS_KEY).iteritems():
+        stats = json.loads(value)
+        if time.time() - stats['reported_at'] > max_age:
+            stale_fields.append(field)
+        else:
+            pool_stats[field] = stats
+    if stale_fields:
+        redis_client.hdel(POOL_STATS_KEY, *stale_fields)
+    return pool_stats
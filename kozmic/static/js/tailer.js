@@ -1,16 +1,25 @@
 (function($, window, document) {
 
+    // How close (in pixels) to the top or the bottom of the page
+    // the log viewer starts fetching the previous or the next window
+    var FETCH_THRESHOLD = 1000;
+    // The maximum number of windows kept in the DOM
+    var MAX_WINDOWS = 5;
+
     function wrapLines(text, lineNumber) {
-        var i = lineNumber;
-        var result = text.replace(/\n*$/, '').replace(/^(.*)$/mg, function(match) {
-            return ('<span class="line" id="' + i + '"><a href="#' + (i++) + '" class="number">' +
-                i + '</a>' + match + '</span>');
-        });
-        return {lineNumber: i, result: result};
+        var lines = text.split('\n');
+        var result = $.map(lines, function(line, i) {
+            var n = lineNumber + i;
+            return ('<span class="line" id="' + n + '"><a href="#' + n + '" class="number">' +
+                    (n + 1) + '</a>' + line + '</span>');
+        }).join('\n');
+        return {lineNumber: lineNumber + lines.length, result: result};
     }
 
     function tail(log, url, lineNumber) {
-        var s = new WebSocket(url);
+        var isFinished = false;
+        var s = new WebSocket(url + (url.indexOf('?') == -1 ? '?' : '&') +
+                              'since=' + lineNumber);
 
         s.onopen = function() {
             console.debug('connected');
@@ -21,37 +30,171 @@
             if (data.type == 'message') {
                 $('body').scrollTop(log[0].scrollHeight + 30);
                 if (data.content != '') {
-                    var r = wrapLines(data.content, lineNumber);
+                    var r = wrapLines(data.content.replace(/\n$/, ''), data.seq);
                     lineNumber = r.lineNumber;
                     log[0].innerHTML += r.result + '\n';
                 }
+            } else if (data.type == 'truncated') {
+                log.append($('<span class="truncated"></span>').text(data.content), '\n');
             } else if (data.type == 'status' && data.content == 'finished') {
+                isFinished = true;
                 location.reload(true);
             }
         };
-        
+
         s.onerror = function(e) {
             console.error(e);
         };
 
         s.onclose = function(e) {
             console.debug('closed');
+            if (!isFinished) {
+                // Reconnect and receive only the lines we have missed
+                setTimeout(function() { tail(log, url, lineNumber); }, 2000);
+            }
         };
     }
 
+    // Shows a finished job log by windows of lines. Initially the log
+    // contains the last window rendered by the server; other windows are
+    // fetched from `data-lines-url` while scrolling or following a line
+    // anchor. Only the MAX_WINDOWS windows around the visible part of
+    // the log are kept in the DOM.
+    function LogViewer(log) {
+        this.log = log;
+        this.url = log.data('lines-url');
+        this.lineCount = log.data('line-count');
+        this.windowSize = log.data('window-size');
+        this.isFetching = false;
+
+        var viewer = this;
+        log.children('.log-window').each(function() {
+            viewer.wrapWindow($(this));
+        });
+        $(window).on('scroll', function() { viewer.onScroll(); });
+        $(window).on('hashchange', function() { viewer.showAnchor(); });
+        this.showAnchor();
+    }
+
+    LogViewer.prototype.wrapWindow = function(logWindow) {
+        if (logWindow.data('end') > logWindow.data('start')) {
+            logWindow.html(wrapLines(logWindow.html(), logWindow.data('start')).result);
+        }
+    };
+
+    LogViewer.prototype.createWindow = function(data) {
+        var logWindow = $('<span class="log-window"></span>');
+        logWindow.data('start', data.start).data('end', data.end);
+        logWindow.html(data.html);
+        this.wrapWindow(logWindow);
+        return logWindow;
+    };
+
+    LogViewer.prototype.getStart = function() {
+        return this.log.children('.log-window').first().data('start');
+    };
+
+    LogViewer.prototype.getEnd = function() {
+        return this.log.children('.log-window').last().data('end');
+    };
+
+    LogViewer.prototype.fetch = function(params, callback) {
+        var viewer = this;
+        this.isFetching = true;
+        $.getJSON(this.url, params).done(function(data) {
+            viewer.lineCount = data.line_count;
+            callback(data);
+        }).always(function() {
+            viewer.isFetching = false;
+        });
+    };
+
+    LogViewer.prototype.fetchPrevious = function() {
+        var viewer = this;
+        var end = this.getStart();
+        this.fetch({start: Math.max(end - this.windowSize, 0), end: end}, function(data) {
+            var $document = $(document);
+            var height = $document.height();
+            viewer.log.prepend(viewer.createWindow(data));
+            // Keep the visible lines in place
+            $document.scrollTop($document.scrollTop() + $document.height() - height);
+            var windows = viewer.log.children('.log-window');
+            if (windows.length > MAX_WINDOWS) {
+                windows.last().remove();
+            }
+        });
+    };
+
+    LogViewer.prototype.fetchNext = function() {
+        var viewer = this;
+        this.fetch({start: this.getEnd()}, function(data) {
+            viewer.log.append(viewer.createWindow(data));
+            var windows = viewer.log.children('.log-window');
+            if (windows.length > MAX_WINDOWS) {
+                var $document = $(document);
+                var height = $document.height();
+                windows.first().remove();
+                $document.scrollTop($document.scrollTop() + $document.height() - height);
+            }
+        });
+    };
+
+    LogViewer.prototype.onScroll = function() {
+        if (this.isFetching) {
+            return;
+        }
+        var $window = $(window);
+        var top = this.log.offset().top;
+        var bottom = top + this.log.outerHeight();
+        if (this.getStart() > 0 &&
+                $window.scrollTop() - top < FETCH_THRESHOLD) {
+            this.fetchPrevious();
+        } else if (this.getEnd() < this.lineCount &&
+                   bottom - ($window.scrollTop() + $window.height()) < FETCH_THRESHOLD) {
+            this.fetchNext();
+        }
+    };
+
+    LogViewer.prototype.showAnchor = function() {
+        var lineNumber = parseInt(window.location.hash.substr(1), 10);
+        if (isNaN(lineNumber) || lineNumber < 0 || lineNumber >= this.lineCount) {
+            return;
+        }
+        var scrollToLine = function() {
+            document.getElementById(lineNumber).scrollIntoView();
+        };
+        if (lineNumber >= this.getStart() && lineNumber < this.getEnd()) {
+            scrollToLine();
+            return;
+        }
+        // The line is not loaded: replace the log content with
+        // the window that has the line in the middle
+        var viewer = this;
+        var start = Math.max(lineNumber - Math.floor(this.windowSize / 2), 0);
+        this.fetch({start: start}, function(data) {
+            viewer.log.empty().append(viewer.createWindow(data));
+            scrollToLine();
+        });
+    };
+
     $(function() {
         $('.job-log').each(function() {
             var $this = $(this);
 
+            if ($this.data('lines-url') !== undefined) {
+                new LogViewer($this);
+                return;
+            }
+
             var lineNumber = 0;
             $this.html(function(_, oldText) {
                 if (oldText != '') {
-                    var r = wrapLines(oldText, lineNumber);
+                    var r = wrapLines(oldText.replace(/\n$/, ''), lineNumber);
                     lineNumber = r.lineNumber;
                     return r.result;
                 }
             });
-            
+
             var tailerUrl = $this.data('tailer-url');
             if (tailerUrl !== undefined) {
                 tail($this, tailerUrl, lineNumber);
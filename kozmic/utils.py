@@ -2,7 +2,11 @@
 kozmic.utils
 ~~~~~~~~~~~~
 """
+import os
 import json
+import fcntl
+import contextlib
+import multiprocessing
 
 from sqlalchemy import types
 
@@ -20,3 +24,25 @@ class JSONEncodedDict(types.TypeDecorator):
         if value is not None:
             value = json.loads(value)
         return value
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on `path` file, creating it if necessary."""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_worker_slots(cpus_per_job, memory_per_job):
+    """Returns how many jobs the host can run at once, given that
+    a job needs `cpus_per_job` CPUs and `memory_per_job` MiB of memory.
+    Always returns at least 1.
+    """
+    cpus = multiprocessing.cpu_count()
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2 ** 20
+    return max(1, min(int(cpus // cpus_per_job),
+                      int(memory // memory_per_job)))
@@ -11,6 +11,9 @@ import kozmic.builds.commands
 manager = Manager(kozmic.create_app)
 manager.add_command('db', MigrateCommand)
 manager.command(kozmic.builds.commands.clean_dependencies_cache)
+manager.command(kozmic.builds.commands.show_log_buffers)
+manager.command(kozmic.builds.commands.show_redis_pools)
+manager.command(kozmic.builds.commands.show_scheduler_queues)
 
 
 if __name__ == '__main__':
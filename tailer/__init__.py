@@ -4,14 +4,40 @@ Tailer
 An WSGI-application that watches a Redis pub/sub channel and streams it's
 content to a websocket.
 
-The application exposes only one endpoint: `/<channel-name>/`.
+The application exposes only one endpoint: `/<channel-name>/?since=<seq>`.
 
 It does the following:
 
-1. Retrieves a list of strings stored at the `channel-name` *key* and sends
-   it to the websocket;
-2. Subscribes to the `channel-name` pub/sub *channel* and streams it's content
-   to the websocket while the `channel-name` *key* exists in Redis database.
+1. Subscribes to the `channel-name` pub/sub *channel*;
+2. Retrieves a list of lines stored at the `channel-name` *key*, starting from
+   the line number `since` (zero by default), and sends it to the websocket
+   in chunks of :data:`BACKLOG_CHUNK_SIZE` lines;
+3. Streams the channel content to the websocket until the end of stream
+   message (:data:`kozmic.builds.messages.END_OF_STREAM`) is received.
+   As a fallback for workers that have died without sending it, the stream
+   also ends once the `channel-name` *key* disappears from Redis database.
+
+Lists of running jobs are capped (see :class:`kozmic.builds.tasks.Publisher`).
+If the requested lines have been trimmed, a ``truncated`` message is sent
+instead of them.
+
+Every websocket message carries the number of its first line (``seq``).
+Channel messages carry line numbers too (see :mod:`kozmic.builds.messages`),
+so the messages received while the backlog was being sent are deduplicated
+and none are lost. A client that has been disconnected can reconnect
+with ``since`` set to the number of lines it has already received.
+
+Each worker process has a single Redis pub/sub connection shared by all its
+websockets (see :class:`Multiplexer`), so the number of Redis connections
+depends on the number of running jobs rather than on the number of viewers.
+Other commands use a connection pool configured by ``KOZMIC_REDIS_*``
+settings (see :mod:`kozmic.redis_utils`). If the pool size is limited,
+the limit must not be less than the number of gevent greenlets.
+
+Redis contains raw job log with ANSI sequences. It is translated to HTML
+by a :class:`kozmic.builds.ansi.AnsiToHtmlConverter` that lives as long as
+the websocket connection, so colors spanning multiple messages are preserved.
+Therefore the :mod:`kozmic` package and its requirements must be importable.
 
 The implementation heavily rely on the uwsgi functionality. The app can be started
 using the following command string::
@@ -26,31 +52,196 @@ Do not use ``--http :9090``, because it breaks websockets ping/pong.
 import os
 import re
 import json
+import time
+import urlparse
+import socket
+import logging
 
 import uwsgi
 import redis
-import gevent.select
+import gevent
+import gevent.event
+import gevent.queue
+import gevent.socket
 from werkzeug.utils import import_string
 
+from kozmic.config import DefaultConfig
+from kozmic.redis_utils import (create_connection_pool, get_pool_options,
+                                report_pool_stats)
+from kozmic.builds import messages
+from kozmic.builds.ansi import AnsiToHtmlConverter
+
 
 if 'KOZMIC_CONFIG' in os.environ:
     config = import_string(os.environ['KOZMIC_CONFIG'])
-    redis_host = config.KOZMIC_REDIS_HOST
-    redis_port = config.KOZMIC_REDIS_PORT
-    redis_db = config.KOZMIC_REDIS_DATABASE
 else:
-    redis_host = os.environ['REDIS_HOST']
-    redis_port = os.environ['REDIS_PORT']
-    redis_db = os.environ['REDIS_DATABASE']
+    class config(DefaultConfig):
+        KOZMIC_REDIS_HOST = os.environ['REDIS_HOST']
+        KOZMIC_REDIS_PORT = os.environ['REDIS_PORT']
+        KOZMIC_REDIS_DATABASE = os.environ['REDIS_DATABASE']
+
+logger = logging.getLogger(__name__)
+
+redis_client = redis.StrictRedis(connection_pool=create_connection_pool(
+    **get_pool_options(dict(
+        (name, getattr(config, name)) for name in dir(config)
+        if name.startswith('KOZMIC_REDIS_')))))
+
+
+class Multiplexer(object):
+    """Fans messages of Redis pub/sub channels out to local subscribers.
+
+    All the subscriptions share one pub/sub connection, which is read by
+    a single greenlet. Every :meth:`subscribe` call returns a new
+    :class:`gevent.queue.Queue` that receives channel messages.
+    Subscriptions are reference-counted: a Redis channel is unsubscribed
+    once its last queue is unsubscribed.
+
+    The connection is opened by the first :meth:`subscribe` call, so
+    it belongs to the worker process even if the module has been imported
+    by the uWSGI master.
+
+    :param redis_client: Redis client
+    :type redis_client: redis.StrictRedis
+    """
+    def __init__(self, redis_client):
+        self._redis_client = redis_client
+        self._own_channel = None
+        self._pubsub = None
+        self._queues = {}
+        self._listener = None
+
+    def _connect(self):
+        self._pubsub = self._redis_client.pubsub()
+        # Stay subscribed to a channel of our own, otherwise redis-py
+        # drops the connection as soon as the number of subscriptions
+        # reaches zero, which races with the following subscriptions
+        self._pubsub.subscribe([self._own_channel] + list(self._queues))
+
+    def subscribe(self, channel):
+        """Returns a queue that receives messages of `channel`."""
+        if self._listener is None:
+            self._own_channel = 'tailer:{}:{}'.format(
+                socket.gethostname(), os.getpid())
+            self._connect()
+            self._listener = gevent.spawn(self._listen)
+
+        queue = gevent.queue.Queue()
+        if channel not in self._queues:
+            self._queues[channel] = set()
+            self._execute(self._pubsub.subscribe, channel)
+        self._queues[channel].add(queue)
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        """Stops sending messages of `channel` to `queue`."""
+        queues = self._queues.get(channel)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._queues[channel]
+            self._execute(self._pubsub.unsubscribe, channel)
+
+    def _execute(self, command, channel):
+        try:
+            command(channel)
+        except redis.ConnectionError:
+            # The listener will reconnect and subscribe
+            # to the right set of channels
+            pass
+
+    def _listen(self):
+        while True:
+            try:
+                for message in self._pubsub.listen():
+                    if message['type'] == 'message':
+                        for queue in self._queues.get(message['channel'], ()):
+                            queue.put(message['data'])
+            except redis.ConnectionError:
+                logger.exception('Lost connection to Redis, reconnecting...')
+                while True:
+                    gevent.sleep(1)
+                    try:
+                        self._connect()
+                    except redis.ConnectionError:
+                        continue
+                    break
 
-redis = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db)
 
+multiplexer = Multiplexer(redis_client)
 
-def send_message(type, content):
-    uwsgi.websocket_send(json.dumps({
-        'type': type,
-        'content': content,
-    }))
+#: Put to a connection queue when there is data to read from the websocket
+WEBSOCKET_IS_READABLE = object()
+
+#: The maximum number of backlog lines read from Redis and sent at once
+BACKLOG_CHUNK_SIZE = 1000
+
+#: Number of seconds between checks whether the job log key still exists
+JOB_CHECK_INTERVAL = 30
+
+#: Content of the ``truncated`` message
+TRUNCATION_MESSAGE = (
+    'The log is truncated: {} lines are not shown. The full log is '
+    'available on the job page once the job has finished.')
+
+# Returns the number of trimmed lines and up to ARGV[2] lines of the KEYS[1]
+# list starting from the line number ARGV[1]. Reading the offset and the
+# lines atomically guarantees that the list has not been trimmed in between
+read_lines = redis_client.register_script('''
+local offset = tonumber(redis.call('HGET', KEYS[2], 'offset') or 0)
+local start = math.max(tonumber(ARGV[1]) - offset, 0)
+local lines = redis.call('LRANGE', KEYS[1], start, start + tonumber(ARGV[2]) - 1)
+return {offset, lines}
+''')
+
+
+def decode(log):
+    return log.decode('utf-8', 'replace')
+
+
+def send_message(type, content, **kwargs):
+    kwargs.update(type=type, content=content)
+    uwsgi.websocket_send(json.dumps(kwargs))
+
+
+def send_backlog(job_id, converter, start, end=None):
+    """Sends lines of the `job_id` list from `start` to `end` (`end`
+    is not included) in chunks of :data:`BACKLOG_CHUNK_SIZE` lines.
+    Returns the number of the line following the last sent one.
+    """
+    seq = start
+    while end is None or seq < end:
+        count = BACKLOG_CHUNK_SIZE
+        if end is not None:
+            count = min(count, end - seq)
+        offset, lines = read_lines(
+            keys=[job_id, messages.get_meta_key(job_id)], args=[seq, count])
+        if seq < offset:
+            send_message('truncated', TRUNCATION_MESSAGE.format(offset - seq),
+                         seq=seq)
+            seq = offset
+            if end is not None:
+                lines = lines[:max(end - seq, 0)]
+        if lines:
+            send_message('message', converter.feed(decode(''.join(lines))),
+                         seq=seq)
+            seq += len(lines)
+        if len(lines) < count:
+            # The end of the list has been reached
+            break
+    return seq
+
+
+def watch_websocket(websocket_fd, queue, processed):
+    """Puts :data:`WEBSOCKET_IS_READABLE` to `queue` whenever there is
+    data to read from the websocket and waits for `processed` to be set.
+    """
+    while True:
+        gevent.socket.wait_read(websocket_fd)
+        processed.clear()
+        queue.put(WEBSOCKET_IS_READABLE)
+        processed.wait()
 
 
 def app(environ, start_response):
@@ -62,39 +253,72 @@ def app(environ, start_response):
     uwsgi.websocket_handshake(environ['HTTP_SEC_WEBSOCKET_KEY'],
                               environ.get('HTTP_ORIGIN', ''))
     
-    # Emit the backlog of messages
-    lines = redis.lrange(job_id, 0, -1)
-    send_message('message', ''.join(lines))
+    try:
+        since = max(int(urlparse.parse_qs(
+            environ.get('QUERY_STRING', '')).get('since', ['0'])[0]), 0)
+    except ValueError:
+        since = 0
 
-    channel = redis.pubsub()
-    channel.subscribe(job_id)
-    channel_socket_fd = channel.connection._sock.fileno()
-    websocket_fd = uwsgi.connection_fd()
+    converter = AnsiToHtmlConverter()
 
-    while True:
-        rlist, _, _ = gevent.select.select(
-            [channel_socket_fd, websocket_fd], [], [], 5.0)
-        if rlist:
-            for fd in rlist:
-                if fd == channel_socket_fd:
-                    message = channel.parse_response()
-                    # See http://redis.io/topics/pubsub for format of `message`
-                    if message[0] == 'message':
-                        send_message('message', message[2])
-                elif fd == websocket_fd:
-                    # Let uwsgi do it's job to receive pong and send ping
-                    uwsgi.websocket_recv_nb()
-        else:
-            # Have not heard from the channel and the client in 5 seconds...
+    # Subscribe before reading the backlog: the messages published
+    # in the meantime are queued and deduplicated below
+    queue = multiplexer.subscribe(job_id)
+    websocket_processed = gevent.event.Event()
+    websocket_watcher = gevent.spawn(
+        watch_websocket, uwsgi.connection_fd(), queue, websocket_processed)
+    try:
+        seq = send_backlog(job_id, converter, since)
+        # The first check is done soon: the job may have finished
+        # before the websocket has been connected
+        next_job_check_at = time.time() + 5.0
+        while True:
             try:
-                # Check if the client is still here by sending ping
-                # (`websocket_recv` sends ping implicitly,
-                # `websocket_recv_nb` -- non-blocking variant of it)
-                uwsgi.websocket_recv_nb()
-            except IOError:
-                break
-            # Check if the job is still ongoing
-            if not redis.exists(job_id):
-                send_message('status', 'finished')
-                break
+                message = queue.get(timeout=5.0)
+            except gevent.queue.Empty:
+                # Have not heard from the channel and the client in 5 seconds...
+                try:
+                    # Check if the client is still here by sending ping
+                    # (`websocket_recv` sends ping implicitly,
+                    # `websocket_recv_nb` -- non-blocking variant of it)
+                    uwsgi.websocket_recv_nb()
+                except IOError:
+                    break
+                # Check if the job is still ongoing (in case its worker
+                # has died and the end of stream will never come)
+                if time.time() >= next_job_check_at:
+                    if not redis_client.exists(job_id):
+                        send_message('status', 'finished')
+                        break
+                    next_job_check_at = time.time() + JOB_CHECK_INTERVAL
+            else:
+                if message is WEBSOCKET_IS_READABLE:
+                    # Let uwsgi do it's job to receive pong and send ping
+                    try:
+                        uwsgi.websocket_recv_nb()
+                    except IOError:
+                        break
+                    websocket_processed.set()
+                elif message == messages.END_OF_STREAM:
+                    send_message('status', 'finished')
+                    break
+                else:
+                    first_seq, data = messages.decode(message)
+                    if first_seq > seq:
+                        # Lines are missing (the channel has been
+                        # resubscribed), take them from the list
+                        seq = max(send_backlog(job_id, converter, seq, first_seq),
+                                  first_seq)
+                    data = messages.skip_lines(data, seq - first_seq)
+                    if data:
+                        send_message('message', converter.feed(decode(data)),
+                                     seq=seq)
+                        seq += data.count('\n')
+    finally:
+        websocket_watcher.kill()
+        multiplexer.unsubscribe(job_id, queue)
+        try:
+            report_pool_stats(redis_client, 'tailer')
+        except redis.RedisError:
+            logger.exception('Failed to report Redis pool stats.')
     return ''
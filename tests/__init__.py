@@ -6,7 +6,7 @@ from alembic.config import Config
 from alembic.command import upgrade as alembic_upgrade
 from flask.ext.webtest import TestApp, get_scopefunc
 
-from kozmic import create_app, db
+from kozmic import create_app, db, docker_utils
 from . import factories
 
 
@@ -81,6 +81,8 @@ class WebTestMixin(object):
 class TestCase(WebTestMixin, SQLAlchemyMixin, SQLAlchemyFixtureMixin):
     def setup_method(self, method):
         self.setup_app_and_ctx()
+        # Image ids are cached per process, do not let tests share them
+        docker_utils.get_image_index().clear()
         self.drop_database()
         self.create_database()
         factories.setup(self.db.session)
@@ -1,7 +1,9 @@
 # coding: utf-8
 import os
+import time
 import tempfile
 import shutil
+import threading
 import contextlib
 
 import mock
@@ -10,7 +12,7 @@ from flask.ext.webtest import SessionScope
 
 import kozmic.builds.tasks
 from kozmic import docker
-from kozmic.models import DeployKey, Build, Job
+from kozmic.models import DeployKey, Build, Job, CacheKey
 from . import TestCase, factories, utils
 
 
@@ -38,7 +40,8 @@ class TestDoJob(TestCase):
                            'echo "installed!"',
             build_script='cat /hello/readme.txt && echo "YEAH"')
 
-    def _do_job(self, hook_call):
+    @contextlib.contextmanager
+    def _mock_job_environment(self, cache_id='qwerty'):
         @contextlib.contextmanager
         def create_temp_dir():
             working_dir = tempfile.mktemp()
@@ -46,11 +49,15 @@ class TestDoJob(TestCase):
             yield working_dir
             shutil.rmtree(working_dir)
 
+        with mock.patch.object(Build, 'set_status'), \
+             mock.patch.object(DeployKey, 'ensure') as ensure_deploy_key_mock, \
+             mock.patch.object(Job, 'get_stage_cache_ids', return_value=[cache_id]), \
+             mock.patch('kozmic.builds.tasks.create_temp_dir', create_temp_dir):
+            yield ensure_deploy_key_mock
+
+    def _do_job(self, hook_call):
         with SessionScope(self.db):
-            with mock.patch.object(Build, 'set_status'), \
-                 mock.patch.object(DeployKey, 'ensure') as ensure_deploy_key_mock, \
-                 mock.patch.object(Job, 'get_cache_id', return_value='qwerty'), \
-                 mock.patch('kozmic.builds.tasks.create_temp_dir', create_temp_dir):
+            with self._mock_job_environment() as ensure_deploy_key_mock:
                 kozmic.builds.tasks.do_job(hook_call_id=hook_call.id)
         self.db.session.rollback()
 
@@ -59,10 +66,8 @@ class TestDoJob(TestCase):
 
         return Job.query.filter_by(hook_call=hook_call).first()
 
-    def test_private_project(self):
-        cache_id = 'qwerty'
+    def _remove_cached_image(self, cache_id):
         cached_image = 'kozmic-cache/{}'.format(cache_id)
-
         try:
             for image_data in docker.images(cached_image):
                 for repo_tag in image_data['RepoTags']:
@@ -73,6 +78,11 @@ class TestDoJob(TestCase):
             pass
         assert not docker.images(cached_image)
 
+    def test_private_project(self):
+        cache_id = 'qwerty'
+        cached_image = 'kozmic-cache/{}'.format(cache_id)
+        self._remove_cached_image(cache_id)
+
         build = factories.BuildFactory.create(
             project=self.project,
             gh_commit_sha=self.prev_head_sha)
@@ -82,8 +92,8 @@ class TestDoJob(TestCase):
 
         job = self._do_job(hook_call)
         assert job.return_code == 0
-        assert job.stdout == (
-            'Pulling "{}" Docker image...\n'
+        assert job.get_log() == (
+            'Pulling "{}" Docker image (pull policy: always)...\n'
              'installed!\nit works\nYEAH\n'.format(self.hook.docker_image))
         assert docker.images(cached_image)
 
@@ -96,12 +106,60 @@ class TestDoJob(TestCase):
 
         job = self._do_job(hook_call)
         assert job.return_code == 0
-        assert job.stdout == (
-            'Pulling "{}" Docker image...\n'
+        assert job.get_log() == (
+            'Pulling "{}" Docker image (pull policy: always)...\n'
             'Skipping install script as tracked files did not change...\n'
             'it works\n'
             'YEAH\n'.format(self.hook.docker_image))
 
+    def test_concurrent_jobs_of_the_same_commit(self):
+        self._remove_cached_image('shared')
+        # Make sure the jobs overlap
+        self.hook.install_script = self.hook.install_script + '\nsleep 5'
+        self.db.session.commit()
+
+        # Push and pull request events of the same commit
+        hook_calls = []
+        for ref in ('master', 'feature'):
+            build = factories.BuildFactory.create(
+                project=self.project,
+                gh_commit_ref=ref,
+                gh_commit_sha=self.prev_head_sha)
+            hook_calls.append(factories.HookCallFactory.create(
+                hook=self.hook,
+                build=build))
+
+        # Every thread runs the task in its own application
+        # context and database session
+        threads = [
+            threading.Thread(target=kozmic.builds.tasks.do_job,
+                             kwargs={'hook_call_id': hook_call.id})
+            for hook_call in hook_calls]
+        with self._mock_job_environment(cache_id='shared'):
+            for thread in threads:
+                thread.start()
+                time.sleep(1)
+            for thread in threads:
+                thread.join()
+        self.db.session.rollback()
+
+        jobs = [Job.query.filter_by(hook_call=hook_call).one()
+                for hook_call in hook_calls]
+        assert [job.return_code for job in jobs] == [0, 0]
+        # Both jobs use the same cache key
+        assert CacheKey.query.count() == 1
+
+        # Only the first job has run the install script,
+        # the second one has waited for it
+        building_job, waiting_job = jobs
+        assert 'installed!' in building_job.get_log()
+        assert waiting_job.get_log() == (
+            'Pulling "{}" Docker image (pull policy: always)...\n'
+            'Waiting for dependency cache built by job #{}...\n'
+            'Using dependency cache built by another job.\n'
+            'it works\n'
+            'YEAH\n'.format(self.hook.docker_image, building_job.id))
+
     def test_public_project(self):
         self.hook.install_script = ''
         self.hook.build_script = 'echo Hello!'
@@ -118,8 +176,8 @@ class TestDoJob(TestCase):
 
         job = self._do_job(hook_call)
         assert job.return_code == 0
-        assert job.stdout == (
-            'Pulling "{}" Docker image...\n'
+        assert job.get_log() == (
+            'Pulling "{}" Docker image (pull policy: always)...\n'
             'Hello!\n'.format(self.hook.docker_image))
 
     def teardown_method(self, method):
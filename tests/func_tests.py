@@ -9,7 +9,8 @@ import github3.repos
 import github3.git
 from flask import url_for
 
-from kozmic.models import User, DeployKey, Project, Hook
+from kozmic.models import db, User, DeployKey, Project, Hook, CacheKey
+from kozmic.builds.logs import JobLogWriter
 from . import TestCase, func_fixtures as fixtures
 from . import factories, unit_tests
 
@@ -336,6 +337,26 @@ class TestHooksManagement(TestCase):
         # Ensure the changes are saved
         assert hook_1.title == 'PEP 8 check'
         assert hook_1.build_script == '#!/bin/sh\npep8 app.py'
+        assert not hook_1.shallow_clone
+
+        hook_form['shallow_clone'] = True
+        hook_form['sparse_checkout_paths'] = 'src\r\ndocs'
+        hook_form.submit()
+
+        assert hook_1.shallow_clone
+        assert not hook_1.single_branch
+        assert hook_1.sparse_checkout_paths == 'src\ndocs'
+
+        # Memoized cache ids of the hook are invalidated
+        cache_key = CacheKey(
+            hook=hook_1, install_script_hash='hash', docker_image_id='id',
+            gh_commit_sha='sha', cache_id='cache-id',
+            docker_image='kozmic-cache/cache-id:1')
+        db.session.add(cache_key)
+        db.session.commit()
+        hook_form['tracked_files'] = 'requirements.txt'
+        hook_form.submit()
+        assert not hook_1.cache_keys.count()
 
         # Trying to submit form without required field
         hook_form['title'] = ''
@@ -428,6 +449,38 @@ class TestHooksManagement(TestCase):
             'Pumpurum.txt',
         }
 
+    def test_manager_can_change_install_stages_in_hook_settings(self):
+        """Manager can add, change and remove install stages."""
+        hook = factories.HookFactory.create(project=self.project)
+        self.login(user_id=self.user.id)
+        settings_page = self.get_project_settings_page(self.project)
+        link_id = 'edit-hook-{}'.format(hook.id)
+
+        # There is a blank stage to be filled in
+        hook_form = settings_page.click(linkid=link_id).forms['hook-form']
+        hook_form['install_stages-0-script'] = '#!/bin/bash\r\nnpm install'
+        hook_form['install_stages-0-tracked_files'] = 'package.json'
+        hook_form.submit()
+
+        assert [(stage.number, stage.script, stage.get_tracked_paths())
+                for stage in hook.install_stages] == [
+            (1, '#!/bin/bash\nnpm install', ['package.json'])]
+
+        hook_form = settings_page.click(linkid=link_id).forms['hook-form']
+        assert hook_form['install_stages-0-script'].value == (
+            '#!/bin/bash\nnpm install')
+        hook_form['install_stages-1-script'] = '#!/bin/bash\r\nbower install'
+        hook_form.submit()
+        assert hook.install_stages.count() == 2
+
+        # Stages with empty scripts are removed and the rest are renumbered
+        hook_form = settings_page.click(linkid=link_id).forms['hook-form']
+        hook_form['install_stages-0-script'] = ''
+        hook_form.submit()
+        assert [(stage.number, stage.script)
+                for stage in hook.install_stages] == [
+            (1, '#!/bin/bash\nbower install')]
+
 
 class TestMembersManagement(TestCase):
     def setup_method(self, method):
@@ -506,7 +559,7 @@ class TestGitHubHooks(TestCase):
         head_sha = commit_data['sha']
 
         with mock.patch.object(Project, 'gh', gh_repo_mock), \
-             mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+             mock.patch('kozmic.builds.tasks.enqueue_job') as enqueue_job_mock:
             r = self.w.post_json(
                 url_for('builds.hook', id=self.hook_1.id, _external=True),
                 fixtures.PULL_REQUEST_HOOK_CALL_DATA)
@@ -530,11 +583,11 @@ class TestGitHubHooks(TestCase):
         assert build.gh_commit_message == commit_data['message']
         assert build.gh_commit_author == commit_data['author']['name']
 
-        do_job_mock.delay.assert_called_once_with(hook_call_id=hook_call.id)
+        enqueue_job_mock.assert_called_once_with(hook_call_id=hook_call.id)
 
     def test_github_ping_event(self):
         with mock.patch.object(Project, 'gh'), \
-             mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+             mock.patch('kozmic.builds.tasks.enqueue_job') as enqueue_job_mock:
             url = url_for('builds.hook', id=self.hook_1.id, _external=True)
             r = self.w.post_json(url, {
                 'zen': 'Hello!',
@@ -554,7 +607,7 @@ class TestGitHubHooks(TestCase):
         head_sha = commit_data['sha']
 
         with mock.patch.object(Project, 'gh', gh_repo_mock), \
-             mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+             mock.patch('kozmic.builds.tasks.enqueue_job') as enqueue_job_mock:
             push_hook_call_data = copy.deepcopy(fixtures.PUSH_HOOK_CALL_DATA)
             push_hook_call_data['ref'] = 'refs/heads/{}'.format(
                 fixtures.PULL_REQUEST_HOOK_CALL_DATA['pull_request']['head']['ref'])
@@ -576,9 +629,9 @@ class TestGitHubHooks(TestCase):
         assert self.hook_2.calls.count() == 1
         assert build.number == 1  # Make sure that second hook call hasn't
                                   # increased build number
-        assert do_job_mock.delay.call_count == 2
-        assert mock.call(hook_call_id=hook_call_1.id) in do_job_mock.delay.call_args_list
-        assert mock.call(hook_call_id=hook_call_2.id) in do_job_mock.delay.call_args_list
+        assert enqueue_job_mock.call_count == 2
+        assert mock.call(hook_call_id=hook_call_1.id) in enqueue_job_mock.call_args_list
+        assert mock.call(hook_call_id=hook_call_2.id) in enqueue_job_mock.call_args_list
 
 
 class TestBadges(TestCase):
@@ -654,3 +707,80 @@ class TestBuilds(TestCase):
             r.click('Restart').follow()
         restart_job_mock.delay.assert_called_once_with(job.id)
         assert job.build.status == 'enqueued'
+
+    def test_log(self):
+        job = factories.JobFactory.create(
+            build=self.build,
+            hook_call=self.hook_call,
+            started_at=dt.datetime.utcnow() - dt.timedelta(minutes=2),
+            finished_at=dt.datetime.utcnow())
+        log_writer = JobLogWriter(db.engine, job.id, chunk_size=8)
+        log_writer.write(''.join('line {}\n'.format(i) for i in xrange(1, 11)))
+        log_writer.close()
+        log_url = url_for('projects.job_log', project_id=self.project.id,
+                          id=job.id)
+
+        self.login(user_id=self.user.id)
+        r = self.w.get(log_url)
+        assert r.headers['Accept-Ranges'] == 'bytes'
+        assert r.content_length == 71
+        assert r.body.startswith('line 1\nline 2\n')
+        assert r.body.endswith('line 9\nline 10\n')
+
+        r = self.w.get(log_url + '?tail=2')
+        assert r.body == 'line 9\nline 10\n'
+
+        r = self.w.get(log_url + '?from_line=9')
+        assert r.body == 'line 9\nline 10\n'
+
+        r = self.w.get(log_url, headers={'Range': 'bytes=7-12'})
+        assert r.status_code == 206
+        assert r.headers['Content-Range'] == 'bytes 7-12/71'
+        assert r.body == 'line 2'
+
+        r = self.w.get(log_url, headers={'Range': 'bytes=-3'})
+        assert r.status_code == 206
+        assert r.body == '10\n'
+
+        r = self.w.get(log_url, headers={'Range': 'bytes=100-'},
+                       expect_errors=True)
+        assert r.status_code == 416
+        assert r.headers['Content-Range'] == 'bytes */71'
+
+    def test_log_window(self):
+        self.app.config['KOZMIC_LOG_WINDOW_SIZE'] = 3
+        job = factories.JobFactory.create(
+            build=self.build,
+            hook_call=self.hook_call,
+            started_at=dt.datetime.utcnow() - dt.timedelta(minutes=2),
+            finished_at=dt.datetime.utcnow())
+        log_writer = JobLogWriter(db.engine, job.id, chunk_size=8)
+        log_writer.write(''.join('line {}\n'.format(i) for i in xrange(1, 11)))
+        log_writer.write('\x1b[4mThe end\x1b[24m\n')
+        log_writer.close()
+
+        # The page shows the last window
+        self.login(user_id=self.user.id)
+        r = self.w.get(url_for('projects.job', project_id=self.project.id,
+                               build_id=self.build.id, id=job.id))
+        log = r.lxml.cssselect('.job-log')[0]
+        assert log.get('data-line-count') == '11'
+        log_window = log.cssselect('.log-window')[0]
+        assert log_window.get('data-start') == '8'
+        assert log_window.get('data-end') == '11'
+        assert 'line 8' not in r
+        assert 'line 9\nline 10\n<span class="ansi4">The end</span><' in r
+
+        lines_url = url_for('projects.job_log_lines',
+                            project_id=self.project.id, id=job.id)
+        r = self.w.get(lines_url, {'start': 2, 'end': 4})
+        assert r.json == {
+            'start': 2,
+            'end': 4,
+            'line_count': 11,
+            'html': 'line 3\nline 4',
+        }
+
+        # The window size is limited
+        r = self.w.get(lines_url, {'start': 0, 'end': 100})
+        assert r.json['html'] == 'line 1\nline 2\nline 3'
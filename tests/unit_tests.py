@@ -1,28 +1,45 @@
 # coding: utf-8
 import os
+import re
 import time
 import unittest
 import tempfile
 import Queue
 import datetime as dt
-import hashlib
 import json
+import subprocess
+import threading
+import SocketServer
+import BaseHTTPServer
 
+import ansi2html
 import docker as _docker
 import httpretty
 import pytest
 import redis
 import mock
 import github3
-from flask import current_app, url_for
+from flask import current_app, url_for, _app_ctx_stack
 from flask.ext.principal import Need
 from flask.ext.webtest import SessionScope
 
 import kozmic.builds.tasks
 import kozmic.builds.views
-from kozmic import mail, docker, docker_utils
+import kozmic.utils
+from kozmic.builds import messages
+from kozmic.builds.ansi import AnsiToHtmlConverter, ansi_to_html
+from kozmic.builds.follower import LogFollower
+from kozmic.builds.logs import JobLogWriter
+from kozmic.builds.mirrors import update_git_mirror, GitMirrorError, _git_env
+from kozmic.builds.ssh import KnownHostsCache, get_known_hosts
+from kozmic.builds.locks import CacheBuildLock, single_flight
+from kozmic.builds.trees import (get_tracked_file_shas_from_mirror,
+                                 get_tracked_file_shas_from_github, TreeError)
+from kozmic.builds.rendering import LRUCache, JobLogRenderer
+from kozmic import mail, docker, docker_utils, redis_utils, celery
 from kozmic.models import (db, DeployKey, Project, Membership, User, Hook,
-                           HookCall, Job, Build, TrackedFile)
+                           HookCall, Job, Build, TrackedFile, CacheKey,
+                           InstallStage)
 from . import TestCase, factories, func_fixtures, utils, unit_fixtures as fixtures
 
 
@@ -549,6 +566,29 @@ class TestHookDB(TestCase):
         for hook_call in hook_calls:
             assert hook_call.hook_id is None
 
+    def test_get_checkout_options(self):
+        user = factories.UserFactory.create()
+        project = factories.ProjectFactory.create(owner=user)
+        hook = factories.HookFactory.create(project=project)
+
+        assert hook.get_checkout_options('master') == {
+            'ref': 'master',
+            'shallow': False,
+            'single_branch': False,
+            'sparse_paths': [],
+        }
+
+        hook.shallow_clone = True
+        hook.sparse_checkout_paths = 'docs\n\n  src/app \n'
+        db.session.commit()
+
+        assert hook.get_checkout_options('feature') == {
+            'ref': 'feature',
+            'shallow': True,
+            'single_branch': False,
+            'sparse_paths': ['docs', 'src/app'],
+        }
+
 
 KOZMIC_BLUES = '''
 Time keeps movin' on,
@@ -590,10 +630,10 @@ class TestTailer(TestCase):
             # {'channel': 'test', 'data': 1L, 'pattern': None, 'type': 'subscribe'}
             listener.next()
 
-            for line in KOZMIC_BLUES.split('\n'):
+            for i, line in enumerate(KOZMIC_BLUES.split('\n')):
                 f.write(line + '\n')
                 f.flush()
-                assert listener.next()['data'] == line + '\n'
+                assert listener.next()['data'] == messages.encode(i, line + '\n')
 
         time.sleep(.5)
         assert KOZMIC_BLUES + '\n' == ''.join(redis_client.lrange('test', 0, -1))
@@ -613,25 +653,307 @@ class TestTailer(TestCase):
                 time.sleep(2)
             kill_container_mock.assert_called_once_with()
 
+    def test_kill_timeout_is_reset_by_incomplete_lines(self):
+        with tempfile.NamedTemporaryFile(mode='a+b') as f:
+            tailer = self._Tailer(
+                log_path=f.name,
+                publisher=mock.MagicMock(),
+                container={'Id': '564fe66af3aa755d79797e1'},
+                kill_timeout=1)
+
+            with mock.patch.object(tailer, '_kill_container') as kill_container_mock:
+                tailer.start()
+                # A progress bar that is redrawn for longer than the timeout
+                for i in range(8):
+                    f.write('{}%\r'.format(i * 10))
+                    f.flush()
+                    time.sleep(.3)
+                assert not kill_container_mock.called
+                time.sleep(2)
+            kill_container_mock.assert_called_once_with()
+
+
+class TestLogFollower(object):
+    def test_read_lines(self):
+        with tempfile.NamedTemporaryFile(mode='a+b') as f:
+            follower = LogFollower(f.name, poll_interval=0.1)
+            try:
+                assert follower.read_lines() == []
+
+                f.write('first\nsecond\nthi')
+                f.flush()
+                assert follower.read_lines() == ['first', 'second']
+
+                f.write('rd\nfourth')
+                f.flush()
+                assert follower.read_lines() == ['third']
+                assert follower.read_lines(final=True) == ['fourth']
+                assert follower.offset == len('first\nsecond\nthird\nfourth')
+            finally:
+                follower.close()
+
+    def test_final_read_ignores_max_read_size(self):
+        with tempfile.NamedTemporaryFile(mode='a+b') as f:
+            follower = LogFollower(f.name, poll_interval=0.1,
+                                   max_read_size=100)
+            try:
+                f.write(''.join('line {}\n'.format(i) for i in range(50)))
+                f.write('last')
+                f.flush()
+                assert follower.read_lines() == [
+                    'line {}'.format(i) for i in range(13)]
+                assert follower.has_unread_data()
+
+                assert follower.read_lines(final=True) == [
+                    'line {}'.format(i) for i in range(13, 50)] + ['last']
+                assert not follower.has_unread_data()
+            finally:
+                follower.close()
+
+    def test_wait(self):
+        with tempfile.NamedTemporaryFile(mode='a+b') as f:
+            follower = LogFollower(f.name, poll_interval=0.1)
+            try:
+                started_at = time.time()
+                follower.wait(0.3)
+                assert time.time() - started_at >= 0.25
+
+                f.write('line\n')
+                f.flush()
+                started_at = time.time()
+                follower.wait(5)
+                assert time.time() - started_at < 1
+                assert follower.read_lines() == ['line']
+            finally:
+                follower.close()
+
+
+class TestAnsiToHtmlConverter(object):
+    def test_state_is_carried_across_lines_and_chunks(self):
+        converter = AnsiToHtmlConverter()
+        assert converter.feed('\x1b[1;31mred\nstill ') == (
+            '<span class="ansi1 ansi31">red</span>\n'
+            '<span class="ansi1 ansi31">still </span>')
+        assert converter.feed('red\x1b[0m <plain>\n') == (
+            '<span class="ansi1 ansi31">red</span> &lt;plain&gt;\n')
+
+    def test_split_escape_sequence(self):
+        converter = AnsiToHtmlConverter()
+        assert converter.feed('a\x1b[3') == 'a'
+        assert converter.feed('6mb\x1b[K\x1b[0m') == '<span class="ansi36">b</span>'
+        assert ansi_to_html('c\x1b[3') == 'c\x1b[3'
+
+    def test_compatibility_with_ansi2html(self):
+        ansi = ('\x1b[4mRunning "jshint:lib" (jshint) task\x1b[24m\n'
+                '\x1b[38;5;208morange\x1b[7m negative\x1b[m & plain\n'
+                '\x1b[1;32mbold green\x1b[22m green')
+        ansi2html_converter = ansi2html.Ansi2HTMLConverter()
+        assert ansi_to_html(ansi) == ansi2html_converter.convert(ansi, full=False)
+        assert (AnsiToHtmlConverter().produce_headers() ==
+                ansi2html_converter.produce_headers())
+
+
+class TestMessages(object):
+    def test_encode_and_decode(self):
+        message = messages.encode(42, 'first\nsecond\n')
+        assert messages.decode(message) == (42, 'first\nsecond\n')
+
+    def test_skip_lines(self):
+        assert messages.skip_lines('a\nb\nc\n', 0) == 'a\nb\nc\n'
+        assert messages.skip_lines('a\nb\nc\n', 2) == 'c\n'
+        assert messages.skip_lines('a\nb\nc\n', 4) == ''
+
 
 class TestPublisher(TestCase):
-    def test_ansi_sequences_formatting(self):
+    def test_publish(self):
         redis_mock = mock.MagicMock()
 
         publisher = kozmic.builds.tasks.Publisher(redis_mock, 'test')
         publisher.publish([
-            '[4mRunning "jshint:lib" (jshint) task[24m',
-            '[36m->[0m running [36m1 suite',  # intentionally omit "[0m"
+            '\x1b[4mRunning "jshint:lib" (jshint) task\x1b[24m',
+            '\x1b[36m->\x1b[0m running \x1b[36m1 suite',
         ])
+        publisher.flush()
 
-        expected_calls = [
-            mock.call('test', '<span class="ansi4">Running "jshint:lib" '
-                              '(jshint) task</span>\n'),
-            mock.call('test', '<span class="ansi36">-&gt;</span> running '
-                              '<span class="ansi36">1 suite</span>\n')
+        # ANSI sequences are kept as is
+        expected_lines = [
+            '\x1b[4mRunning "jshint:lib" (jshint) task\x1b[24m\n',
+            '\x1b[36m->\x1b[0m running \x1b[36m1 suite\n',
         ]
-        assert redis_mock.rpush.call_args_list == expected_calls
-        assert redis_mock.publish.call_args_list == expected_calls
+        pipeline_mock = redis_mock.pipeline.return_value
+        assert pipeline_mock.rpush.call_args_list == [
+            mock.call('test', *expected_lines)]
+        # Messages are prefixed by the number of their first line
+        assert pipeline_mock.publish.call_args_list == [
+            mock.call('test', '0\n' + ''.join(expected_lines))]
+
+    def test_flush_thresholds(self):
+        redis_mock = mock.MagicMock()
+        pipeline_mock = redis_mock.pipeline.return_value
+
+        publisher = kozmic.builds.tasks.Publisher(
+            redis_mock, 'test', max_lines=3, max_bytes=10, max_latency=0.2)
+
+        publisher.publish(['1', '2'])
+        assert not pipeline_mock.execute.called
+        publisher.publish('3')
+        assert pipeline_mock.rpush.call_args_list == [
+            mock.call('test', '1\n', '2\n', '3\n')]
+
+        pipeline_mock.reset_mock()
+        publisher.publish('0123456789')
+        assert pipeline_mock.rpush.call_args_list == [
+            mock.call('test', '0123456789\n')]
+        assert pipeline_mock.publish.call_args_list == [
+            mock.call('test', '3\n0123456789\n')]
+
+        pipeline_mock.reset_mock()
+        publisher.publish('4')
+        assert not pipeline_mock.execute.called
+        time.sleep(0.5)
+        assert pipeline_mock.rpush.call_args_list == [mock.call('test', '4\n')]
+
+        pipeline_mock.reset_mock()
+        publisher.publish('5\n6')
+        publisher.finish()
+        assert pipeline_mock.rpush.call_args_list == [
+            mock.call('test', '5\n', '6\n')]
+        assert pipeline_mock.publish.call_args_list == [
+            mock.call('test', '5\n5\n6\n'),
+            mock.call('test', messages.END_OF_STREAM),
+        ]
+        pipeline_mock.delete.assert_called_once_with('test', 'test:meta')
+
+    def test_list_cap(self):
+        redis_mock = mock.MagicMock()
+        pipeline_mock = redis_mock.pipeline.return_value
+
+        publisher = kozmic.builds.tasks.Publisher(
+            redis_mock, 'test', max_latency=0, list_max_lines=3,
+            list_max_bytes=10, list_ttl=60)
+        publisher.publish(['1', '2'])
+        assert not pipeline_mock.ltrim.called
+        pipeline_mock.hset.assert_called_once_with('test:meta', 'bytes', 4)
+        assert pipeline_mock.expire.call_args_list == [
+            mock.call('test', 60), mock.call('test:meta', 60)]
+
+        pipeline_mock.reset_mock()
+        publisher.publish(['3', '4'])  # Too many lines
+        pipeline_mock.ltrim.assert_called_once_with('test', 1, -1)
+        pipeline_mock.hincrby.assert_called_once_with('test:meta', 'offset', 1)
+        redis_mock.pipeline.assert_called_with(transaction=True)
+
+        pipeline_mock.reset_mock()
+        publisher.publish('0123456')  # Too many bytes
+        pipeline_mock.ltrim.assert_called_once_with('test', 2, -1)
+        pipeline_mock.hset.assert_called_once_with('test:meta', 'bytes', 10)
+
+        pipeline_mock.reset_mock()
+        publisher.publish('0123456789')  # The last line is always kept
+        pipeline_mock.ltrim.assert_called_once_with('test', 2, -1)
+        pipeline_mock.hset.assert_called_once_with('test:meta', 'bytes', 11)
+
+    def test_flush_thread(self):
+        redis_mock = mock.MagicMock()
+        pipeline_mock = redis_mock.pipeline.return_value
+
+        publisher = kozmic.builds.tasks.Publisher(
+            redis_mock, 'test', max_latency=0.1)
+        publisher.publish('1')
+        flush_thread = publisher._flush_thread
+        time.sleep(0.3)
+        publisher.publish('2')
+        time.sleep(0.3)
+        assert pipeline_mock.rpush.call_args_list == [
+            mock.call('test', '1\n'), mock.call('test', '2\n')]
+        # The same thread flushes every batch
+        assert publisher._flush_thread is flush_thread
+        assert flush_thread.is_alive()
+
+        publisher.finish()
+        assert not flush_thread.is_alive()
+
+    def test_list_cap_after_failure(self):
+        redis_mock = mock.MagicMock()
+        pipeline_mock = redis_mock.pipeline.return_value
+
+        publisher = kozmic.builds.tasks.Publisher(
+            redis_mock, 'test', max_latency=0, list_max_lines=3)
+        pipeline_mock.execute.side_effect = redis.ConnectionError
+        with pytest.raises(redis.ConnectionError):
+            publisher.publish(['1', '2', '3', '4'])
+
+        # Only the lines that have been written count
+        pipeline_mock.reset_mock()
+        pipeline_mock.execute.side_effect = None
+        publisher.publish('5')
+        pipeline_mock.ltrim.assert_called_once_with('test', 2, -1)
+        pipeline_mock.hset.assert_called_once_with('test:meta', 'bytes', 6)
+
+    def test_log_writer(self):
+        log_writer_mock = mock.MagicMock()
+        publisher = kozmic.builds.tasks.Publisher(
+            mock.MagicMock(), 'test', log_writer=log_writer_mock)
+        publisher.publish(['1', '2'])
+        publisher.flush()
+        log_writer_mock.write.assert_called_once_with('1\n2\n')
+        publisher.finish()
+        log_writer_mock.close.assert_called_once_with()
+
+
+class TestLRUCache(object):
+    def test_eviction(self):
+        cache = LRUCache(max_size=10)
+        cache.set('a', '1234')
+        cache.set('b', '1234')
+        assert cache.get('a') == '1234'  # "a" is now more recent than "b"
+        cache.set('c', '1234')
+        assert 'b' not in cache
+        assert cache.get('a') == cache.get('c') == '1234'
+        assert cache.size == 8
+
+        cache.set('too-long', '12345678901')
+        assert 'too-long' not in cache
+        assert len(cache) == 2
+
+
+class TestJobLogRenderer(TestCase):
+    def setup_method(self, method):
+        TestCase.setup_method(self, method)
+
+        self.user = factories.UserFactory.create()
+        self.project = factories.ProjectFactory.create(owner=self.user)
+        self.hook = factories.HookFactory.create(project=self.project)
+        self.build = factories.BuildFactory.create(project=self.project)
+        self.hook_call = factories.HookCallFactory.create(
+            hook=self.hook, build=self.build)
+
+    def test_render(self):
+        job = factories.JobFactory.create(
+            build=self.build,
+            hook_call=self.hook_call,
+            started_at=dt.datetime.utcnow(),
+            stdout='\x1b[4mHello!\x1b[24m')
+        renderer = JobLogRenderer(max_size=1024)
+
+        with mock.patch('kozmic.builds.rendering.ansi_to_html',
+                        wraps=ansi_to_html) as ansi_to_html_mock:
+            assert renderer.render(job) == '<span class="ansi4">Hello!</span>'
+            assert renderer.render(job) == '<span class="ansi4">Hello!</span>'
+            assert ansi_to_html_mock.call_count == 1
+
+            # The job is still running and its log has grown
+            job.stdout += '\nBye!'
+            db.session.commit()
+            assert renderer.render(job) == '<span class="ansi4">Hello!</span>\nBye!'
+            assert ansi_to_html_mock.call_count == 2
+            assert (job.id, len('\x1b[4mHello!\x1b[24m')) not in renderer._cache
+
+            job.return_code = 0
+            job.finished_at = dt.datetime.utcnow()
+            db.session.commit()
+            assert renderer.render(job) == '<span class="ansi4">Hello!</span>\nBye!'
+            assert ansi_to_html_mock.call_count == 2
 
 
 @pytest.mark.docker
@@ -689,6 +1011,335 @@ class TestBuilder(TestCase):
         assert builder.return_code == 1
 
 
+    def test_builder_with_mirror(self):
+        with kozmic.builds.tasks.create_temp_dir() as mirrors_dir:
+            repo_path = os.path.join(mirrors_dir, 'test-repo')
+            head_sha = utils.create_git_repo(repo_path)
+            mirror_path = update_git_mirror(mirrors_dir, 'test', repo_path)
+
+            with kozmic.builds.tasks.create_temp_dir() as build_dir:
+                builder = kozmic.builds.tasks.Builder(
+                    docker=docker._get_current_object(),
+                    docker_image='kozmic/ubuntu-base:12.04',
+                    script='#!/bin/bash\nbash ./kozmic.sh',
+                    working_dir=build_dir,
+                    # The source must be cloned from the mirror
+                    clone_url='/does-not-exist',
+                    commit_sha=head_sha,
+                    mirror_path=mirror_path,
+                    message_queue=mock.MagicMock())
+                builder.run()
+
+                log_path = os.path.join(build_dir, 'script.log')
+                with open(log_path, 'r') as log:
+                    stdout = log.read().strip()
+
+        assert not builder.exc_info
+        assert builder.return_code == 0
+        assert stdout == 'Hello!'
+
+    def test_builder_with_checkout_options(self):
+        with kozmic.builds.tasks.create_temp_dir() as build_dir:
+            repo_path = os.path.join(build_dir, 'test-repo')
+            utils.create_git_repo(repo_path)
+            head_sha = utils.add_commit_to_git_repo(repo_path)
+
+            builder = kozmic.builds.tasks.Builder(
+                docker=docker._get_current_object(),
+                docker_image='kozmic/ubuntu-base:12.04',
+                script='#!/bin/bash\nls',
+                working_dir=build_dir,
+                clone_url='/kozmic/test-repo',
+                commit_sha=head_sha,
+                checkout_options={
+                    'ref': 'master',
+                    'shallow': True,
+                    'sparse_paths': ['content'],
+                },
+                message_queue=mock.MagicMock())
+            builder.run()
+
+            log_path = os.path.join(build_dir, 'script.log')
+            with open(log_path, 'r') as log:
+                stdout = log.read().strip()
+
+        assert not builder.exc_info
+        assert builder.return_code == 0
+        assert stdout == 'content'
+
+    def test_builder_reuses_source(self):
+        with kozmic.builds.tasks.create_temp_dir() as source_dir:
+            with kozmic.builds.tasks.create_temp_dir() as build_dir:
+                repo_path = os.path.join(build_dir, 'test-repo')
+                head_sha = utils.create_git_repo(repo_path)
+
+                builder = kozmic.builds.tasks.Builder(
+                    docker=docker._get_current_object(),
+                    docker_image='kozmic/ubuntu-base:12.04',
+                    script='#!/bin/bash\ntouch ./installed',
+                    working_dir=build_dir,
+                    clone_url='/kozmic/test-repo',
+                    commit_sha=head_sha,
+                    source_dir=source_dir,
+                    message_queue=mock.MagicMock())
+                builder.run()
+                assert builder.return_code == 0
+
+            with kozmic.builds.tasks.create_temp_dir() as build_dir:
+                builder = kozmic.builds.tasks.Builder(
+                    docker=docker._get_current_object(),
+                    docker_image='kozmic/ubuntu-base:12.04',
+                    script='#!/bin/bash\nls',
+                    working_dir=build_dir,
+                    # The source must be reused, not cloned
+                    clone_url='/does-not-exist',
+                    commit_sha=head_sha,
+                    source_dir=source_dir,
+                    message_queue=mock.MagicMock())
+                builder.run()
+
+                log_path = os.path.join(build_dir, 'script.log')
+                with open(log_path, 'r') as log:
+                    stdout = log.read().strip()
+
+        assert not builder.exc_info
+        assert builder.return_code == 0
+        # Files created by the previous run are cleaned
+        assert stdout == 'kozmic.sh'
+
+
+class TestGitMirrors(object):
+    def test_update_git_mirror(self):
+        with kozmic.builds.tasks.create_temp_dir() as mirrors_dir:
+            repo_path = os.path.join(mirrors_dir, 'test-repo')
+            head_sha = utils.create_git_repo(repo_path)
+
+            mirror_path = update_git_mirror(mirrors_dir, '1', repo_path)
+            assert mirror_path == os.path.join(mirrors_dir, '1.git')
+            assert subprocess.check_output(
+                ['git', '--git-dir', mirror_path, 'rev-parse', 'HEAD']
+            ).strip() == head_sha
+
+            new_head_sha = utils.add_commit_to_git_repo(repo_path)
+            assert new_head_sha != head_sha
+
+            assert update_git_mirror(mirrors_dir, '1', repo_path) == mirror_path
+            assert subprocess.check_output(
+                ['git', '--git-dir', mirror_path, 'rev-parse', 'HEAD']
+            ).strip() == new_head_sha
+
+    def test_update_git_mirror_failure(self):
+        with kozmic.builds.tasks.create_temp_dir() as mirrors_dir:
+            with pytest.raises(GitMirrorError):
+                update_git_mirror(mirrors_dir, '1', '/does-not-exist')
+            assert not os.path.exists(os.path.join(mirrors_dir, '1.git'))
+
+    def test_ssh_host_keys_are_checked(self):
+        known_hosts = 'github.com ssh-rsa AAAAB3NzaC1yc2EAAAABIwAAAQEAq2A7hRGmdnm9\n'
+        deploy_key = (utils.generate_private_key('passphrase'), 'passphrase')
+        with _git_env(deploy_key, known_hosts) as env:
+            with open(env['GIT_SSH']) as git_ssh:
+                git_ssh_sh = git_ssh.read()
+            assert '-o StrictHostKeyChecking=yes' in git_ssh_sh
+            known_hosts_path = re.search(
+                r'-o UserKnownHostsFile=(\S+)', git_ssh_sh).group(1)
+            with open(known_hosts_path) as known_hosts_file:
+                assert known_hosts_file.read() == known_hosts
+
+
+class TestKnownHosts(TestCase):
+    def test_known_hosts_cache(self):
+        cache = KnownHostsCache(ttl=60)
+        with mock.patch.object(cache, '_scan', return_value='keys-1\n') as scan_mock, \
+             mock.patch('time.time', return_value=1000):
+            assert cache.get() == 'keys-1\n'
+            assert cache.get() == 'keys-1\n'
+        assert scan_mock.call_count == 1
+
+        # Keys have expired but the scan fails: the old ones are used
+        with mock.patch.object(cache, '_scan', return_value='') as scan_mock, \
+             mock.patch('time.time', return_value=1061):
+            assert cache.get() == 'keys-1\n'
+            assert cache.get() == 'keys-1\n'
+        assert scan_mock.call_count == 1
+
+        with mock.patch.object(cache, '_scan', return_value='keys-2\n') as scan_mock, \
+             mock.patch('time.time', return_value=1122):
+            assert cache.get() == 'keys-2\n'
+        assert scan_mock.call_count == 1
+
+    @mock.patch('kozmic.builds.ssh._known_hosts_cache', None)
+    def test_get_known_hosts(self):
+        with mock.patch.object(KnownHostsCache, '_scan',
+                               return_value='keys-1\n') as scan_mock:
+            assert get_known_hosts() == 'keys-1\n'
+            # The keys are cached per process, not per application
+            with self.create_app().app_context():
+                assert get_known_hosts() == 'keys-1\n'
+            assert scan_mock.call_count == 1
+
+            # A forked process gets its own cache
+            with mock.patch('os.getpid', return_value=os.getpid() + 1):
+                assert get_known_hosts() == 'keys-1\n'
+            assert scan_mock.call_count == 2
+
+    def test_pinned_known_hosts(self):
+        self.app.config['KOZMIC_SSH_KNOWN_HOSTS'] = 'github.com ssh-rsa AAAA'
+        with mock.patch.object(KnownHostsCache, '_scan') as scan_mock:
+            assert get_known_hosts() == 'github.com ssh-rsa AAAA\n'
+        assert not scan_mock.called
+
+
+class TestCacheBuildLock(TestCase):
+    def setup_method(self, method):
+        TestCase.setup_method(self, method)
+        config = current_app.config
+        self.redis_client = redis.StrictRedis(
+            host=config['KOZMIC_REDIS_HOST'],
+            port=config['KOZMIC_REDIS_PORT'],
+            db=config['KOZMIC_REDIS_DATABASE'])
+        self.redis_client.delete('kozmic:cache-build-lock:test')
+
+    def test_lock(self):
+        lock_1 = CacheBuildLock(self.redis_client, 'test', 1, ttl=60)
+        lock_2 = CacheBuildLock(self.redis_client, 'test', 2, ttl=60)
+        assert lock_1.acquire() is None
+        assert lock_2.acquire() == '1'
+
+        # The holder renews the lock
+        self.redis_client.expire(lock_1.key, 1)
+        stop_renewing = mock.Mock()
+        stop_renewing.wait.side_effect = [False, True]
+        lock_1._renew(stop_renewing)
+        assert self.redis_client.ttl(lock_1.key) > 1
+        assert lock_2.acquire() == '1'
+
+        # Only the holder can release the lock
+        lock_2.release()
+        assert lock_2.acquire() == '1'
+        lock_1.release()
+        assert lock_2.acquire() is None
+        lock_2.release()
+
+    def test_single_flight(self):
+        built = threading.Event()
+        waited_for = []
+
+        def build():
+            lock = CacheBuildLock(self.redis_client, 'test', 1)
+            with single_flight(lock, built.is_set) as is_built:
+                assert not is_built
+                started.set()
+                time.sleep(1)
+                built.set()
+
+        started = threading.Event()
+        thread = threading.Thread(target=build)
+        thread.start()
+        started.wait()
+
+        lock = CacheBuildLock(self.redis_client, 'test', 2)
+        with single_flight(lock, built.is_set, on_wait=waited_for.append,
+                           poll_interval=0.1) as is_built:
+            assert is_built
+        thread.join()
+        assert waited_for == ['1']
+        assert not self.redis_client.exists('kozmic:cache-build-lock:test')
+
+
+class TestScheduler(TestCase):
+    def setup_method(self, method):
+        TestCase.setup_method(self, method)
+        self.scheduler = utils.create_scheduler()
+        self.limits = {}
+
+    def get_limits(self, project_ids):
+        return self.limits
+
+    def enqueue(self, project_id, n=1):
+        for _ in range(n):
+            self.scheduler.enqueue(project_id, hook_call_id=project_id)
+
+    def pop_projects(self, n):
+        project_ids = []
+        for _ in range(n):
+            job, _ = self.scheduler.pop(self.get_limits)
+            project_ids.append(job['project_id'])
+            self.scheduler.finish(job)
+        return project_ids
+
+    def test_fairness(self):
+        self.enqueue(1, n=3)
+        self.enqueue(2)
+        assert self.pop_projects(4) == [1, 2, 1, 1]
+        assert self.scheduler.pop(self.get_limits) == (None, False)
+        assert not self.scheduler.has_queued_jobs()
+
+        # Idle projects do not accumulate credit
+        self.enqueue(1, n=5)
+        assert self.pop_projects(3) == [1, 1, 1]
+        self.enqueue(2, n=2)
+        assert self.pop_projects(4) == [2, 1, 2, 1]
+
+    def test_weights(self):
+        self.limits = {1: (None, 2), 2: (None, 1)}
+        self.enqueue(1, n=6)
+        self.enqueue(2, n=6)
+        assert self.pop_projects(6) == [1, 2, 1, 1, 2, 1]
+
+    def test_caps(self):
+        self.limits = {1: (1, 1)}
+        self.enqueue(1, n=2)
+        self.enqueue(2)
+
+        job_1, is_blocked = self.scheduler.pop(self.get_limits)
+        assert job_1['project_id'] == 1
+        job_2, is_blocked = self.scheduler.pop(self.get_limits)
+        assert job_2['project_id'] == 2
+        assert is_blocked
+        assert self.scheduler.pop(self.get_limits) == (None, True)
+
+        self.scheduler.finish(job_1)
+        job_3, is_blocked = self.scheduler.pop(self.get_limits)
+        assert job_3['project_id'] == 1
+        assert job_3['hook_call_id'] == 1
+        assert not is_blocked
+
+    def test_leases(self):
+        self.scheduler.lease_ttl = 1
+        self.limits = {1: (1, 1)}
+        self.enqueue(1, n=3)
+
+        job, _ = self.scheduler.pop(self.get_limits)
+        with self.scheduler.hold_lease(job):
+            # The lease is renewed while the job is running
+            time.sleep(1.5)
+            assert self.scheduler.pop(self.get_limits) == (None, True)
+        job, _ = self.scheduler.pop(self.get_limits)
+        assert job
+
+        # The job of a died worker stops counting once its lease expires
+        time.sleep(1.5)
+        job, _ = self.scheduler.pop(self.get_limits)
+        assert job
+
+    def test_get_stats(self):
+        self.enqueue(1, n=3)
+        with mock.patch('time.time', return_value=time.time() + 10):
+            job, _ = self.scheduler.pop(self.get_limits)
+        stats = self.scheduler.get_stats()
+        assert stats.keys() == [1]
+        assert stats[1]['queued'] == 2
+        assert stats[1]['running'] == 1
+        assert stats[1]['started'] == 1
+        assert 0 <= stats[1]['oldest_wait_time'] < 10
+        assert 10 <= stats[1]['average_wait_time'] < 11
+        assert stats[1]['last_wait_time'] == stats[1]['average_wait_time']
+
+        self.scheduler.finish(job)
+        assert self.scheduler.get_stats()[1]['running'] == 0
+
+
 class BuilderStub(kozmic.builds.tasks.Builder):
     def run(self):
         time.sleep(1)
@@ -720,17 +1371,15 @@ class TestBuildTaskDB(TestCase):
             with mock.patch.object(Build, 'set_status') as set_status_mock, \
                  mock.patch.object(DeployKey, 'ensure') as ensure_deploy_key_mock, \
                  mock.patch('kozmic.builds.tasks.Builder', new=BuilderStub), \
-                 mock.patch('kozmic.builds.tasks.Tailer') as tailer_mock, \
                  mock.patch.multiple('docker.Client', pull=mock.DEFAULT,
                                      inspect_image=mock.DEFAULT):
-                tailer_mock.return_value.has_killed_container = False
                 kozmic.builds.tasks.do_job(hook_call_id=hook_call_id)
         self.db.session.rollback()
 
         assert self.build.jobs.count() == 1
         job = self.build.jobs.first()
         assert job.return_code == 0
-        assert 'Everything went great!\nGood bye.' in job.stdout
+        assert job.get_log().endswith('Everything went great!\nGood bye.\n')
         build_number = self.build.number
         ensure_deploy_key_mock.assert_called_once_with()
         set_status_mock.assert_has_calls([
@@ -742,6 +1391,36 @@ class TestBuildTaskDB(TestCase):
                 description='Kozmic build #{} has passed'.format(build_number)),
         ])
 
+    def test_enqueue_job(self):
+        scheduler = utils.create_scheduler()
+        self.app.extensions['kozmic_scheduler'] = scheduler
+
+        hook_call_id = self.hook_call.id
+        project_id = self.project.id
+        with mock.patch('kozmic.builds.tasks.do_job') as do_job_mock:
+            kozmic.builds.tasks.enqueue_job(hook_call_id)
+        do_job_mock.apply.assert_called_once_with(
+            kwargs={'hook_call_id': hook_call_id})
+        stats = scheduler.get_stats()[project_id]
+        assert stats['started'] == 1
+        assert stats['queued'] == stats['running'] == 0
+
+    def test_get_project_limits(self):
+        project_id = self.project.id
+        get_project_limits = kozmic.builds.tasks.get_project_limits
+        assert get_project_limits([project_id]) == {project_id: (None, 1)}
+
+        self.project.max_concurrent_jobs = 2
+        self.project.scheduling_weight = 3
+        self.db.session.commit()
+        assert get_project_limits([project_id]) == {project_id: (2, 3)}
+
+        self.project.max_concurrent_jobs = None
+        self.db.session.commit()
+        with mock.patch.dict(self.app.config,
+                             KOZMIC_SCHEDULER_MAX_JOBS_PER_PROJECT=4):
+            assert get_project_limits([project_id]) == {project_id: (4, 3)}
+
     @pytest.mark.docker
     def test_restart_build(self):
         job = factories.JobFactory.create(
@@ -759,7 +1438,7 @@ class TestBuildTaskDB(TestCase):
                  mock.patch('kozmic.builds.tasks._run') as _run_mock, \
                  mock.patch.object(DeployKey, 'ensure') as ensure_deploy_key_mock:
                 _run_mock.return_value.__enter__ = mock.MagicMock(
-                    side_effect=lambda *args, **kwargs: (0, 'output', {'Id': 'container-id'}))
+                    side_effect=lambda *args, **kwargs: (0, {'Id': 'container-id'}))
                 kozmic.builds.tasks.restart_job(job.id)
         self.db.session.rollback()
 
@@ -770,7 +1449,9 @@ class TestBuildTaskDB(TestCase):
         job = self.build.jobs.first()
         assert job_id_before_restart != job.id
         assert job.return_code == 0
-        assert 'output' in job.stdout
+        assert job.get_log() == (
+            'Pulling "{}" Docker image (pull policy: always)...\n'.format(
+                self.hook.docker_image))
 
 
 class TestJobDB(TestCase):
@@ -796,60 +1477,239 @@ class TestJobDB(TestCase):
         self.hook.tracked_files.extend([
             TrackedFile(path='./a/../b/../install.sh'),
             TrackedFile(path='requirements'),
-            TrackedFile(path='./Gemfile'),
+            TrackedFile(path='./config/settings.py'),
         ])
         db.session.flush()
 
-        dir_entries = ['requirements/basic.txt', 'requirements/dev.txt']
-        deleted_paths = []
-
-        def contents(path, ref=None):
-            # Mock github3.repo.Repository.contents method
-            if path == 'requirements':
-                # Pretend that "requirements" is a directory
-                return dict(zip(dir_entries, map(contents, dir_entries)))
-            else:
-                # Other paths are regular files, maybe deleted
-                if path in deleted_paths:
-                    return None
-                rv = mock.MagicMock()  # Mock github3.repos.contents.Contents
-                rv.sha = hashlib.sha256(path).hexdigest()
-                return rv
-        gh_mock.contents.side_effect = contents
+        # Git trees by their SHAs
+        trees = {
+            'config-1': {'settings.py': ('blob', 'sha-s')},
+        }
+
+        def tree(sha):
+            # Mock github3.repos.Repository.tree method
+            entries = [mock.Mock(path=path, type=type_, sha=entry_sha)
+                       for path, (type_, entry_sha) in trees[sha].items()]
+            return mock.Mock(sha=sha, tree=entries)
+        gh_mock.tree.side_effect = tree
+
+        def set_commit(commit_sha, root_entries):
+            self.build.gh_commit_sha = commit_sha
+            trees[commit_sha] = dict(root_entries, config=('tree', 'config-1'))
 
         seen_cache_ids = set()
 
         # Compute the cache
+        set_commit('sha-1', {'install.sh': ('blob', 'sha-a'),
+                             'requirements': ('tree', 'requirements-1')})
         cache_id = self.job.get_cache_id()
         assert cache_id not in seen_cache_ids
         seen_cache_ids.add(cache_id)
 
-        # Make sure that `get_cache_id` asked GitHub API for contents
-        # of all the tracked files using their normalized paths.
-        # Also make sure that calls are made in lexicographical order
-        assert gh_mock.contents.call_args_list == [
-            mock.call('Gemfile', ref=self.build.gh_commit_sha),
-            mock.call('install.sh', ref=self.build.gh_commit_sha),
-            mock.call('requirements', ref=self.build.gh_commit_sha),
-        ]
+        # Make sure that `get_cache_id` asked GitHub API only for the trees
+        # along the tracked paths, one request per tree. The tracked
+        # directory is identified by its tree SHA, its tree is not needed
+        assert gh_mock.tree.call_args_list == [
+            mock.call('sha-1'), mock.call('config-1')]
 
-        # Add a new file to the tracked directory and
-        # make sure the cache id is changed
-        dir_entries.append('requirements/new-file.txt')
+        # Change a file nested in the tracked directory (which changes
+        # the directory tree SHA) and make sure the cache id is changed
+        set_commit('sha-2', {'install.sh': ('blob', 'sha-a'),
+                             'requirements': ('tree', 'requirements-2')})
         cache_id = self.job.get_cache_id()
         assert cache_id not in seen_cache_ids
         seen_cache_ids.add(cache_id)
 
         # Delete one of the tracked files and make sure the cache id is changed
-        deleted_paths.append('install.sh')
+        set_commit('sha-3', {'requirements': ('tree', 'requirements-2')})
         cache_id = self.job.get_cache_id()
         assert cache_id not in seen_cache_ids
         seen_cache_ids.add(cache_id)
 
-        # Change nothing and make sure the cache id is not changed
+        # Change an untracked file and make sure the cache id is not changed
+        set_commit('sha-4', {'requirements': ('tree', 'requirements-2'),
+                             'README': ('blob', 'sha-e')})
         cache_id = self.job.get_cache_id()
         assert cache_id in seen_cache_ids
 
+        # Results are memoized per commit
+        gh_mock.tree.reset_mock()
+        assert self.job.get_cache_id() == cache_id
+        assert not gh_mock.tree.called
+
+    @mock.patch('kozmic.docker_utils.get_docker_image_id', return_value='id-1')
+    @mock.patch.object(Job, 'get_stage_cache_ids', return_value=['cache-id-1'])
+    def test_get_cache_key(self, get_cache_ids_mock, get_image_id_mock):
+        cache_key = self.job.get_cache_key()
+        assert cache_key.cache_id == 'cache-id-1'
+        assert cache_key.docker_image == 'kozmic-cache/cache-id-1:{}'.format(
+            self.project.id)
+        assert get_cache_ids_mock.call_count == 1
+
+        # The job is restarted: the cache key is reused
+        job = factories.JobFactory.create(
+            build=self.build, hook_call=self.hook_call)
+        assert job.get_cache_key().id == cache_key.id
+        assert get_cache_ids_mock.call_count == 1
+        assert CacheKey.query.count() == 1
+
+        # The install script has changed
+        get_cache_ids_mock.return_value = ['cache-id-2']
+        self.hook.install_script = '#!/bin/bash\nbundle install'
+        assert job.get_cache_key().cache_id == 'cache-id-2'
+        assert get_cache_ids_mock.call_count == 2
+
+        # The base image has changed
+        get_image_id_mock.return_value = 'id-2'
+        get_cache_ids_mock.return_value = ['cache-id-3']
+        assert job.get_cache_key().cache_id == 'cache-id-3'
+        assert get_cache_ids_mock.call_count == 3
+        assert CacheKey.query.count() == 3
+
+        # An install stage has been added
+        self.hook.install_stages.append(
+            InstallStage(number=1, script='#!/bin/bash\nnpm install'))
+        get_cache_ids_mock.return_value = ['cache-id-3', 'cache-id-4']
+        cache_key = job.get_cache_key()
+        assert cache_key.cache_id == 'cache-id-4'
+        assert cache_key.get_stage_docker_images() == [
+            'kozmic-cache/cache-id-3:{}'.format(self.project.id),
+            'kozmic-cache/cache-id-4:{}'.format(self.project.id),
+        ]
+        assert get_cache_ids_mock.call_count == 4
+
+    @mock.patch('kozmic.docker_utils.get_docker_image_id', return_value='id-1')
+    @mock.patch.object(Job, 'get_stage_cache_ids', return_value=['cache-id-1'])
+    def test_get_cache_key_created_concurrently(self, get_cache_ids_mock,
+                                                get_image_id_mock):
+        key = {
+            'hook_id': self.hook.id,
+            'install_script_hash': CacheKey.get_install_script_hash(
+                [self.hook.install_script]),
+            'docker_image_id': 'id-1',
+            'gh_commit_sha': self.build.gh_commit_sha,
+        }
+        # Make sure the job's transaction has started before the key is created
+        assert CacheKey.query.filter_by(**key).first() is None
+
+        def create_key_concurrently(mirror_path=None):
+            # Another job creates the key while this one computes the cache ids
+            with db.engine.connect() as connection:
+                connection.execute(CacheKey.__table__.insert().values(
+                    cache_id='cache-id-0',
+                    docker_image='kozmic-cache/cache-id-0:1',
+                    stage_docker_images='kozmic-cache/cache-id-0:1',
+                    created_at=dt.datetime.utcnow(),
+                    **key))
+            return ['cache-id-1']
+        get_cache_ids_mock.side_effect = create_key_concurrently
+
+        cache_key = self.job.get_cache_key()
+        assert cache_key.cache_id == 'cache-id-0'
+        assert CacheKey.query.count() == 1
+
+    @mock.patch('kozmic.docker_utils.get_docker_image_id', return_value='id-1')
+    @mock.patch('kozmic.models.get_tracked_file_shas')
+    def test_get_stage_cache_ids(self, get_shas_mock, get_image_id_mock):
+        self.hook.tracked_files.delete()
+        self.hook.tracked_files.append(TrackedFile(path='requirements.txt'))
+        self.hook.install_stages.extend([
+            InstallStage(number=2, script='#!/bin/bash\nnpm install',
+                         tracked_files='./package.json\n\n'),
+            InstallStage(number=1, script='#!/bin/bash\nbower install',
+                         tracked_files='bower.json'),
+        ])
+        db.session.flush()
+        assert [script for script, _ in self.hook.get_install_stages()] == [
+            '#!/bin/bash\npip install -r reqs.txt',
+            '#!/bin/bash\nbower install',
+            '#!/bin/bash\nnpm install',
+        ]
+
+        shas = {
+            'requirements.txt': 'sha-a',
+            'bower.json': 'sha-b',
+            'package.json': 'sha-c',
+        }
+        get_shas_mock.side_effect = lambda *args, **kwargs: dict(shas)
+
+        cache_ids = self.job.get_stage_cache_ids()
+        assert len(set(cache_ids)) == 3
+        # SHAs of all the stages are requested at once
+        assert get_shas_mock.call_count == 1
+        assert sorted(get_shas_mock.call_args[0][1]) == [
+            'bower.json', './package.json', 'requirements.txt']
+        assert self.job.get_cache_id() == cache_ids[-1]
+
+        # A change of the second stage tracked file changes only
+        # the second and the following stages cache ids
+        shas['bower.json'] = 'sha-d'
+        new_cache_ids = self.job.get_stage_cache_ids()
+        assert new_cache_ids[0] == cache_ids[0]
+        assert new_cache_ids[1] != cache_ids[1]
+        assert new_cache_ids[2] != cache_ids[2]
+
+        # A change of the base image changes all of them
+        get_image_id_mock.return_value = 'id-2'
+        assert not set(self.job.get_stage_cache_ids()) & set(new_cache_ids)
+
+    def test_get_tracked_file_shas_from_mirror(self):
+        with kozmic.builds.tasks.create_temp_dir() as repo_dir:
+            git_dir = os.path.join(repo_dir, '.git')
+
+            def git(*args):
+                return subprocess.check_output(
+                    ['git', '--git-dir', git_dir, '--work-tree', repo_dir] +
+                    list(args)).strip()
+
+            def tree(sha):
+                # Mock github3.repos.Repository.tree method using the same
+                # repository, the way GitHub Git Trees API sees it
+                entries = []
+                for line in git('ls-tree', sha).splitlines():
+                    info, path = line.split('\t')
+                    _, type_, entry_sha = info.split()
+                    entries.append(mock.Mock(path=path, type=type_, sha=entry_sha))
+                return mock.Mock(sha=git('rev-parse', sha + '^{tree}'),
+                                 tree=entries)
+            gh_repo = mock.Mock()
+            gh_repo.tree.side_effect = tree
+
+            utils.create_git_repo(repo_dir)
+            os.mkdir(os.path.join(repo_dir, 'requirements'))
+            with open(os.path.join(repo_dir, 'requirements', 'basic.txt'), 'w') as f:
+                f.write('flask\n')
+            git('add', 'requirements')
+            git('commit', '-m', 'Add requirements')
+            head_sha = git('rev-parse', 'HEAD')
+
+            paths = ['', 'kozmic.sh', 'requirements', 'missing.txt']
+            shas = get_tracked_file_shas_from_mirror(git_dir, head_sha, paths)
+            assert shas['kozmic.sh'] == git('rev-parse', head_sha + ':kozmic.sh')
+            assert shas['requirements'] == git(
+                'rev-parse', head_sha + ':requirements')
+            assert shas['']
+            assert shas['missing.txt'] is None
+            # The mirror and GitHub identify directories by the same tree SHAs
+            assert get_tracked_file_shas_from_github(
+                gh_repo, head_sha, paths) == shas
+
+            # A change of a nested file changes the directory tree SHA
+            with open(os.path.join(repo_dir, 'requirements', 'basic.txt'), 'a') as f:
+                f.write('redis\n')
+            git('commit', '-a', '-m', 'Change requirements')
+            new_head_sha = git('rev-parse', 'HEAD')
+            new_shas = get_tracked_file_shas_from_mirror(
+                git_dir, new_head_sha, paths)
+            assert new_shas['requirements'] != shas['requirements']
+            assert new_shas['kozmic.sh'] == shas['kozmic.sh']
+            assert get_tracked_file_shas_from_github(
+                gh_repo, new_head_sha, paths) == new_shas
+
+            with pytest.raises(TreeError):
+                get_tracked_file_shas_from_mirror(
+                    os.path.join(repo_dir, '.git'), 'f' * 40, ['kozmic.sh'])
+
     @mock.patch('kozmic.docker_utils.get_docker_image_id', return_value='id-1')
     @mock.patch.object(Project, 'gh')
     def test_get_cache_id_changes_when__script_changes(
@@ -889,10 +1749,178 @@ class TestJobDB(TestCase):
         cache_id = self.job.get_cache_id()
         assert cache_id not in seen_cache_ids
 
+    def test_log(self):
+        log = 'first\n\x1b[32msecond\x1b[0m\n\nfourth\nfifth'
+        log_writer = JobLogWriter(db.engine, self.job.id, chunk_size=4)
+        for i in xrange(0, len(log), 3):
+            log_writer.write(log[i:i + 3])
+        log_writer.close()
+
+        assert self.job.log_chunks.count() == 9
+        assert self.job.get_log_length() == len(log)
+        assert self.job.get_log_line_count() == 5
+        assert self.job.get_log() == log
+        assert self.job.get_log(3, 9) == log[3:9]
+        assert self.job.get_log(len(log) - 2) == 'th'
+        assert self.job.get_log(100) == ''
+        assert ''.join(self.job.iter_log(chunks_per_query=2)) == log
+        assert ''.join(self.job.iter_log(9, chunks_per_query=2)) == log[:9]
+        assert self.job.get_log_lines() == log
+        assert self.job.get_log_lines(1, 3) == '\x1b[32msecond\x1b[0m\n\n'
+        assert self.job.get_log_lines(3) == 'fourth\nfifth'
+        assert self.job.get_log_lines(5) == ''
+        for start in xrange(7):
+            assert (''.join(self.job.iter_log_lines(start, chunks_per_query=2)) ==
+                    self.job.get_log_lines(start))
+
+    def test_legacy_log(self):
+        self.job.stdout = 'first\nsecond\nthird\n'
+        db.session.commit()
+
+        assert self.job.get_log_length() == 19
+        assert self.job.get_log_line_count() == 3
+        assert self.job.get_log(6, 12) == 'second'
+        assert self.job.get_log_lines(1, 2) == 'second\n'
+        assert ''.join(self.job.iter_log_lines(1)) == 'second\nthird\n'
+        assert ''.join(self.job.iter_log(8)) == 'first\nse'
+
+
+class TestCeleryApp(TestCase):
+    def test_tasks_reuse_app(self):
+        @celery.task
+        def get_app_and_context():
+            return current_app._get_current_object(), _app_ctx_stack.top
+
+        with mock.patch('kozmic.create_app') as create_app_mock:
+            app_1, ctx_1 = get_app_and_context.delay().get()
+            app_2, ctx_2 = get_app_and_context.delay().get()
+        assert not create_app_mock.called
+        # Tasks are run in the worker application, each in its own context
+        assert app_1 is app_2 is self.app
+        assert ctx_1 is not ctx_2
+        assert self.ctx not in (ctx_1, ctx_2)
+
+
+class TestPooledDockerClient(object):
+    def test_connections_are_reused(self):
+        connections = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                connections.append(self.connection)
+
+            def do_GET(self):
+                body = json.dumps({'Version': '0.9.0', 'Path': self.path})
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+        with kozmic.builds.tasks.create_temp_dir() as temp_dir:
+            socket_path = os.path.join(temp_dir, 'docker.sock')
+            server = Server(socket_path, Handler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            try:
+                client = docker_utils.PooledDockerClient(
+                    base_url='unix://' + socket_path, version='1.10')
+                for _ in range(3):
+                    assert client.version()['Path'] == '/v1.10/version'
+                assert len(connections) == 1
+
+                # Concurrent requests open more connections
+                results = []
+                threads = [threading.Thread(
+                    target=lambda: results.append(client.version()))
+                    for _ in range(5)]
+                for request_thread in threads:
+                    request_thread.start()
+                for request_thread in threads:
+                    request_thread.join()
+                assert len(results) == 5
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+class TestRedisUtils(TestCase):
+    def setup_method(self, method):
+        TestCase.setup_method(self, method)
+        self.redis_client = redis_utils.get_redis_client()
+        self.redis_client.delete(redis_utils.POOL_STATS_KEY)
+
+    def test_get_redis_client(self):
+        pool = self.redis_client.connection_pool
+        assert isinstance(pool, redis_utils.ConnectionPool)
+        assert redis_utils.get_redis_client().connection_pool is pool
+
+        self.redis_client.ping()
+        with self.redis_client.pipeline() as pipeline:
+            self.redis_client.ping()
+            pipeline.ping().execute()
+        stats = pool.get_stats()
+        assert stats['created'] == 2
+        assert stats['in_use'] == 0
+        assert stats['idle'] == 2
+        assert stats['peak_in_use'] == 2
+        assert stats['max'] is None
+
+    def test_health_check(self):
+        pool = redis_utils.create_connection_pool(
+            host=self.app.config['KOZMIC_REDIS_HOST'],
+            port=self.app.config['KOZMIC_REDIS_PORT'],
+            db=self.app.config['KOZMIC_REDIS_DATABASE'],
+            health_check_interval=30)
+        redis_client = redis.StrictRedis(connection_pool=pool)
+        assert redis_client.ping()
+
+        # The connection has been closed while idle
+        connection = pool._available_connections[0]
+        connection._sock.close()
+        assert redis_client.ping()
+        assert pool.get_stats()['failed_health_checks'] == 0
+
+        connection._sock.close()
+        connection.released_at -= 30
+        assert redis_client.ping()
+        assert pool.get_stats()['failed_health_checks'] == 1
+        assert pool.get_stats()['created'] == 1
+
+    def test_pool_stats(self):
+        self.redis_client.ping()
+        redis_utils.report_pool_stats(self.redis_client, 'worker')
+        pool_stats = redis_utils.get_pool_stats(self.redis_client)
+        assert len(pool_stats) == 1
+        name, stats = pool_stats.items()[0]
+        assert name.startswith('worker:')
+        assert stats['created'] == 1
+
+        # Stale reports are removed
+        with mock.patch('time.time', return_value=time.time() + 3601):
+            assert not redis_utils.get_pool_stats(self.redis_client)
+        assert not self.redis_client.exists(redis_utils.POOL_STATS_KEY)
+
+    def test_broker_transport_options(self):
+        config = dict(self.app.config, KOZMIC_REDIS_MAX_CONNECTIONS=20)
+        assert redis_utils.get_broker_transport_options(config) == {
+            'max_connections': 20}
+
 
 class TestCommands(TestCase):
+    @mock.patch('kozmic.docker_utils.remove_image')
     @mock.patch('kozmic.builds.commands.docker')
-    def test_clean_dependencies_cache(self, docker_mock):
+    def test_clean_dependencies_cache(self, docker_mock, remove_image_mock):
         i = 'kozmic-cache/{}:{}'.format
         docker_mock.images.return_value = [
             {'RepoTags': [i('a1', '1')], 'Created': 1389658801, 'Id': 'id-a1'},
@@ -903,41 +1931,187 @@ class TestCommands(TestCase):
             {'RepoTags': [i('a2', '2')], 'Created': 1389658212, 'Id': 'id-a2'},
         ]
         kozmic.builds.commands.clean_dependencies_cache()
-        assert docker_mock.remove_image.call_args_list == [
+        assert remove_image_mock.call_args_list == [
             mock.call('id-e1'),
             mock.call('id-b1'),
         ]
 
+    def test_get_log_buffers_stats(self):
+        user = factories.UserFactory.create()
+        project = factories.ProjectFactory.create(owner=user)
+        hook = factories.HookFactory.create(project=project)
+        build = factories.BuildFactory.create(project=project)
+        hook_call = factories.HookCallFactory.create(hook=hook, build=build)
+        job = factories.JobFactory.create(
+            build=build, hook_call=hook_call, started_at=dt.datetime.utcnow(),
+            task_uuid='test-job')
+        factories.JobFactory.create(
+            build=build, hook_call=hook_call, started_at=dt.datetime.utcnow(),
+            finished_at=dt.datetime.utcnow(), task_uuid='finished-test-job')
+
+        config = current_app.config
+        redis_client = redis.StrictRedis(host=config['KOZMIC_REDIS_HOST'],
+                                         port=config['KOZMIC_REDIS_PORT'],
+                                         db=config['KOZMIC_REDIS_DATABASE'])
+        publisher = kozmic.builds.tasks.Publisher(
+            redis_client, 'test-job', max_latency=0, list_max_lines=2)
+        try:
+            publisher.publish(['1', '2', '3'])
+            stats = kozmic.builds.commands.get_log_buffers_stats(redis_client)
+            assert len(stats) == 1
+            assert stats[0]['job'] == job
+            assert stats[0]['lines'] == 2
+            assert stats[0]['bytes'] == 4
+            assert stats[0]['trimmed_lines'] == 1
+            assert 0 < stats[0]['ttl'] <= 3600
+        finally:
+            publisher.finish()
+
+        stats = kozmic.builds.commands.get_log_buffers_stats(redis_client)
+        assert stats[0]['lines'] == 0
+        assert stats[0]['ttl'] is None
+
 
 class TestUtils(TestCase):
-    @mock.patch.object(_docker.Client, 'images')
-    def test_does_docker_image_exist(self, images_mock):
-        images_mock.return_value = [
-            {
-                'RepoTags': [
-                    'ubuntu:12.04',
-                    'ubuntu:precise',
-                    'ubuntu:latest'
-                ],
+    @mock.patch.object(_docker.Client, 'inspect_image')
+    def test_does_docker_image_exist(self, inspect_image_mock):
+        images = {
+            'ubuntu:12.04': {
                 'Id': '8dbd9e392a964056420e5d58ca5cc376ef18e2de93b5cc90e868a1bbc8318c1c',
-                'Created': 1365714795,
+                'Created': '2013-04-11T21:13:15.000000000Z',
                 'Size': 131506275,
-                'VirtualSize': 131506275
             },
-            {
-                'RepoTags': [
-                    'ubuntu:12.10',
-                    'ubuntu:quantal'
-                ],
-                'ParentId': '27cf784147099545',
-                'Id': 'b750fe79269d2ec9a3c593ef05b4332b1d1a02a62b4accb2c21d589ff2f5f2dc',
-                'Created': 1364102658,
-                'Size': 24653,
-                'VirtualSize': 180116135
-            }
-        ]
+            'ubuntu:latest': {
+                'Id': '8dbd9e392a964056420e5d58ca5cc376ef18e2de93b5cc90e868a1bbc8318c1c',
+                'Created': '2013-04-11T21:13:15.000000000Z',
+                'Size': 131506275,
+            },
+        }
+
+        def inspect_image(name):
+            if name not in images:
+                raise _docker.APIError('No such image', mock.Mock(status_code=404))
+            return images[name]
+        inspect_image_mock.side_effect = inspect_image
 
         assert docker_utils.does_docker_image_exist('ubuntu', tag='12.04')
         assert docker_utils.does_docker_image_exist('ubuntu')
         assert not docker_utils.does_docker_image_exist('ubuntu', tag='qwerty')
         assert not docker_utils.does_docker_image_exist('debian')
+        assert inspect_image_mock.call_count == 4
+
+        # Results are cached
+        assert docker_utils.does_docker_image_exist('ubuntu', tag='12.04')
+        assert not docker_utils.does_docker_image_exist('debian')
+        assert inspect_image_mock.call_count == 4
+
+        # Other Docker errors are not swallowed
+        inspect_image_mock.side_effect = _docker.APIError(
+            'Server error', mock.Mock(status_code=500))
+        with pytest.raises(_docker.APIError):
+            docker_utils.get_docker_image_id('centos')
+
+    @mock.patch.multiple('docker.Client', commit=mock.DEFAULT,
+                         remove_image=mock.DEFAULT, inspect_image=mock.DEFAULT)
+    def test_image_index_invalidation(self, commit, remove_image, inspect_image):
+        inspect_image.side_effect = _docker.APIError(
+            'No such image', mock.Mock(status_code=404))
+        assert not docker_utils.get_docker_image_id('kozmic-cache/qwerty', tag='1')
+
+        docker_utils.commit_image('container-id', 'kozmic-cache/qwerty', tag='1')
+        inspect_image.side_effect = None
+        inspect_image.return_value = {'Id': 'image-id'}
+        assert docker_utils.get_docker_image_id(
+            'kozmic-cache/qwerty', tag='1') == 'image-id'
+
+        docker_utils.remove_image('image-id')
+        remove_image.assert_called_once_with('image-id')
+        inspect_image.reset_mock()
+        docker_utils.get_docker_image_id('kozmic-cache/qwerty', tag='1')
+        assert inspect_image.call_count == 1
+
+    def test_get_docker_client(self):
+        client = docker_utils.get_docker_client()
+        assert docker._get_current_object() is client
+        assert docker_utils.get_docker_client() is client
+
+        # A forked process gets its own client
+        with mock.patch('os.getpid', return_value=client.pid + 1):
+            assert docker_utils.get_docker_client() is not client
+
+    def test_get_worker_slots(self):
+        with mock.patch('multiprocessing.cpu_count', return_value=8), \
+             mock.patch('os.sysconf', side_effect=lambda name: {
+                 'SC_PAGE_SIZE': 4096,
+                 'SC_PHYS_PAGES': 4 * 2 ** 30 / 4096,
+             }[name]):
+            assert kozmic.utils.get_worker_slots(1, 1024) == 4
+            assert kozmic.utils.get_worker_slots(4, 512) == 2
+            assert kozmic.utils.get_worker_slots(16, 8192) == 1
+
+    def test_get_image_index(self):
+        index = docker_utils.get_image_index()
+        # The index is shared by the applications of the process
+        with self.create_app().app_context():
+            assert docker_utils.get_image_index() is index
+
+        # A forked process gets its own index
+        with mock.patch('os.getpid', return_value=index.pid + 1):
+            assert docker_utils.get_image_index() is not index
+
+    def test_image_index_ttl(self):
+        index = docker_utils.ImageIndex(ttl=30)
+        with mock.patch('time.time', return_value=1000):
+            index.set('ubuntu:latest', 'image-id')
+            assert index.get('ubuntu:latest') == (True, 'image-id')
+            assert index.get('debian:latest') == (False, None)
+        with mock.patch('time.time', return_value=1030):
+            assert index.get('ubuntu:latest') == (False, None)
+
+    @mock.patch.multiple('docker.Client', pull=mock.DEFAULT,
+                         inspect_image=mock.DEFAULT)
+    def test_pull_image(self, pull, inspect_image):
+        with kozmic.builds.tasks.create_temp_dir() as pulls_dir:
+            pull_image = lambda policy, max_age=0: docker_utils.pull_image(
+                'ubuntu', policy=policy, max_age=max_age, pulls_dir=pulls_dir)
+
+            assert pull_image(docker_utils.PULL_NEVER_IF_PRESENT) is False
+            assert not pull.called
+
+            assert pull_image(docker_utils.PULL_ALWAYS) is True
+            assert pull.call_count == 1
+
+            assert pull_image(docker_utils.PULL_IF_OLDER_THAN, max_age=60) is False
+            assert pull.call_count == 1
+            assert pull_image(docker_utils.PULL_IF_OLDER_THAN, max_age=0) is True
+            assert pull.call_count == 2
+
+            # The image is missing, so it's pulled regardless of the policy
+            inspect_image.side_effect = [
+                _docker.APIError('No such image', mock.Mock()), None]
+            assert pull_image(docker_utils.PULL_NEVER_IF_PRESENT) is True
+            assert pull.call_count == 3
+
+    @mock.patch.multiple('docker.Client', pull=mock.DEFAULT,
+                         inspect_image=mock.DEFAULT)
+    def test_concurrent_pulls(self, pull, inspect_image):
+        """Tests that concurrent jobs trigger a single pull."""
+        pull.side_effect = lambda image: time.sleep(0.5)
+
+        with kozmic.builds.tasks.create_temp_dir() as pulls_dir:
+            results = []
+
+            def target():
+                with self.app.app_context():
+                    results.append(docker_utils.pull_image(
+                        'ubuntu', policy=docker_utils.PULL_ALWAYS,
+                        pulls_dir=pulls_dir))
+
+            threads = [threading.Thread(target=target) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert pull.call_count == 1
+        assert sorted(results) == [False] * 4 + [True]
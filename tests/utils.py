@@ -2,6 +2,9 @@ import subprocess
 
 from Crypto.PublicKey import RSA
 
+from kozmic.redis_utils import get_redis_client
+from kozmic.builds.scheduler import Scheduler
+
 
 CREATE_GIT_REPO_SH = '''
 git init {dir}
@@ -35,11 +38,12 @@ def create_git_repo(target_dir):
 
 
 def add_commit_to_git_repo(target_dir):
+    """Adds a commit to :param:`target_dir` repository. Returns head SHA."""
     subprocess.call(
         COMMIT_TO_GIT_REPO_SH.format(dir=target_dir), shell=True,
         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     return subprocess.check_output(
-        'cd {}'.format(target_dir),
+        'cd {} && git rev-parse HEAD'.format(target_dir),
         shell=True
     ).strip()
 
@@ -47,3 +51,14 @@ def add_commit_to_git_repo(target_dir):
 def generate_private_key(passphrase):
     rsa_key = RSA.generate(1024)
     return rsa_key.exportKey(format='PEM', passphrase=passphrase)
+
+
+def create_scheduler():
+    """Returns a :class:`kozmic.builds.scheduler.Scheduler` that uses
+    Redis keys of its own. The keys left by the previous tests are deleted.
+    """
+    redis_client = get_redis_client()
+    prefix = 'kozmic:test-scheduler:'
+    for key in redis_client.keys(prefix + '*'):
+        redis_client.delete(key)
+    return Scheduler(redis_client, prefix=prefix)